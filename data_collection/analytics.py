@@ -0,0 +1,372 @@
+"""
+This script turns the collected measurements into per-relay, per-time-window and per-anchor summaries.
+
+-   The binary store is read through read-only memory maps and a JSON lines measurements file is parsed in chunks, so
+    only one chunk of samples is held in memory at a time. A running collector is not disturbed
+-   Every TTLB sample is counted in log-bucketed histograms, one row per relay, anchor and time window. Quantiles come
+    out within SKETCH_RELATIVE_ACCURACY and memory grows with the number of relays, not of samples
+
+-   outputs, written to the output directory:
+    -   relays.csv: samples, TTLB percentiles and median throughput of every relay
+    -   windows.csv: samples, relays measured and TTLB percentiles of every time window
+    -   anchors.csv: samples and TTLB percentiles of every anchor, and its geometric mean TTLB ratio to the most used
+        anchor over the relays measured through both
+    -   scores.json: the TTLB quantile of every relay, like Database.getScores
+
+-   usage: python -m data_collection.analytics [--jsonl measurements.json | --store measurements.bin] [--out analytics]
+    [--window-hours 24] [--quantile 0.5]
+"""
+
+# IMPORTS
+
+import os
+import sys
+import csv
+import json
+import math
+import argparse
+import datetime
+from itertools import chain
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+    print("Could not import numpy")
+
+from data_collection.main import MeasurementStore, STORE_FILE, SKETCH_RELATIVE_ACCURACY
+
+
+# VARIABLES
+
+OUTPUT_DIR = "analytics"
+CHUNK_RECORDS = 1 << 20  # store records read at once
+CHUNK_LINES = 100000  # JSON lines parsed at once
+DEFAULT_WINDOW_HOURS = 24
+PERCENTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+MIN_TTLB = 1e-3  # TTLBs are clamped to [MIN_TTLB, MAX_TTLB] seconds before they are bucketed
+MAX_TTLB = 1e4
+
+
+# UTILS
+
+def recordDtype():
+    """
+    NumPy view of MeasurementStore.RECORD.
+    """
+    dtype = np.dtype([('relay', 'V20'), ('timestamp', '<f8'), ('offset', '<u8'), ('count', '<u2'),
+                      ('anchor', '<u2'), ('file_size', '<u4'), ('build_time', '<f4')])
+    assert dtype.itemsize == MeasurementStore.RECORD.size
+    return dtype
+
+
+def parseTimestamps(timestamps):
+    """
+    Vectorized main.parseTimestamp: local TIMESTAMP_FORMAT strings to seconds since the epoch.
+    """
+    naive = np.array([t.replace(' T ', 'T') for t in timestamps], dtype='datetime64[us]')
+    seconds = naive.astype(np.int64) / 1e6
+    hours, inverse = np.unique(np.floor(seconds / 3600).astype(np.int64), return_inverse=True)
+    epoch = datetime.datetime(1970, 1, 1)
+    offsets = np.array([(epoch + datetime.timedelta(hours=int(h))).timestamp() - h * 3600 for h in hours])
+    return seconds + offsets[inverse]
+
+
+def growRows(array, rows):
+    """
+    Returns array with at least rows rows, doubling its capacity when it has to grow.
+    """
+    if rows <= array.shape[0]:
+        return array
+    grown = np.zeros((max(rows, 2 * array.shape[0]),) + array.shape[1:], dtype=array.dtype)
+    grown[:array.shape[0]] = array
+    return grown
+
+
+def percentileNames():
+    return [f"p{round(q * 100)}" for q in PERCENTILES]
+
+
+# CLASSES
+
+class Keys:
+    def __init__(self):
+        """
+        Interns keys (fingerprints, anchors, windows) as consecutive row numbers.
+        """
+        self.names = list()
+        self._rows = dict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def rows(self, keys, convert=None):
+        """
+        Returns the row of every key, converting the distinct ones with convert before interning them.
+        """
+        unique, inverse = np.unique(keys, return_inverse=True)
+        rows = np.empty(len(unique), dtype=np.int64)
+        for i, key in enumerate(unique.tolist()):
+            name = convert(key) if convert else key
+            row = self._rows.get(name)
+            if row is None:
+                row = self._rows[name] = len(self.names)
+                self.names.append(name)
+            rows[i] = row
+        return rows[inverse.reshape(-1)]
+
+
+class LogHistograms:
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        """
+        One log-bucketed TTLB histogram per row. Bucket bounds grow geometrically like those of QuantileSketch, so every
+        quantile is estimated within relative_accuracy.
+        """
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self._min_key = math.ceil(math.log(MIN_TTLB) / self._log_gamma)
+        self.buckets = math.ceil(math.log(MAX_TTLB) / self._log_gamma) - self._min_key + 1
+        self.rows = 0
+        self.counts = np.zeros((0, self.buckets), dtype=np.int64)
+
+    def add(self, rows, values):
+        if not len(rows):
+            return
+        keys = np.ceil(np.log(np.clip(values, MIN_TTLB, MAX_TTLB)) / self._log_gamma).astype(np.int64) - self._min_key
+        self.rows = max(self.rows, int(rows.max()) + 1)
+        self.counts = growRows(self.counts, self.rows)
+        flat = np.bincount(rows * self.buckets + keys, minlength=self.rows * self.buckets)
+        self.counts[:self.rows] += flat.reshape(self.rows, self.buckets)
+
+    def totals(self):
+        return self.counts[:self.rows].sum(axis=1)
+
+    def quantiles(self, qs):
+        """
+        :return: array of the qs quantiles of every row, NaN for rows without samples
+        """
+        cumulative = np.cumsum(self.counts[:self.rows], axis=1)
+        totals = cumulative[:, -1] if self.rows else np.zeros(0, dtype=np.int64)
+        result = np.full((self.rows, len(qs)), np.nan)
+        for i, q in enumerate(qs):
+            keys = (cumulative < (q * totals)[:, None]).sum(axis=1) + self._min_key
+            result[:, i] = np.where(totals > 0, 2 * self.gamma ** keys / (self.gamma + 1), np.nan)
+        return result
+
+
+class Analytics:
+    def __init__(self, window_hours=DEFAULT_WINDOW_HOURS, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        self.window_seconds = window_hours * 3600
+        self.relays = Keys()
+        self.anchors = Keys()
+        self.windows = Keys()
+        self.relay_histograms = LogHistograms(relative_accuracy)
+        self.anchor_histograms = LogHistograms(relative_accuracy)
+        self.window_histograms = LogHistograms(relative_accuracy)
+
+        self.measurements = 0
+        self.relay_file_size = np.zeros(0)                  # sum of the file size of every sample, per relay
+        self.relay_seen = np.zeros((0, 2))                  # first and last timestamp, per relay
+        self.relay_anchor_logs = np.zeros((0, 0))           # sum of log TTLB, per relay and anchor
+        self.relay_anchor_samples = np.zeros((0, 0))        # samples, per relay and anchor
+        self.window_relays = np.zeros((0, 0), dtype=bool)   # whether a relay was measured, per window and relay
+
+    # Loading
+    def add(self, relays, anchors, timestamps, file_sizes, counts, ttlbs, relay_key=None):
+        """
+        Adds a chunk of measurements. relays, anchors, timestamps, file_sizes and counts have one entry per measurement
+        and ttlbs holds their samples back to back.
+        """
+        relay_rows = self.relays.rows(relays, relay_key)
+        anchor_rows = self.anchors.rows(anchors)
+        window_rows = self.windows.rows(np.floor(timestamps / self.window_seconds).astype(np.int64))
+        self.measurements += len(relay_rows)
+
+        sample_relays = np.repeat(relay_rows, counts)
+        sample_anchors = np.repeat(anchor_rows, counts)
+        sample_windows = np.repeat(window_rows, counts)
+        self.relay_histograms.add(sample_relays, ttlbs)
+        self.anchor_histograms.add(sample_anchors, ttlbs)
+        self.window_histograms.add(sample_windows, ttlbs)
+
+        relays, anchors, windows = len(self.relays), len(self.anchors), len(self.windows)
+        self.relay_file_size = growRows(self.relay_file_size, relays)
+        self.relay_file_size[:relays] += np.bincount(sample_relays, weights=np.repeat(file_sizes, counts),
+                                                     minlength=relays)
+
+        self.relay_seen = growRows(self.relay_seen, relays)
+        first = np.full(relays, np.inf)
+        last = np.full(relays, -np.inf)
+        np.minimum.at(first, relay_rows, timestamps)
+        np.maximum.at(last, relay_rows, timestamps)
+        seen = self.relay_seen[:relays]
+        known = seen[:, 1] > 0
+        seen[:, 0] = np.where(known, np.minimum(seen[:, 0], first), first)
+        seen[:, 1] = np.maximum(seen[:, 1], last)
+
+        self.relay_anchor_logs = self._growGrid(self.relay_anchor_logs, relays, anchors)
+        self.relay_anchor_samples = self._growGrid(self.relay_anchor_samples, relays, anchors)
+        cells = sample_relays * self.relay_anchor_logs.shape[1] + sample_anchors
+        size = self.relay_anchor_logs.size
+        self.relay_anchor_logs += np.bincount(cells, weights=np.log(np.clip(ttlbs, MIN_TTLB, MAX_TTLB)),
+                                              minlength=size).reshape(self.relay_anchor_logs.shape)
+        self.relay_anchor_samples += np.bincount(cells, minlength=size).reshape(self.relay_anchor_samples.shape)
+
+        self.window_relays = self._growGrid(self.window_relays, windows, relays)
+        self.window_relays[window_rows, relay_rows] = True
+
+    def addStore(self, store_path):
+        """
+        Streams a measurement store in chunks of CHUNK_RECORDS records through read-only memory maps. Records past the
+        last complete one, or pointing past the last complete sample, are still being written and are skipped.
+        """
+        with open(store_path, 'rb') as file:
+            magic, version, record_size = MeasurementStore.HEADER.unpack(file.read(MeasurementStore.HEADER.size))
+        if (magic, version, record_size) != (MeasurementStore.MAGIC, MeasurementStore.VERSION,
+                                             MeasurementStore.RECORD.size):
+            raise ValueError(f"{store_path} is not a version {MeasurementStore.VERSION} measurement store, "
+                             f"open it with the collector once to upgrade it")
+
+        base_path = os.path.splitext(store_path)[0]
+        anchors = list()
+        if os.path.exists(base_path + '.idx'):
+            with open(base_path + '.idx') as index_file:
+                anchors = json.load(index_file)['anchors']
+
+        record_count = (os.path.getsize(store_path) - MeasurementStore.HEADER.size) // MeasurementStore.RECORD.size
+        sample_count = os.path.getsize(base_path + '.times') // MeasurementStore.SAMPLE.size
+        if not record_count or not sample_count:
+            return
+        records = np.memmap(store_path, recordDtype(), 'r', MeasurementStore.HEADER.size, (record_count,))
+        samples = np.memmap(base_path + '.times', '<f4', 'r', 0, (sample_count, 4))
+        anchor_names = np.array(anchors + ['unknown'])    # ids missing from the anchor table are unknown
+
+        for start in range(0, record_count, CHUNK_RECORDS):
+            chunk = records[start:start + CHUNK_RECORDS]
+            chunk = chunk[chunk['offset'] + chunk['count'] <= sample_count]
+            counts = chunk['count'].astype(np.int64)
+            starts = np.cumsum(counts) - counts
+            sample_numbers = np.repeat(chunk['offset'].astype(np.int64) - starts, counts) + np.arange(counts.sum())
+            anchor_ids = np.minimum(chunk['anchor'].astype(np.int64), len(anchors))
+            self.add(chunk['relay'], anchor_names[anchor_ids], chunk['timestamp'], chunk['file_size'], counts,
+                     samples[sample_numbers, 3], relay_key=lambda relay: bytes(relay).hex().upper())
+
+    def addJsonl(self, jsonl_path):
+        """
+        Streams a JSON lines measurements file, parsing CHUNK_LINES lines with a single json.loads call.
+        """
+        with open(jsonl_path) as file:
+            while True:
+                lines = [line for line in (file.readline() for _ in range(CHUNK_LINES)) if line.strip()]
+                if not lines:
+                    break
+                chunk = json.loads('[' + ','.join(lines) + ']')
+                times = [d['times'] for d in chunk]
+                self.add(np.array([d['relay'] for d in chunk]), np.array([d['anchor'] for d in chunk]),
+                         parseTimestamps([d['timestamp'] for d in chunk]),
+                         np.array([d['file_size_kb'] for d in chunk], dtype=np.float64),
+                         np.array([len(t) for t in times], dtype=np.int64),
+                         np.fromiter(chain.from_iterable(times), dtype=np.float64))
+
+    # Summaries
+    def relaySummaries(self):
+        samples = self.relay_histograms.totals()
+        percentiles = self.relay_histograms.quantiles(PERCENTILES)
+        median = percentiles[:, PERCENTILES.index(0.5)]
+        file_size = self.relay_file_size[:len(self.relays)] / np.maximum(samples, 1)
+        rows = []
+        for i, relay in enumerate(self.relays.names):
+            first_seen, last_seen = self.relay_seen[i]
+            rows.append([relay, int(samples[i])] + [round(p, 4) for p in percentiles[i]] +
+                        [round(file_size[i] / median[i], 2), self._isoTime(first_seen), self._isoTime(last_seen)])
+        return ['relay', 'samples'] + percentileNames() + ['throughput_kBps', 'first_seen', 'last_seen'], rows
+
+    def windowTrends(self):
+        samples = self.window_histograms.totals()
+        percentiles = self.window_histograms.quantiles(PERCENTILES)
+        relays = self.window_relays[:len(self.windows)].sum(axis=1)
+        rows = []
+        for i in np.argsort(self.windows.names):
+            rows.append([self._isoTime(self.windows.names[i] * self.window_seconds), int(samples[i]), int(relays[i])] +
+                        [round(p, 4) for p in percentiles[i]])
+        return ['window_start', 'samples', 'relays'] + percentileNames(), rows
+
+    def anchorComparison(self):
+        """
+        Compares every anchor to the most used one by the geometric mean of their TTLB ratios over the relays
+        measured through both, which cancels out differences between the relays each anchor happened to measure.
+        """
+        samples = self.anchor_histograms.totals()
+        percentiles = self.anchor_histograms.quantiles(PERCENTILES)
+        counts = self.relay_anchor_samples[:len(self.relays), :len(self.anchors)]
+        logs = self.relay_anchor_logs[:len(self.relays), :len(self.anchors)]
+        mean_logs = np.where(counts > 0, logs / np.maximum(counts, 1), np.nan)
+        reference = int(np.argmax(samples)) if len(samples) else 0
+
+        rows = []
+        for i, anchor in enumerate(self.anchors.names):
+            shared = (counts[:, i] > 0) & (counts[:, reference] > 0)
+            ratio = math.exp(np.mean(mean_logs[shared, i] - mean_logs[shared, reference])) if shared.any() else None
+            rows.append([anchor, int(samples[i]), int((counts[:, i] > 0).sum())] + [round(p, 4) for p in percentiles[i]]
+                        + [int(shared.sum()), round(ratio, 4) if ratio is not None else ''])
+        return ['anchor', 'samples', 'relays'] + percentileNames() + ['shared_relays', 'ratio_to_reference'], rows
+
+    def scores(self, quantile=0.5):
+        values = self.relay_histograms.quantiles([quantile])[:, 0]
+        return {relay: float(value) for relay, value in zip(self.relays.names, values) if not np.isnan(value)}
+
+    def write(self, output_dir, quantile=0.5):
+        os.makedirs(output_dir, exist_ok=True)
+        for name, (header, rows) in (('relays.csv', self.relaySummaries()), ('windows.csv', self.windowTrends()),
+                                     ('anchors.csv', self.anchorComparison())):
+            with open(os.path.join(output_dir, name), 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(header)
+                writer.writerows(rows)
+        with open(os.path.join(output_dir, 'scores.json'), 'w') as file:
+            json.dump(self.scores(quantile), file)
+
+    @staticmethod
+    def _growGrid(array, rows, columns):
+        if rows <= array.shape[0] and columns <= array.shape[1]:
+            return array
+        grown = np.zeros((max(rows, 2 * array.shape[0]), max(columns, array.shape[1])), dtype=array.dtype)
+        grown[:array.shape[0], :array.shape[1]] = array
+        return grown
+
+    @staticmethod
+    def _isoTime(timestamp):
+        if not np.isfinite(timestamp):
+            return ''
+        return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# MAIN
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Summarise collected measurements")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--store', default=None, help=f"binary measurement store (default: {STORE_FILE})")
+    source.add_argument('--jsonl', default=None, help="JSON lines measurements file")
+    parser.add_argument('--out', default=OUTPUT_DIR, help="output directory")
+    parser.add_argument('--window-hours', type=float, default=DEFAULT_WINDOW_HOURS, help="length of a time window")
+    parser.add_argument('--quantile', type=float, default=0.5, help="TTLB quantile exported as the relay score")
+    args = parser.parse_args(argv)
+
+    if np is None:
+        print("ERROR: The analytics need numpy")
+        return 1
+
+    analytics = Analytics(args.window_hours)
+    if args.jsonl:
+        analytics.addJsonl(args.jsonl)
+    else:
+        analytics.addStore(args.store or STORE_FILE)
+    analytics.write(args.out, args.quantile)
+    print(f"{analytics.measurements} measurements of {len(analytics.relays)} relays through {len(analytics.anchors)} "
+          f"anchors summarised into {args.out}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
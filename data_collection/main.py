@@ -5,22 +5,43 @@ This script will start collecting bandwidth data from all Tor relays.
     a JSON database
 
 -   configuration:
-    -   anchor relay
+    -   anchor relay, or a list of anchors that every relay is measured through in turn
     -   target file URL
     -   file's size
+
+-   usage: python main.py [-v | --import measurements.json | --merge collector_dir ...] from this directory, or the
+    same arguments to python -m data_collection.main from the repository root
 """
 
 # IMPORTS
 
+import os
 import sys
 import json
+import math
+import heapq
+import mmap
+import struct
 import datetime
 import time
-from threading import Timer
+import socket
+import asyncio
+import statistics
+import queue
+import urllib.parse
+from threading import Timer, Thread, Lock, Condition, Event
+from functools import partial
 import hashlib
-from io import BytesIO
+import stem
 import stem.control
-from collections import defaultdict
+from collections import defaultdict, deque
+
+# The fastor package sits next to this directory, so that the collector also runs as 'python main.py' from here
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY_ROOT not in sys.path:
+    sys.path.append(REPOSITORY_ROOT)
+
+from fastor.consensus import ConsensusCache
 
 try:
     import pycurl
@@ -34,17 +55,77 @@ except ImportError:
 CONFIG_FILE = "config.json"
 STATE_FILE = "state.json"
 DATABASE_FILE = "measurements.json"
+STORE_FILE = "measurements.bin"
+AGGREGATES_FILE = "aggregates.json"
+FAILURES_FILE = "failures.json"
+CONSENSUS_FILE = "consensus.json"
 LOGS_FILE = "logs.txt"
 DATA_UPDATE_TIMER_SECONDS = 10
 
 SOCKS_PORT = 9050
+CONTROL_PORT = 9051
 CONNECTION_TIMEOUT = 15  # timeout before we give up on a circuit
+FETCH_TIMEOUT = 120  # seconds a whole fetch may take, connecting included, before it is abandoned
+TIMEOUT_QUANTILE = 0.8  # quantile of the fitted latency distribution used as an adaptive timeout
+TIMEOUT_WINDOW = 1000  # latencies an adaptive timeout is fitted to
+TIMEOUT_MIN_SAMPLES = 100  # completed latencies needed before an adaptive timeout replaces CONNECTION_TIMEOUT
+TIMEOUT_REFIT_SAMPLES = 20  # latencies recorded between refits of an adaptive timeout
+MIN_ADAPTIVE_TIMEOUT = 1.5  # bounds of an adaptive timeout in seconds
+MAX_ADAPTIVE_TIMEOUT = 60
+RELAY_TIMEOUT_SAMPLES = 8  # recent latencies kept per relay
+RELAY_TIMEOUT_MARGIN = 1.5  # factor over a relay's slowest recent latency granted to relays slower than the fit
+DEFAULT_CONCURRENCY = 1  # number of circuits measured in parallel
+DEFAULT_BACKEND = "threads"  # "threads" (pycurl) or "asyncio"
+CURL_SELECT_TIMEOUT = 0.05  # seconds the curl multi loop waits for socket activity
+DEFAULT_CONTENT_MARKER = "van"  # string every response body of the target file has to contain
+PROGRESS_SAMPLE_BYTES = 64 * 1024  # initial spacing of the (bytes, time) progress samples of a fetch
+PROGRESS_MAX_SAMPLES = 64  # progress samples kept per fetch, their spacing doubles when exceeded
+RESPONSE_CHUNK_SIZE = 64 * 1024  # bytes read at once from a streamed response
+DEFAULT_PREBUILD_CIRCUITS = 2  # circuits built ahead for the next relays in the queue, 0 disables prebuilding
+IMPORT_BATCH_RECORDS = 10000  # measurements appended to the store at once by an import
+AGGREGATES_SAVE_SECONDS = 300  # interval between saves of the per-relay aggregates
+COMPACTION_INTERVAL_SECONDS = 3600  # interval between retention passes over the store
+JOURNAL_CHECKPOINT_ENTRIES = 5000  # state journal entries written between checkpoints of the state file
+WRITER_QUEUE_SIZE = 10000  # items a background writer holds before producers block on it
+WRITER_COMMIT_SECONDS = 1.0  # longest a queued item waits before its group is committed
+DEFAULT_FSYNC_POLICY = "interval"  # "always" (every group), "interval" (every FSYNC_INTERVAL_SECONDS) or "never"
+FSYNC_INTERVAL_SECONDS = 10  # interval between fsyncs of the measurement files under the "interval" policy
+DEFAULT_SCHEDULER = "sweep"  # "sweep" (consensus order) or "priority" (RelayScheduler)
+DEFAULT_PRIORITY_WEIGHTS = {'staleness': 1.0, 'variance': 0.5, 'weight': 0.3, 'new': 1.0}
+STALENESS_HORIZON_SECONDS = 86400  # age at which a relay's last sample counts as fully stale
+SCHEDULER_REBUILD_FRACTION = 0.05  # fraction of the consensus popped between full priority recomputations
+FAILURE_BACKOFF_SECONDS = {'circuit': 3600, 'timeout': 1800, 'connection': 1800, 'content': 21600, 'other': 900}
+MAX_FAILURE_BACKOFF_SECONDS = 7 * 86400  # cap of the exponential backoff of a failing relay
+FAILURE_RESET_SECONDS = 7 * 86400  # time after its backoff ends that a relay's failures are forgotten
+CONCURRENCY_DECREASE_FACTOR = 0.5  # multiplicative cut of the adaptive concurrency when measurements degrade
+CONCURRENCY_THROUGHPUT_GAIN = 0.05  # relative throughput gain a widening of the adaptive concurrency has to bring
+CUTOFF_REFRESH_SECONDS = 300  # interval between recomputations of the adaptive sampling score cutoff
+SKETCH_RELATIVE_ACCURACY = 0.01  # relative error of quantiles estimated by QuantileSketch
+HUBER_K = 3.0  # residuals beyond this many robust standard deviations are down-weighted by PathDecomposition
+DECOMPOSITION_SCALE_RATE = 0.01  # smoothing of the running residual scale of PathDecomposition
+DECOMPOSITION_SWEEPS = 2  # Gauss-Seidel sweeps of PathDecomposition per database update
+DECOMPOSITION_REPLAY_SWEEPS = 50  # sweeps after replaying stored measurements, which starts from a cold fit
+
+TIMESTAMP_FORMAT = "%Y-%m-%d T %H:%M:%S.%f"
+PHASES = ('connect', 'pretransfer', 'starttransfer', 'total')  # cumulative timings recorded for every fetch
 
 
 # UTILS
 
 def getTimestamp():
-    return datetime.datetime.now().strftime("%Y-%m-%d T %H:%M:%S.%f")
+    return datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+
+
+def parseTimestamp(timestamp):
+    return datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp()
+
+
+def shardOf(fingerprint, shard_count):
+    """
+    Returns the shard a relay belongs to. The fingerprint space is split into shard_count equal ranges of its leading
+    32 bits, so collectors configured with the same count agree on the partition without talking to each other.
+    """
+    return (int(fingerprint[:8], 16) * shard_count) >> 32
 
 
 # CLASSES
@@ -76,6 +157,101 @@ class RepeatedTimer:
         self.is_running = False
 
 
+class GroupCommitWriter:
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, commit, sync=None, fsync_policy=DEFAULT_FSYNC_POLICY, max_pending=WRITER_QUEUE_SIZE,
+                 commit_seconds=WRITER_COMMIT_SECONDS, name="GroupCommitWriter"):
+        """
+        Commits queued items in groups on a dedicated thread. commit(items) is called with everything queued since the
+        last group, at most commit_seconds after the first of them was queued, and sync() follows it according to the
+        fsync policy: "always" after every group, "interval" at most every FSYNC_INTERVAL_SECONDS, "never" leaves it
+        to the OS. The queue is bounded, so put blocks producers while the disk falls behind instead of growing memory.
+        Everything put before stop() is committed before it returns, and items put after it are rejected.
+        """
+        self.commit = commit
+        self.sync = sync
+        self.fsync_policy = fsync_policy
+        self.commit_seconds = commit_seconds
+        self.name = name
+        self.queue = queue.Queue(max_pending)
+
+        self._thread = None
+        self._lock = Lock()
+        self._stopped = False
+        self._lastSync = time.monotonic()
+
+    def put(self, item):
+        """
+        Queues item for the next group, starting the writer thread on first use.
+
+        :return: False if the writer was stopped and the item is dropped
+        """
+        with self._lock:
+            if self._stopped:
+                print(f"ERROR: {self.name} is stopped, dropping an item put after it")
+                return False
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+            self.queue.put(item)
+            return True
+
+    def flush(self):
+        """
+        Blocks until everything queued so far has been committed.
+        """
+        if self._thread is not None:
+            self.queue.put(self._FLUSH)
+            self.queue.join()
+
+    def stop(self):
+        """
+        Commits everything queued so far and stops the writer thread. Items are only queued holding the lock, so none
+        can follow the stop marker.
+        """
+        with self._lock:
+            self._stopped = True
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self.queue.put(self._STOP)
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        running = True
+        while running:
+            items = [self.queue.get()]
+            deadline = time.monotonic() + self.commit_seconds
+            while items[-1] is not self._FLUSH and items[-1] is not self._STOP:
+                try:
+                    items.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            running = items[-1] is not self._STOP
+
+            batch = [item for item in items if item is not self._FLUSH and item is not self._STOP]
+            try:
+                if batch:
+                    self.commit(batch)
+                self._syncIfDue(force=not running)
+            except Exception as ex:
+                print(f"ERROR: {self.name} could not commit {len(batch)} items. Details below:")
+                print(str(ex))
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def _syncIfDue(self, force=False):
+        if self.sync is None or self.fsync_policy == "never":
+            return
+        now = time.monotonic()
+        if force or self.fsync_policy == "always" or now - self._lastSync >= FSYNC_INTERVAL_SECONDS:
+            self.sync()
+            self._lastSync = now
+
+
 class CustomConfig(dict):
     def __repr__(self):
         s = ""
@@ -97,7 +273,7 @@ class CustomLogger:
     def __init__(self, path, print_logs=False):
         self.path = path
         self.print_logs = print_logs
-        self.cache = list()
+        self.writer = GroupCommitWriter(self._write, fsync_policy="never", name="CustomLogger")
 
     def __call__(self, *args, **kwargs):
         self.add(*args, **kwargs)
@@ -105,33 +281,36 @@ class CustomLogger:
     def add(self, msg):
         timestamp = getTimestamp()
         log = f"[{timestamp}] {msg}\n"
-        self.cache.append(log)
+        self.writer.put(log)
 
         if self.print_logs:
             print(log, end="")
 
     def dump(self):
-        if not self.cache:
-            return
+        self.writer.flush()
+
+    def _write(self, logs):
         try:
             with open(self.path, "a") as log_file:
-                for log in self.cache:
-                    log_file.write(log)
-            self.cache.clear()
+                log_file.write(''.join(logs))
         except Exception as ex:
             print(f"ERROR: There was a Logger error when trying to dump logs to {self.path}. Details below:")
             print(str(ex))
 
 
 class Measurement:
-    def __init__(self, timestamp, relay, times, config):
+    def __init__(self, timestamp, relay, times, config, phases=None, build_time=None, progress=None, anchor=None):
         self.timestamp = timestamp
         self.relay = relay
         self.times = times
         self.config = config
+        self.anchor = anchor if anchor is not None else config.get('anchor', '')     # second hop of the path
+        self.phases = phases            # per fetch timings, one value for each name in PHASES
+        self.build_time = build_time    # seconds taken to build the circuit
+        self.progress = progress        # per fetch (bytes received, seconds since the request) samples
 
     def asDict(self):
-        anchor = self.config.get('anchor', '')
+        anchor = self.anchor
         file_size = self.config.get('target_file_size_kb', 1)
         d = {'timestamp': self.timestamp,
              'anchor': anchor,
@@ -139,34 +318,1031 @@ class Measurement:
              'relay': self.relay,
              'times': self.times
              }
+        if self.build_time is not None:
+            d['build_time'] = self.build_time
+        if self.phases:
+            d['phases'] = {name: [timings[i] for timings in self.phases] for i, name in enumerate(PHASES)}
+        if self.progress:
+            d['progress'] = [[list(sample) for sample in samples] for samples in self.progress]
         return d
 
+    @staticmethod
+    def fromDict(d):
+        config = {'anchor': d['anchor'], 'target_file_size_kb': d['file_size_kb']}
+        phases = None
+        if 'phases' in d:
+            phases = list(zip(*(d['phases'][name] for name in PHASES)))
+        progress = None
+        if 'progress' in d:
+            progress = [[tuple(sample) for sample in samples] for samples in d['progress']]
+        return Measurement(d['timestamp'], d['relay'], d['times'], config, phases, d.get('build_time'), progress)
+
+
+class MeasurementStore:
+    """
+    Append-only binary measurement store.
+
+    -   <name>.bin holds a header followed by one fixed-width record per measurement: relay fingerprint (20 bytes),
+        epoch timestamp, offset and count of its samples, anchor id, file size and circuit build time
+    -   <name>.times holds the samples of all measurements, each as float32 connect, pretransfer, starttransfer and
+        total times. Phases that were not recorded are NaN
+    -   <name>.idx is a sidecar JSON file with the anchor table, only rewritten when a new anchor appears
+    -   <name>.ridx is the append-only relay index: one (relay fingerprint, record number) entry per record, appended
+        after the records it indexes. It is loaded into a fingerprint: record numbers map when the store is opened,
+        and records appended after its last entry are re-indexed from the .bin file. Compactions rewrite it
+
+    Both data files are memory-mapped for reading, so a relay lookup only touches that relay's records. Version 1
+    stores, which only held total times, are upgraded when opened.
+    """
+    MAGIC = b'FMST'
+    VERSION = 2
+    HEADER = struct.Struct('<4sHH')         # magic, version, record size
+    RECORD = struct.Struct('<20sdQHHIf')    # relay, timestamp, first sample, sample count, anchor id, file size, build
+    SAMPLE = struct.Struct('<4f')           # connect, pretransfer, starttransfer, total
+    INDEX_ENTRY = struct.Struct('<20sQ')    # relay, record number
+    RECORD_V1 = struct.Struct('<20sdQHHI')
+    SAMPLE_V1 = struct.Struct('<f')
+
+    def __init__(self, path, logger):
+        base_path = os.path.splitext(path)[0]
+        self.path = path
+        self.samples_path = base_path + '.times'
+        self.index_path = base_path + '.idx'
+        self.relay_index_path = base_path + '.ridx'
+        self.logger = logger
 
-class Database:
-    def __init__(self, measurements_file, state_file, logger):
-        self.measurements_file = measurements_file
+        self.anchors = list()
+        self.index = defaultdict(list)  # relay fingerprint: record numbers
+
+        self._records_file = None
+        self._samples_file = None
+        self._relay_index_file = None
+        self._record_count = 0
+        self._sample_count = 0
+        self._maps = dict()             # path: (mapped size, mmap)
+        self._lock = Lock()
+
+    def __len__(self):
+        return self._record_count
+
+    # Public methods
+    def open(self):
+        self._records_file = open(self.path, 'a+b')
+        self._samples_file = open(self.samples_path, 'a+b')
+        self._relay_index_file = open(self.relay_index_path, 'a+b')
+
+        if self._records_file.tell() == 0:
+            self._records_file.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.RECORD.size))
+            self._records_file.flush()
+        else:
+            self._records_file.seek(0)
+            magic, version, record_size = self.HEADER.unpack(self._records_file.read(self.HEADER.size))
+            if magic == self.MAGIC and version == 1 and record_size == self.RECORD_V1.size:
+                self._upgradeFromVersion1()
+            elif magic != self.MAGIC or version != self.VERSION or record_size != self.RECORD.size:
+                raise ValueError(f"{self.path} is not a version {self.VERSION} measurement store")
+
+        self._recoverTornWrites()
+        self._loadIndex()
+        self.logger(f"MeasurementStore INFO: Opened {self.path} with {self._record_count} measurements of "
+                    f"{len(self.index)} relays")
+
+    def close(self):
+        with self._lock:
+            for _, view in self._maps.values():
+                view.close()
+            self._maps.clear()
+            self._records_file.close()
+            self._samples_file.close()
+            self._relay_index_file.close()
+
+    def append(self, measurements):
+        """
+        Appends the measurements to the store. Samples are written before the records that point to them, so a crash
+        can only leave unreferenced samples behind, which are dropped on the next open.
+        """
+        if not measurements:
+            return
+
+        with self._lock:
+            records = bytearray()
+            samples = bytearray()
+            sample_offset = self._sample_count
+            for measurement in measurements:
+                d = measurement.asDict()
+                times = d['times']
+                phases = measurement.phases or [(math.nan, math.nan, math.nan, t) for t in times]
+                build_time = measurement.build_time if measurement.build_time is not None else math.nan
+                anchor_id = self._anchorId(d['anchor'])
+                records += self.RECORD.pack(bytes.fromhex(d['relay']), parseTimestamp(d['timestamp']), sample_offset,
+                                            len(times), anchor_id, int(d['file_size_kb']), build_time)
+                for timings in phases:
+                    samples += self.SAMPLE.pack(*timings)
+                sample_offset += len(times)
+
+            self._samples_file.write(samples)
+            self._samples_file.flush()
+            self._records_file.write(records)
+            self._records_file.flush()
+
+            self._indexRecords(self._record_count, [measurement.relay for measurement in measurements])
+            self._record_count += len(measurements)
+            self._sample_count = sample_offset
+
+    def sync(self):
+        with self._lock:
+            os.fsync(self._samples_file.fileno())
+            os.fsync(self._records_file.fileno())
+
+    def relays(self):
+        return list(self.index.keys())
+
+    def relayMeasurements(self, fingerprint):
+        """
+        Returns all measurements of a relay as dictionaries in the Measurement.asDict() layout, with the timestamp
+        as seconds since the epoch and NaN for timings that were not recorded.
+        """
+        with self._lock:
+            record_numbers = list(self.index.get(fingerprint, ()))
+            if not record_numbers:
+                return []
+            records = self._view(self.path)
+            samples = self._view(self.samples_path)
+
+            measurements = []
+            for record_number in record_numbers:
+                _, timestamp, offset, count, anchor_id, file_size, build_time = \
+                    self.RECORD.unpack_from(records, self.HEADER.size + record_number * self.RECORD.size)
+                phases = self._unpackSamples(samples, offset, count)
+                measurements.append({'timestamp': timestamp,
+                                     'anchor': self.anchors[anchor_id] if anchor_id < len(self.anchors) else '',
+                                     'file_size_kb': file_size,
+                                     'relay': fingerprint,
+                                     'times': [timings[-1] for timings in phases],
+                                     'build_time': build_time,
+                                     'phases': {name: [timings[i] for timings in phases]
+                                                for i, name in enumerate(PHASES)}
+                                     })
+            return measurements
+
+    def iterRecords(self, start=0):
+        """
+        Yields (relay, timestamp, times, anchor) for every measurement from record number start onwards, in append
+        order. Records and their samples are copied out of the store IMPORT_BATCH_RECORDS at a time holding the lock,
+        as appends and compactions remap or close the memory maps.
+        """
+        record_number = start
+        while True:
+            with self._lock:
+                end = min(record_number + IMPORT_BATCH_RECORDS, self._record_count)
+                if record_number >= end:
+                    return
+                records = list(self.RECORD.iter_unpack(
+                    self._view(self.path)[self.HEADER.size + record_number * self.RECORD.size:
+                                          self.HEADER.size + end * self.RECORD.size]))
+                first_sample = min(record[2] for record in records)
+                end_sample = max(record[2] + record[3] for record in records)
+                samples = self._view(self.samples_path)[first_sample * self.SAMPLE.size:end_sample * self.SAMPLE.size]
+                anchors = list(self.anchors)
+            for relay, timestamp, offset, count, anchor_id, _, _ in records:
+                times = [timings[-1] for timings in self._unpackSamples(samples, offset - first_sample, count)]
+                anchor = anchors[anchor_id] if anchor_id < len(anchors) else ''
+                yield relay.hex().upper(), timestamp, times, anchor
+            record_number = end
+
+    def compact(self, min_timestamp=None, max_per_relay=None):
+        """
+        Rewrites the store without measurements older than min_timestamp and keeping at most the max_per_relay most
+        recent measurements of each relay.
+
+        :return: number of dropped measurements
+        """
+        with self._lock:
+            keep = set()
+            for record_numbers in self.index.values():
+                kept = record_numbers[-max_per_relay:] if max_per_relay else record_numbers
+                keep.update(kept)
+
+            records_path = self.path + '.compact'
+            samples_path = self.samples_path + '.compact'
+            kept_records = 0
+            with open(records_path, 'wb') as records_out, open(samples_path, 'wb') as samples_out:
+                records_out.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.RECORD.size))
+                sample_offset = 0
+                for record_number in range(self._record_count):
+                    relay, timestamp, offset, count, anchor_id, file_size, build_time = self._readRecord(record_number)
+                    if record_number not in keep or (min_timestamp and timestamp < min_timestamp):
+                        continue
+                    self._samples_file.seek(offset * self.SAMPLE.size)
+                    samples_out.write(self._samples_file.read(count * self.SAMPLE.size))
+                    records_out.write(self.RECORD.pack(relay, timestamp, sample_offset, count, anchor_id, file_size,
+                                                       build_time))
+                    sample_offset += count
+                    kept_records += 1
+
+            dropped = self._record_count - kept_records
+            self._replaceFiles(records_path, samples_path)
+            return dropped
+
+    def merge(self, other, start=0, end=None, known=None):
+        """
+        Appends the measurements of another open store that are not in this one yet. Measurements are identified by
+        relay and timestamp, so merging the same store twice, or stores that share history, adds no duplicates. Only
+        the records of relays present in the other store are read, through the index.
+
+        :param start: first record number of the other store to merge
+        :param end: record number of the other store to stop at, None for its end
+        :param known: relay fingerprint: timestamps of its measurements in this store, filled in as relays come up and
+                      kept up to date. Successive merges sharing it read each relay's records once
+        :return: number of merged measurements
+        """
+        known = dict() if known is None else known
+        with self._lock:
+            own_records = self._view(self.path)
+            records = bytearray()
+            samples = bytearray()
+            merged = list()
+            sample_offset = self._sample_count
+            other_records = other._view(other.path)
+            other_samples = other._view(other.samples_path)
+            for record_number in range(start, len(other) if end is None else min(end, len(other))):
+                relay, timestamp, offset, count, anchor_id, file_size, build_time = \
+                    self.RECORD.unpack_from(other_records, self.HEADER.size + record_number * self.RECORD.size)
+                fingerprint = relay.hex().upper()
+                timestamps = known.get(fingerprint)
+                if timestamps is None:
+                    timestamps = known[fingerprint] = {
+                        self.RECORD.unpack_from(own_records, self.HEADER.size + own * self.RECORD.size)[1]
+                        for own in self.index.get(fingerprint, ())}
+                if timestamp in timestamps:
+                    continue
+                timestamps.add(timestamp)
+                anchor = other.anchors[anchor_id] if anchor_id < len(other.anchors) else ''
+                records += self.RECORD.pack(relay, timestamp, sample_offset, count, self._anchorId(anchor), file_size,
+                                            build_time)
+                samples += other_samples[offset * self.SAMPLE.size:(offset + count) * self.SAMPLE.size]
+                merged.append(fingerprint)
+                sample_offset += count
+
+            self._samples_file.write(samples)
+            self._samples_file.flush()
+            self._records_file.write(records)
+            self._records_file.flush()
+
+            self._indexRecords(self._record_count, merged)
+            self._record_count += len(merged)
+            self._sample_count = sample_offset
+
+        self.logger(f"MeasurementStore INFO: Merged {len(merged)} new measurements from {other.path}")
+        return len(merged)
+
+    def importJsonl(self, jsonl_path, batch_size=IMPORT_BATCH_RECORDS):
+        """
+        One-time import of an existing JSON lines measurements file (as written by Database) into the store.
+
+        :return: number of imported measurements
+        """
+        imported = 0
+        batch = []
+        with open(jsonl_path) as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                batch.append(Measurement.fromDict(json.loads(line)))
+                if len(batch) >= batch_size:
+                    self.append(batch)
+                    imported += len(batch)
+                    batch = []
+        self.append(batch)
+        imported += len(batch)
+        self.logger(f"MeasurementStore INFO: Imported {imported} measurements from {jsonl_path}")
+        return imported
+
+    # Files
+    def _recoverTornWrites(self):
+        """
+        Drops partially written records and any samples not referenced by a complete record.
+        """
+        records_size = os.path.getsize(self.path) - self.HEADER.size
+        self._record_count = records_size // self.RECORD.size
+        if records_size % self.RECORD.size:
+            self._truncate(self._records_file, self.HEADER.size + self._record_count * self.RECORD.size)
+
+        samples_size = os.path.getsize(self.samples_path)
+        self._sample_count = samples_size // self.SAMPLE.size
+        while self._record_count:
+            _, _, offset, count, _, _, _ = self._readRecord(self._record_count - 1)
+            if offset + count <= self._sample_count:
+                self._sample_count = offset + count
+                break
+            self._record_count -= 1    # record written without all of its samples
+        else:
+            self._sample_count = 0
+
+        self._truncate(self._records_file, self.HEADER.size + self._record_count * self.RECORD.size)
+        self._truncate(self._samples_file, self._sample_count * self.SAMPLE.size)
+
+    def _upgradeFromVersion1(self):
+        """
+        Rewrites a version 1 store, which only held total times, in the current format.
+        """
+        self.logger(f"MeasurementStore INFO: Upgrading {self.path} from version 1")
+        try:
+            with open(self.index_path) as index_file:
+                self.anchors = json.load(index_file)['anchors']
+        except Exception:
+            pass
+        records_path = self.path + '.upgrade'
+        samples_path = self.samples_path + '.upgrade'
+        self._records_file.seek(self.HEADER.size)
+        self._samples_file.seek(0)
+        with open(records_path, 'wb') as records_out, open(samples_path, 'wb') as samples_out:
+            records_out.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.RECORD.size))
+            for record in self.RECORD_V1.iter_unpack(self._records_file.read()):
+                records_out.write(self.RECORD.pack(*record, math.nan))
+            for (total,) in self.SAMPLE_V1.iter_unpack(self._samples_file.read()):
+                samples_out.write(self.SAMPLE.pack(math.nan, math.nan, math.nan, total))
+        self._replaceFiles(records_path, samples_path)
+
+    def _replaceFiles(self, records_path, samples_path):
+        """
+        Swaps in rewritten data files, keeping the anchor table and rewriting the relay index from the new records.
+        """
+        for _, view in self._maps.values():
+            view.close()
+        self._maps.clear()
+        self._records_file.close()
+        self._samples_file.close()
+        os.replace(samples_path, self.samples_path)
+        os.replace(records_path, self.path)
+
+        self._records_file = open(self.path, 'a+b')
+        self._samples_file = open(self.samples_path, 'a+b')
+        self._recoverTornWrites()
+        self.index = defaultdict(list)
+        self._truncate(self._relay_index_file, 0)
+        self._buildIndex(0)
+
+    def _unpackSamples(self, samples, offset, count):
+        return [self.SAMPLE.unpack_from(samples, (offset + i) * self.SAMPLE.size) for i in range(count)]
+
+    def _readRecord(self, record_number):
+        self._records_file.seek(self.HEADER.size + record_number * self.RECORD.size)
+        return self.RECORD.unpack(self._records_file.read(self.RECORD.size))
+
+    @staticmethod
+    def _truncate(file, size):
+        file.flush()
+        if os.path.getsize(file.name) != size:
+            file.truncate(size)
+        file.seek(0, os.SEEK_END)
+
+    def _view(self, path):
+        """
+        Returns a read-only memory map of path, remapping it if the file has grown since it was last mapped.
+        """
+        size = os.path.getsize(path)
+        mapped_size, view = self._maps.get(path, (0, None))
+        if size != mapped_size:
+            if view is not None:
+                view.close()
+            with open(path, 'rb') as file:
+                view = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            self._maps[path] = (size, view)
+        return view
+
+    # Index
+    def _anchorId(self, anchor):
+        if anchor not in self.anchors:
+            self.anchors.append(anchor)
+            self._saveAnchors()     # anchors must be persisted before any record refers to them
+        return self.anchors.index(anchor)
+
+    def _loadIndex(self):
+        self.anchors = list()
+        try:
+            with open(self.index_path) as index_file:
+                self.anchors = json.load(index_file)['anchors']
+        except FileNotFoundError:
+            pass
+        except Exception as ex:
+            self.logger(f"MeasurementStore ERROR: Could not read the anchors in {self.index_path}. {ex}")
+
+        # Load the relay index up to its first entry that is torn, out of order or past the last record
+        self.index = defaultdict(list)
+        self._relay_index_file.seek(0)
+        data = self._relay_index_file.read()
+        indexed = 0
+        for relay, record_number in self.INDEX_ENTRY.iter_unpack(memoryview(data)[:len(data) - len(data) %
+                                                                                     self.INDEX_ENTRY.size]):
+            if record_number != indexed or record_number >= self._record_count:
+                break
+            self.index[relay.hex().upper()].append(record_number)
+            indexed += 1
+        self._truncate(self._relay_index_file, indexed * self.INDEX_ENTRY.size)
+        self._buildIndex(indexed)
+
+    def _buildIndex(self, start):
+        """
+        Indexes the records from record number start onwards in a single pass over the memory-mapped records, a chunk
+        at a time, and appends them to the relay index file.
+        """
+        if start >= self._record_count:
+            return
+        self.logger(f"MeasurementStore INFO: Indexing {self._record_count - start} measurements of {self.path}")
+        records = self._view(self.path)
+        for chunk_start in range(start, self._record_count, IMPORT_BATCH_RECORDS):
+            chunk_end = min(chunk_start + IMPORT_BATCH_RECORDS, self._record_count)
+            chunk = records[self.HEADER.size + chunk_start * self.RECORD.size:
+                            self.HEADER.size + chunk_end * self.RECORD.size]
+            self._indexRecords(chunk_start, [record[0].hex().upper() for record in self.RECORD.iter_unpack(chunk)])
+
+    def _indexRecords(self, first_record, relays):
+        """
+        Indexes the consecutive records of relays starting at record number first_record, the first one not indexed
+        yet, and appends their entries to the relay index file.
+        """
+        entries = bytearray()
+        for record_number, relay in enumerate(relays, first_record):
+            self.index[relay].append(record_number)
+            entries += self.INDEX_ENTRY.pack(bytes.fromhex(relay), record_number)
+        self._relay_index_file.write(entries)
+        self._relay_index_file.flush()
+
+    def _saveAnchors(self):
+        temp_path = self.index_path + '.tmp'
+        try:
+            with open(temp_path, 'w') as index_file:
+                json.dump({'anchors': self.anchors}, index_file)
+            os.replace(temp_path, self.index_path)
+        except Exception as ex:
+            self.logger(f"MeasurementStore ERROR: Could not save to {self.index_path}")
+            self.logger(str(ex))
+
+
+class QuantileSketch:
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        """
+        Log-bucketed quantile sketch. Values are counted in buckets whose bounds grow geometrically, so every
+        quantile is estimated within relative_accuracy, sketches merge by adding bucket weights and weights can be
+        decayed in place.
+        """
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = defaultdict(float)   # bucket key: weight
+        self.zero_weight = 0.0              # weight of values too small for a bucket
+
+    @property
+    def weight(self):
+        return self.zero_weight + sum(self.buckets.values())
+
+    def add(self, value, weight=1.0):
+        if value <= 1e-9:
+            self.zero_weight += weight
+        else:
+            self.buckets[math.ceil(math.log(value) / self._log_gamma)] += weight
+
+    def merge(self, other):
+        for key, weight in other.buckets.items():
+            self.buckets[key] += weight
+        self.zero_weight += other.zero_weight
+
+    def decay(self, factor):
+        self.zero_weight *= factor
+        for key in list(self.buckets.keys()):
+            self.buckets[key] *= factor
+            if self.buckets[key] < 1e-6:
+                del self.buckets[key]
+
+    def quantile(self, q):
+        total = self.weight
+        if total <= 0:
+            return None
+        rank = q * total
+        cumulative = self.zero_weight
+        if cumulative >= rank:
+            return 0.0
+        for key in sorted(self.buckets.keys()):
+            cumulative += self.buckets[key]
+            if cumulative >= rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets.keys()) / (self.gamma + 1)
+
+    def asDict(self):
+        return {'accuracy': self.relative_accuracy, 'zero': self.zero_weight,
+                'buckets': [[key, weight] for key, weight in self.buckets.items()]}
+
+    @staticmethod
+    def fromDict(d):
+        sketch = QuantileSketch(d['accuracy'])
+        sketch.zero_weight = d['zero']
+        for key, weight in d['buckets']:
+            sketch.buckets[key] = weight
+        return sketch
+
+
+class RelayStats:
+    def __init__(self):
+        """
+        Rolling aggregates of one relay's TTLB samples: weighted count, mean and variance (Welford) and a quantile
+        sketch. With a half life set, older samples are exponentially down-weighted as new ones arrive.
+        """
+        self.samples = 0        # raw samples seen, never decayed
+        self.count = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.last_timestamp = None
+        self.sketch = QuantileSketch()
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count > 0 else 0.0
+
+    def add(self, times, timestamp, half_life=None):
+        self.decay(timestamp, half_life)
+        for value in times:
+            self.samples += 1
+            self.count += 1
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (value - self.mean)
+            self.sketch.add(value)
+
+    def decay(self, timestamp, half_life=None):
+        if half_life and self.last_timestamp is not None and timestamp > self.last_timestamp:
+            factor = 0.5 ** ((timestamp - self.last_timestamp) / half_life)
+            self.count *= factor
+            self.m2 *= factor
+            self.sketch.decay(factor)
+        if self.last_timestamp is None or timestamp > self.last_timestamp:
+            self.last_timestamp = timestamp
+
+    def merge(self, other, half_life=None):
+        """
+        Combines the aggregates of another RelayStats, e.g. one kept by a different collector, into this one. With a
+        half life set, both are first decayed to the later of their last timestamps.
+        """
+        if self.last_timestamp is not None and other.last_timestamp is not None:
+            latest = max(self.last_timestamp, other.last_timestamp)
+            self.decay(latest, half_life)
+            other.decay(latest, half_life)
+        count = self.count + other.count
+        if count > 0:
+            delta = other.mean - self.mean
+            self.m2 += other.m2 + delta * delta * self.count * other.count / count
+            self.mean += delta * other.count / count
+        self.count = count
+        self.samples += other.samples
+        self.sketch.merge(other.sketch)
+        if other.last_timestamp is not None:
+            self.last_timestamp = max(self.last_timestamp or other.last_timestamp, other.last_timestamp)
+
+    def summary(self):
+        return {'samples': self.samples,
+                'mean': self.mean,
+                'variance': self.variance,
+                'p50': self.sketch.quantile(0.5),
+                'p90': self.sketch.quantile(0.9),
+                'p99': self.sketch.quantile(0.99),
+                'last': self.last_timestamp
+                }
+
+    def asDict(self):
+        return {'samples': self.samples, 'count': self.count, 'mean': self.mean, 'm2': self.m2,
+                'last': self.last_timestamp, 'sketch': self.sketch.asDict()}
+
+    @staticmethod
+    def fromDict(d):
+        stats = RelayStats()
+        stats.samples = d['samples']
+        stats.count = d['count']
+        stats.mean = d['mean']
+        stats.m2 = d['m2']
+        stats.last_timestamp = d['last']
+        stats.sketch = QuantileSketch.fromDict(d['sketch'])
+        return stats
+
+
+class PathDecomposition:
+    def __init__(self, huber_k=HUBER_K):
+        """
+        Incremental decomposition of [relay, anchor] path times into a relay and an anchor component,
+
+            time(relay, anchor) = relay component + anchor component
+
+        fitted by least squares over every sample. Least squares only depends on the weight and weighted sum of the
+        samples of each (relay, anchor) pair, so samples are folded in as they arrive and solve() refines the last
+        solution with Gauss-Seidel sweeps over the pairs. For robustness, samples further than huber_k robust standard
+        deviations from the current fit are down-weighted on arrival (Huber). Anchor components are centered on their
+        weighted mean, so a relay component is the time of a path through an average anchor.
+        """
+        self.huber_k = huber_k
+        self.relays = dict()            # relay fingerprint: component
+        self.anchors = dict()           # anchor fingerprint: component
+        self.scale = None               # running robust scale of the residuals
+        self._by_relay = defaultdict(dict)     # relay fingerprint: {anchor fingerprint: [weight, weighted sum]}
+        self._by_anchor = defaultdict(dict)    # anchor fingerprint: {relay fingerprint: the same cell}
+
+    def add(self, relay, anchor, times):
+        cell = self._by_relay[relay].get(anchor)
+        if cell is None:
+            cell = self._by_relay[relay][anchor] = self._by_anchor[anchor][relay] = [0.0, 0.0]
+
+        # Residuals are taken from the current fit, or from the median of the samples for a new pair
+        predicted = self.predict(relay, anchor)
+        if predicted is None:
+            predicted = statistics.median(times)
+        for t in times:
+            weight = 1.0
+            residual = abs(t - predicted)
+            if self.scale:
+                threshold = self.huber_k * self.scale
+                if residual > threshold:
+                    weight = threshold / residual
+                # 1.25 * mean absolute deviation estimates the standard deviation of normal residuals. Clipping
+                # the residual keeps outliers from inflating the scale
+                residual = min(residual, threshold)
+                self.scale += DECOMPOSITION_SCALE_RATE * (1.25 * residual - self.scale)
+            elif residual > 0:
+                self.scale = 1.25 * residual
+            cell[0] += weight
+            cell[1] += weight * t
+
+    def predict(self, relay, anchor=None):
+        """
+        Predicted time of the [relay, anchor] path, or through an average anchor when anchor is None.
+        """
+        if relay not in self.relays or (anchor is not None and anchor not in self.anchors):
+            return None
+        return self.relays[relay] + (self.anchors[anchor] if anchor is not None else 0.0)
+
+    def solve(self, sweeps=DECOMPOSITION_SWEEPS):
+        for _ in range(sweeps):
+            for relay, cells in self._by_relay.items():
+                weight = sum(cell[0] for cell in cells.values())
+                if weight > 0:
+                    self.relays[relay] = sum(cell[1] - cell[0] * self.anchors.get(anchor, 0.0)
+                                             for anchor, cell in cells.items()) / weight
+            for anchor, cells in self._by_anchor.items():
+                weight = sum(cell[0] for cell in cells.values())
+                if weight > 0:
+                    self.anchors[anchor] = sum(cell[1] - cell[0] * self.relays.get(relay, 0.0)
+                                               for relay, cell in cells.items()) / weight
+
+        # Fix the free offset between the two sets of components
+        weights = {anchor: sum(cell[0] for cell in cells.values()) for anchor, cells in self._by_anchor.items()}
+        total = sum(weights.values())
+        if total > 0:
+            offset = sum(weights[anchor] * self.anchors.get(anchor, 0.0) for anchor in weights) / total
+            self.anchors = {anchor: component - offset for anchor, component in self.anchors.items()}
+            self.relays = {relay: component + offset for relay, component in self.relays.items()}
+
+    def asDict(self):
+        return {'scale': self.scale, 'relays': self.relays, 'anchors': self.anchors,
+                'cells': [[relay, anchor, cell[0], cell[1]] for relay, cells in self._by_relay.items()
+                          for anchor, cell in cells.items()]}
+
+    @staticmethod
+    def fromDict(d):
+        decomposition = PathDecomposition()
+        decomposition.scale = d['scale']
+        decomposition.relays = dict(d['relays'])
+        decomposition.anchors = dict(d['anchors'])
+        for relay, anchor, weight, weighted_sum in d['cells']:
+            cell = [weight, weighted_sum]
+            decomposition._by_relay[relay][anchor] = decomposition._by_anchor[anchor][relay] = cell
+        return decomposition
+
+
+class StateJournal:
+    CLEAR = "CLEAR"     # journal entry emptying the skip set, written when a new sweep starts
+
+    def __init__(self, state_file, logger):
+        """
+        Persists the skip set as a checkpoint (state_file) plus an append-only journal of the entries added since.
+        Only new entries are written on sync; the journal is folded into the checkpoint every
+        JOURNAL_CHECKPOINT_ENTRIES entries. Replaying the whole journal over the checkpoint is idempotent, so a crash
+        at any point between the two leaves a consistent state.
+        """
         self.state_file = state_file
+        self.journal_file = os.path.splitext(state_file)[0] + '.journal'
         self.logger = logger
+        self.skip_set = set()
+        self._journal_entries = 0
 
-    def getSkipList(self):
-        state = self._retrieveState()
-        skip_list = state.get('skip', list())
+    def load(self):
+        self.skip_set = set()
+        try:
+            with open(self.state_file, 'r') as file:
+                self.skip_set.update(json.load(file).get('skip', list()))
+        except FileNotFoundError:
+            pass
+        except Exception as ex:
+            self.logger(f"StateJournal ERROR: Could not read {self.state_file}, {str(ex)}")
 
-        if not skip_list:
-            self.logger("Database INFO: The skip list was not found or is empty")
+        self._journal_entries = 0
+        try:
+            valid_size = 0
+            with open(self.journal_file, 'r+') as file:
+                for line in file:
+                    if not line.endswith('\n'):
+                        file.truncate(valid_size)   # drop a torn write of the last entry
+                        break
+                    self._apply(line.strip())
+                    self._journal_entries += 1
+                    valid_size += len(line)
+        except FileNotFoundError:
+            pass
+        return self.skip_set
+
+    def append(self, entries):
+        if not entries:
+            return
+        for entry in entries:
+            self._apply(entry)
+        try:
+            with open(self.journal_file, 'a') as file:
+                file.write(''.join(entry + '\n' for entry in entries))
+                file.flush()
+                os.fsync(file.fileno())
+            self._journal_entries += len(entries)
+        except Exception as ex:
+            self.logger(f"StateJournal ERROR: Could not save to {self.journal_file}")
+            self.logger(str(ex))
+
+        if self._journal_entries >= JOURNAL_CHECKPOINT_ENTRIES:
+            self.checkpoint()
+
+    def checkpoint(self):
+        temp_path = self.state_file + '.tmp'
+        try:
+            with open(temp_path, 'w') as file:
+                json.dump({'skip': list(self.skip_set)}, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.state_file)
+            open(self.journal_file, 'w').close()
+            self._journal_entries = 0
+        except Exception as ex:
+            self.logger(f"StateJournal ERROR: Could not checkpoint to {self.state_file}")
+            self.logger(str(ex))
+
+    def _apply(self, entry):
+        if entry == self.CLEAR:
+            self.skip_set.clear()
+        elif entry:
+            self.skip_set.add(entry)
 
-        return skip_list
 
-    def update(self, skip_list, new_measurements):
-        # Save state
-        state_dict = {'skip': skip_list}
+class FailureCache:
+    def __init__(self, failures_file, logger):
+        """
+        Persistent negative cache of relays whose measurements failed. Each failure is classified, and the relay is
+        backed off for FAILURE_BACKOFF_SECONDS[kind] doubled for every consecutive failure, up to
+        MAX_FAILURE_BACKOFF_SECONDS. A successful measurement or FAILURE_RESET_SECONDS without failures clears it.
+        """
+        self.failures_file = failures_file
+        self.logger = logger
+        self.failures = dict()  # relay fingerprint: {'kind', 'count', 'last', 'until'}
+        self._dirty = False
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.failures)
+
+    @staticmethod
+    def classify(error):
+        message = str(error).lower()
+        if isinstance(error, (asyncio.TimeoutError, socket.timeout)) or 'timed out' in message:
+            return 'timeout'
+        if isinstance(error, stem.CircuitExtensionFailed) or 'circuit' in message:
+            return 'circuit'
+        if isinstance(error, ValueError):
+            return 'content'
+        if isinstance(error, (ConnectionError, stem.ControllerError)):
+            return 'connection'
+        return 'other'
+
+    def recordFailure(self, fingerprint, error, now=None):
+        now = now or time.time()
+        kind = self.classify(error)
+        with self._lock:
+            entry = self.failures.get(fingerprint)
+            count = entry['count'] + 1 if entry else 1
+            backoff = min(FAILURE_BACKOFF_SECONDS[kind] * 2 ** (count - 1), MAX_FAILURE_BACKOFF_SECONDS)
+            self.failures[fingerprint] = {'kind': kind, 'count': count, 'last': now, 'until': now + backoff}
+            self._dirty = True
+        return kind, backoff
+
+    def recordSuccess(self, fingerprint):
+        with self._lock:
+            if self.failures.pop(fingerprint, None) is not None:
+                self._dirty = True
+
+    def isBackedOff(self, fingerprint, now=None):
+        entry = self.failures.get(fingerprint)
+        return entry is not None and (now or time.time()) < entry['until']
+
+    def load(self):
         try:
-            with open(self.state_file, 'w') as file:
-                json.dump(state_dict, file)
+            with open(self.failures_file, 'r') as file:
+                self.failures = json.load(file)
+        except FileNotFoundError:
+            pass
         except Exception as ex:
-            self.logger(f"Database ERROR: Could not save to {self.state_file}")
+            self.logger(f"FailureCache ERROR: Could not read {self.failures_file}, {str(ex)}")
+        self._expire()
+
+    def save(self):
+        self._expire()
+        with self._lock:
+            if not self._dirty:
+                return
+            data = dict(self.failures)
+            self._dirty = False
+        temp_path = self.failures_file + '.tmp'
+        try:
+            with open(temp_path, 'w') as file:
+                json.dump(data, file)
+            os.replace(temp_path, self.failures_file)
+        except Exception as ex:
+            self.logger(f"FailureCache ERROR: Could not save to {self.failures_file}")
             self.logger(str(ex))
 
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [fp for fp, entry in self.failures.items() if now > entry['until'] + FAILURE_RESET_SECONDS]
+            for fingerprint in expired:
+                del self.failures[fingerprint]
+            self._dirty |= bool(expired)
+
+
+class Database:
+    def __init__(self, measurements_file, state_file, logger, store_file=None, aggregates_file=None,
+                 failures_file=None):
+        self.measurements_file = measurements_file
+        self.state_file = state_file
+        self.aggregates_file = aggregates_file
+        self.logger = logger
+        self.state_journal = StateJournal(state_file, logger)
+
+        self.half_life = None               # seconds, None disables time decay
+        self.retention = None               # seconds of raw samples kept in the store
+        self.retention_per_relay = None     # most recent measurements kept per relay in the store
+
+        self.store = None
+        if store_file:
+            self.store = MeasurementStore(store_file, logger)
+            self.store.open()
+
+        self.stats = defaultdict(RelayStats)    # relay fingerprint: RelayStats
+        self.stats_lock = Lock()                # held while the stats change, shared with the threads reading them
+        self.merged_collectors = set()          # aggregates files of other collectors merged into the stats
+        self.decomposition = PathDecomposition()
+        self.failures = FailureCache(failures_file, logger)
+        if failures_file:
+            self.failures.load()
+        self._lastAggregatesSave = time.time()
+        self._lastCompaction = time.time()
+        if aggregates_file:
+            self._loadAggregates()
+
+    def close(self):
+        self.state_journal.checkpoint()
+        self._saveAggregates()
+        if self.store is not None:
+            self.store.close()
+
+    def updateConfig(self, config):
+        half_life_hours = config.get('stats_half_life_hours', None)
+        retention_days = config.get('retention_days', None)
+        self.half_life = half_life_hours * 3600 if half_life_hours else None
+        self.retention = retention_days * 86400 if retention_days else None
+        self.retention_per_relay = config.get('retention_measurements_per_relay', None)
+
+    def sync(self):
+        """
+        Forces the measurements written so far to disk. The state journal is already synced on every append.
+        """
+        if self.store is not None:
+            self.store.sync()
+        elif os.path.exists(self.measurements_file):
+            with open(self.measurements_file, 'a') as file:
+                os.fsync(file.fileno())
+
+    def mergeCollector(self, store, aggregates_file=None, known=None):
+        """
+        Merges the measurements and aggregates of another collector into this database, which needs a store.
+
+        Samples the other collector's retention compacted out of its store only survive in its aggregates, so these
+        are merged with RelayStats.merge, and only its records past their watermark are replayed into the stats. The
+        records before it are still added to the store and to the path decomposition, which is refit from the raw
+        records. The aggregates are only merged if none of the records they cover were in this store already, e.g.
+        from shared history or an earlier merge of the same collector, as those are in the stats already. Otherwise
+        only the records new to this store are replayed.
+
+        :param store: open store of the other collector
+        :param aggregates_file: aggregates of the other collector, None if it kept none for this store
+        :param known: see MeasurementStore.merge, shared by the merges of one run
+        :return: number of merged measurements
+        """
+        stats = None
+        watermark = 0
+        collector = os.path.abspath(aggregates_file) if aggregates_file else None
+        if collector and collector not in self.merged_collectors and os.path.exists(aggregates_file):
+            try:
+                with open(aggregates_file, 'r') as file:
+                    data = json.load(file)
+                stats = {relay: RelayStats.fromDict(d) for relay, d in data['relays'].items()}
+                watermark = min(data['records'], len(store))
+            except Exception as ex:
+                self.logger(f"Database ERROR: Could not read {aggregates_file}, replaying all its measurements. {ex}")
+
+        known = dict() if known is None else known
+        first = len(self.store)
+        merged = self.store.merge(store, end=watermark, known=known)
+        replay_from = len(self.store)
+        if stats is not None and merged == watermark:
+            for relay, other in stats.items():
+                self.stats[relay].merge(other, self.half_life)
+            self.merged_collectors.add(collector)
+        elif stats is not None:
+            self.logger(f"Database INFO: {aggregates_file} covers measurements already in {self.store.path}, "
+                        f"replaying only the new ones")
+            replay_from = first
+        merged += self.store.merge(store, start=watermark, known=known)
+        for record_number, (relay, timestamp, times, anchor) in enumerate(self.store.iterRecords(first), first):
+            if record_number >= replay_from:
+                self.stats[relay].add(times, timestamp, self.half_life)
+            if times:
+                self.decomposition.add(relay, anchor, times)
+        if merged:
+            self.decomposition.solve(DECOMPOSITION_REPLAY_SWEEPS)
+        self._saveAggregates()
+        return merged
+
+    def getScores(self, quantile=0.5):
+        """
+        Returns the estimated TTLB quantile of every measured relay, computed from the rolling aggregates.
+        """
+        with self.stats_lock:
+            return {relay: stats.sketch.quantile(quantile) for relay, stats in self.stats.items() if stats.samples}
+
+    def getDecomposedScores(self):
+        """
+        Returns the relay component of every measured relay, i.e. its mean path time with the anchor's share removed.
+        """
+        with self.stats_lock:
+            return dict(self.decomposition.relays)
+
+    def getRelayStats(self, relay):
+        with self.stats_lock:
+            return self.stats[relay].summary() if relay in self.stats else None
+
+    def getSkipSet(self):
+        skip_set = self.state_journal.load()
+
+        if not skip_set:
+            self.logger("Database INFO: The skip list was not found or is empty")
+
+        return skip_set
+
+    def update(self, skip_updates, new_measurements):
+        # Append measurements to the binary store, if there is one, before they reach the aggregates. The aggregates
+        # record the store length as their watermark, so every measurement they hold must already be in the store or
+        # it is replayed into them a second time after a crash
+        if self.store is not None:
+            try:
+                self.store.append(new_measurements)
+            except Exception as ex:
+                self.logger(f"Database ERROR: Could not save to {self.store.path}")
+                self.logger(str(ex))
+        else:
+            self._appendJsonl(new_measurements)
+
+        # Fold new measurements into the per-relay aggregates. This runs on the writer thread while the measurement
+        # threads read the stats, so it holds the stats lock
+        with self.stats_lock:
+            for m in new_measurements:
+                self.stats[m.relay].add(m.times, parseTimestamp(m.timestamp), self.half_life)
+                if m.times:
+                    self.decomposition.add(m.relay, m.anchor, m.times)
+            if new_measurements:
+                self.decomposition.solve()
+        if time.time() - self._lastAggregatesSave > AGGREGATES_SAVE_SECONDS:
+            self._saveAggregates()
+
+        # Journal the skip list changes
+        self.state_journal.append(skip_updates)
+        if self.failures.failures_file:
+            self.failures.save()
+
+        if self.store is not None and time.time() - self._lastCompaction > COMPACTION_INTERVAL_SECONDS:
+            self._compactStore()
+
+    def _appendJsonl(self, new_measurements):
         # Append measurements to file
         measurement_dicts = [x.asDict() for x in new_measurements]
         measurement_lines = [json.dumps(d)+'\n' for d in measurement_dicts]
@@ -178,114 +1354,1386 @@ class Database:
             self.logger(f"Database ERROR: Could not save to {self.measurements_file}")
             self.logger(str(ex))
 
-    def _retrieveState(self):
-        state = defaultdict(list)
+    def _compactStore(self):
+        """
+        Drops raw samples outside the retention limits from the store. They are already part of the aggregates, which
+        are saved first so that nothing is lost.
+        """
+        self._lastCompaction = time.time()
+        if not self.retention and not self.retention_per_relay:
+            return
+        self._saveAggregates()
+        min_timestamp = time.time() - self.retention if self.retention else None
         try:
-            with open(self.state_file, 'r') as state_file:
-                data = json.load(state_file)
-                for key in data.keys():
-                    state[key] = data[key]
+            dropped = self.store.compact(min_timestamp, self.retention_per_relay)
+        except Exception as ex:
+            self.logger(f"Database ERROR: Could not compact {self.store.path}")
+            self.logger(str(ex))
+            return
+        self._saveAggregates()
+        self.logger(f"Database INFO: Compacted {dropped} measurements out of {self.store.path}")
+
+    def _loadAggregates(self):
+        records = 0
+        try:
+            with open(self.aggregates_file, 'r') as file:
+                data = json.load(file)
+            records = data['records']
+            for relay, d in data['relays'].items():
+                self.stats[relay] = RelayStats.fromDict(d)
+            if 'decomposition' in data:
+                self.decomposition = PathDecomposition.fromDict(data['decomposition'])
+            self.merged_collectors = set(data.get('merged', ()))
+        except FileNotFoundError:
+            pass
         except Exception as ex:
-            self.logger(f"Database ERROR: Could not read {self.state_file}, {str(ex)}")
-        return state
+            self.logger(f"Database ERROR: Could not read {self.aggregates_file}, {str(ex)}")
+
+        # Catch up with measurements stored after the aggregates were last saved
+        if self.store is not None and records < len(self.store):
+            for relay, timestamp, times, anchor in self.store.iterRecords(records):
+                self.stats[relay].add(times, timestamp, self.half_life)
+                if times:
+                    self.decomposition.add(relay, anchor, times)
+            self.decomposition.solve(DECOMPOSITION_REPLAY_SWEEPS)
+            self._saveAggregates()
+
+    def _saveAggregates(self):
+        self._lastAggregatesSave = time.time()
+        if not self.aggregates_file:
+            return
+        with self.stats_lock:
+            data = {'records': len(self.store) if self.store is not None else 0,
+                    'relays': {relay: stats.asDict() for relay, stats in self.stats.items()},
+                    'decomposition': self.decomposition.asDict(),
+                    'merged': sorted(self.merged_collectors)}
+        temp_path = self.aggregates_file + '.tmp'
+        try:
+            with open(temp_path, 'w') as file:
+                json.dump(data, file)
+            os.replace(temp_path, self.aggregates_file)
+        except Exception as ex:
+            self.logger(f"Database ERROR: Could not save to {self.aggregates_file}")
+            self.logger(str(ex))
+
+
+class RelayScheduler:
+    def __init__(self, relay_stats, weights=None, stats_lock=None):
+        """
+        Heap-based relay queue for the priority measurement mode. A relay's priority is a weighted sum of
+
+        -   staleness: time since its last sample, relative to STALENESS_HORIZON_SECONDS
+        -   variance: coefficient of variation of its TTLB samples
+        -   weight: consensus weight relative to the heaviest relay
+        -   new: whether it appeared in the latest consensus
+
+        each normalised to [0, 1]. Relays without enough samples count as fully stale and fully variable.
+        Priorities are computed holding stats_lock, under which the Database updates relay_stats.
+        """
+        self.relay_stats = relay_stats      # relay fingerprint: RelayStats, kept up to date by the Database
+        self.stats_lock = stats_lock if stats_lock is not None else Lock()
+        self.weights = dict(DEFAULT_PRIORITY_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+
+        self.consensus = dict()             # relay fingerprint: consensus weight
+        self.dispatched = dict()            # relay fingerprint: time it was last handed out
+        self.new_relays = set()
+        self.valid_after = None             # valid-after time of the ranked consensus
+        self._max_weight = 1
+        self._heap = list()                 # (-priority, fingerprint)
+        self._pops = 0
+
+    def __len__(self):
+        return len(self.consensus)
+
+    def updateConsensus(self, consensus_weights, valid_after=None):
+        if self.consensus:
+            self.new_relays |= set(consensus_weights) - set(self.consensus)
+        self.new_relays &= set(consensus_weights)
+        self.dispatched = {fp: t for fp, t in self.dispatched.items() if fp in consensus_weights}
+        self.consensus = dict(consensus_weights)
+        self._max_weight = max(self.consensus.values(), default=0) or 1
+        self.valid_after = valid_after if valid_after is not None else time.time()
+        self.rebuild()
+
+    def rebuild(self):
+        now = time.time()
+        with self.stats_lock:
+            self._heap = [(-self.priority(fp, now), fp) for fp in self.consensus]
+        heapq.heapify(self._heap)
+        self._pops = 0
+
+    def priority(self, fingerprint, now):
+        stats = self.relay_stats.get(fingerprint)
+        last_timestamp = self.dispatched.get(fingerprint)
+        if stats is not None and stats.last_timestamp is not None:
+            last_timestamp = max(last_timestamp or stats.last_timestamp, stats.last_timestamp)
+
+        staleness = 1.0
+        if last_timestamp is not None:
+            staleness = min(1.0, max(0.0, now - last_timestamp) / STALENESS_HORIZON_SECONDS)
+
+        variance = 1.0
+        if stats is not None and stats.samples > 1 and stats.mean > 0:
+            variance = min(1.0, math.sqrt(stats.variance) / stats.mean)
+
+        weight = self.consensus.get(fingerprint, 0) / self._max_weight
+        new = 1.0 if fingerprint in self.new_relays else 0.0
+
+        return (self.weights['staleness'] * staleness + self.weights['variance'] * variance +
+                self.weights['weight'] * weight + self.weights['new'] * new)
+
+    def pop(self):
+        """
+        Returns the relay with the highest priority and re-queues it as freshly measured. Stored priorities are
+        re-evaluated lazily when they reach the top, and all of them are recomputed every
+        SCHEDULER_REBUILD_FRACTION of the consensus.
+        """
+        if self._pops >= max(1, int(len(self.consensus) * SCHEDULER_REBUILD_FRACTION)):
+            self.rebuild()
+
+        now = time.time()
+        while self._heap:
+            _, fingerprint = heapq.heappop(self._heap)
+            if fingerprint not in self.consensus:
+                continue
+            with self.stats_lock:
+                priority = self.priority(fingerprint, now)
+            if self._heap and priority < -self._heap[0][0]:
+                heapq.heappush(self._heap, (-priority, fingerprint))     # stale entry, try the new top
+                continue
+            break
+        else:
+            return None
+
+        self._pops += 1
+        self.new_relays.discard(fingerprint)
+        self.dispatched[fingerprint] = now
+        with self.stats_lock:
+            priority = self.priority(fingerprint, now)
+        heapq.heappush(self._heap, (-priority, fingerprint))
+        return fingerprint
+
+    def peek(self, count):
+        """
+        Returns the relays likely to be popped next, ranked by their stored priorities.
+        """
+        return [fp for _, fp in heapq.nsmallest(count, self._heap) if fp in self.consensus]
+
+
+class AdaptiveSampler:
+    def __init__(self, min_repeats=3, max_repeats=10, relative_tolerance=0.1, confidence=0.95, cutoff_quantile=None):
+        """
+        Sequential stopping rule for the repeated fetches of one relay. After min_repeats samples, fetching stops
+        once the confidence interval of the mean TTLB is narrower than relative_tolerance of the mean, or once its
+        lower bound is above the score cutoff, i.e. the relay is clearly slower than the relays we would select.
+        max_repeats caps the number of fetches.
+
+        The cutoff is the cutoff_quantile of the relays' median TTLBs, refreshed by the MeasurementHandler.
+        """
+        self.min_repeats = max(2, min_repeats)
+        self.max_repeats = max(self.min_repeats, max_repeats)
+        self.relative_tolerance = relative_tolerance
+        self.confidence = confidence
+        self.cutoff_quantile = cutoff_quantile
+        self.cutoff = None
+        self._z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+
+    @staticmethod
+    def fromConfig(d, repeats):
+        return AdaptiveSampler(d.get('min_repeats', 3), repeats, d.get('relative_tolerance', 0.1),
+                               d.get('confidence', 0.95), d.get('cutoff_quantile', None))
+
+    def halfWidth(self, times):
+        """
+        Half width of the Student-t confidence interval of the mean of times.
+        """
+        n = len(times)
+        if n < 2:
+            return math.inf
+        return self._tQuantile(n - 1) * statistics.stdev(times) / math.sqrt(n)
+
+    def shouldStop(self, times):
+        n = len(times)
+        if n >= self.max_repeats:
+            return True
+        if n < self.min_repeats:
+            return False
+
+        mean = statistics.fmean(times)
+        half_width = self.halfWidth(times)
+        if half_width <= self.relative_tolerance * mean:
+            return True
+        return self.cutoff is not None and mean - half_width > self.cutoff
+
+    def updateCutoff(self, relay_stats, stats_lock):
+        """
+        Sets the cutoff to the cutoff_quantile of the relays' median TTLBs. They are read holding stats_lock, under
+        which the Database updates relay_stats from the writer thread.
+        """
+        if self.cutoff_quantile is None:
+            return
+        with stats_lock:
+            medians = [stats.sketch.quantile(0.5) for stats in relay_stats.values()]
+        medians = sorted(m for m in medians if m is not None)
+        if medians:
+            self.cutoff = medians[min(len(medians) - 1, int(self.cutoff_quantile * len(medians)))]
+
+    def _tQuantile(self, df):
+        """
+        Student-t quantile from the normal one through the Cornish-Fisher expansion, close enough for df >= 2.
+        """
+        z = self._z
+        return (z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2) +
+                (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3) +
+                (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / (92160 * df ** 4))
+
+
+class ConcurrencyController:
+    def __init__(self, relay_stats, min_concurrency=1, max_concurrency=32, window=20, latency_tolerance=0.25,
+                 max_failure_rate=0.3, stats_lock=None):
+        """
+        AIMD controller of the number of in-flight measurements. Every window finished scans it looks at
+
+        -   throughput: bytes fetched per second over the window
+        -   latency inflation: median ratio of each fetch's TTLB to the historical median of its relay. Every path
+            shares the anchor and the collector's uplink, so inflation across all relays means we are saturating
+            them and biasing the measurements
+        -   failure rate: share of the window's scans that failed
+
+        and cuts the concurrency by CONCURRENCY_DECREASE_FACTOR when inflation exceeds latency_tolerance or failures
+        exceed max_failure_rate. Otherwise it widens by one, holding for a window whenever the last widening did not
+        raise throughput by CONCURRENCY_THROUGHPUT_GAIN. The medians are read holding stats_lock, under which the
+        Database updates relay_stats.
+        """
+        self.relay_stats = relay_stats
+        self.stats_lock = stats_lock if stats_lock is not None else Lock()
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency)
+        self.window = max(1, window)
+        self.latency_tolerance = latency_tolerance
+        self.max_failure_rate = max_failure_rate
+
+        self.throughput = None          # bytes per second of the last window
+        self.inflation = None           # median latency inflation of the last window
+        self.failure_rate = None
+        self._increased = False
+        self._lock = Lock()
+        self._resetWindow()
+
+    @staticmethod
+    def fromConfig(d, relay_stats=None, stats_lock=None):
+        return ConcurrencyController(relay_stats, d.get('min_concurrency', 1), d.get('max_concurrency', 32),
+                                     d.get('window', 20), d.get('latency_tolerance', 0.25),
+                                     d.get('max_failure_rate', 0.3), stats_lock)
+
+    def record(self, fingerprint, concurrency, result=None, error=None):
+        """
+        Adds a finished scan, where result is its (timings, build time, progress) or None if it failed.
+
+        :return: the new concurrency when a window closes with a change, otherwise None
+        """
+        with self._lock:
+            self._finished += 1
+            if error is not None or not result:
+                self._failures += 1
+            else:
+                timings, _, progress = result
+                self._bytes += sum(samples[-1][0] for samples in progress if samples) if progress else 0
+                median = None
+                with self.stats_lock:
+                    stats = self.relay_stats.get(fingerprint) if self.relay_stats is not None else None
+                    if stats is not None and stats.samples >= 3:
+                        median = stats.sketch.quantile(0.5)
+                if median and median > 0:
+                    self._ratios.extend(fetch_timings[-1] / median for fetch_timings in timings)
+
+            if self._finished < self.window:
+                return None
+            return self._adjust(concurrency)
+
+    def _adjust(self, concurrency):
+        elapsed = max(time.monotonic() - self._window_start, 1e-6)
+        throughput = self._bytes / elapsed
+        failure_rate = self._failures / self._finished
+        inflation = statistics.median(self._ratios) if self._ratios else None
+        previous_throughput = self.throughput
+        self.throughput, self.failure_rate, self.inflation = throughput, failure_rate, inflation
+        self._resetWindow()
+
+        if failure_rate > self.max_failure_rate or (inflation is not None and inflation > 1 + self.latency_tolerance):
+            self._increased = False
+            new_concurrency = max(self.min_concurrency, int(concurrency * CONCURRENCY_DECREASE_FACTOR))
+        elif (self._increased and previous_throughput and
+              throughput < previous_throughput * (1 + CONCURRENCY_THROUGHPUT_GAIN)):
+            self._increased = False     # the last widening did not pay off, hold before probing again
+            new_concurrency = concurrency
+        else:
+            self._increased = concurrency < self.max_concurrency
+            new_concurrency = min(self.max_concurrency, concurrency + 1)
+
+        return new_concurrency if new_concurrency != concurrency else None
+
+    def _resetWindow(self):
+        self._window_start = time.monotonic()
+        self._finished = 0
+        self._failures = 0
+        self._bytes = 0
+        self._ratios = list()
+
+
+class TimeoutModel:
+    def __init__(self, default=CONNECTION_TIMEOUT, quantile=TIMEOUT_QUANTILE, min_timeout=MIN_ADAPTIVE_TIMEOUT,
+                 max_timeout=MAX_ADAPTIVE_TIMEOUT):
+        """
+        Learns a timeout from observed latencies, in the spirit of tor's circuit build timeout. A Pareto distribution
+        is fitted to the last TIMEOUT_WINDOW latencies, with latencies that hit the timeout counted as right-censored,
+        and the timeout is its quantile. A relay whose own recent latencies are slower than that gets
+        RELAY_TIMEOUT_MARGIN times its slowest one instead. Until TIMEOUT_MIN_SAMPLES latencies are seen, default is
+        used.
+        """
+        self.default = default
+        self.quantile = quantile
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+
+        self.alpha = None               # shape of the fitted Pareto distribution
+        self.xm = None                  # scale of the fitted Pareto distribution
+        self._timeout = default
+        self._recent = deque(maxlen=TIMEOUT_WINDOW)    # (seconds, timed out)
+        self._relays = dict()           # relay fingerprint: deque of its recent completed latencies
+        self._since_fit = 0
+        self._lock = Lock()
+
+    def record(self, fingerprint, seconds, timed_out=False):
+        with self._lock:
+            self._recent.append((seconds, timed_out))
+            if not timed_out:
+                self._relays.setdefault(fingerprint, deque(maxlen=RELAY_TIMEOUT_SAMPLES)).append(seconds)
+            self._since_fit += 1
+            if self._since_fit >= TIMEOUT_REFIT_SAMPLES:
+                self._fit()
+
+    def recordCircuit(self, circuit, timeout):
+        """
+        Records the build of a PendingCircuit, or its timeout if it was abandoned.
+        """
+        if circuit.timed_out:
+            self.record(circuit.path[0], timeout, timed_out=True)
+        elif circuit.status == stem.CircStatus.BUILT:
+            self.record(circuit.path[0], circuit.build_time)
+
+    def timeout(self, fingerprint=None):
+        with self._lock:
+            timeout = self._timeout
+            recent = self._relays.get(fingerprint)
+            if recent and len(recent) >= 3:
+                timeout = max(timeout, min(self.max_timeout, RELAY_TIMEOUT_MARGIN * max(recent)))
+            return timeout
+
+    def _fit(self):
+        self._since_fit = 0
+        completed = sorted(seconds for seconds, timed_out in self._recent if not timed_out)
+        if len(completed) < TIMEOUT_MIN_SAMPLES:
+            return
+
+        # The scale is taken low in the distribution rather than at its minimum, which outliers would drag down
+        xm = max(completed[len(completed) // 10], 1e-3)
+        log_sum = sum(math.log(max(seconds, xm) / xm) for seconds, _ in self._recent)
+        if log_sum <= 0:
+            return
+        self.xm = xm
+        self.alpha = len(completed) / log_sum
+        timeout = xm / (1 - self.quantile) ** (1 / self.alpha)
+        self._timeout = min(self.max_timeout, max(self.min_timeout, timeout))
+
+
+class StreamAttacher:
+    def __init__(self, tor_controller, logger):
+        """
+        Attaches every new SOCKS stream to the circuit registered for its source port. A single STREAM listener
+        serves all circuits in flight, so any number of measurements can share the controller.
+        """
+        self.tor_controller = tor_controller
+        self.logger = logger
+        self.stream_map = dict()    # source port: circuit id
+        self._lock = Lock()
+
+    def start(self):
+        self.tor_controller.add_event_listener(self._onStream, stem.control.EventType.STREAM)
+        self.tor_controller.set_conf('__LeaveStreamsUnattached', '1')  # leave stream management to us
+
+    def stop(self):
+        self.tor_controller.remove_event_listener(self._onStream)
+        self.tor_controller.reset_conf('__LeaveStreamsUnattached')
+
+    def register(self, source_port, circuit_id):
+        with self._lock:
+            self.stream_map[source_port] = circuit_id
+
+    def unregister(self, source_port):
+        with self._lock:
+            self.stream_map.pop(source_port, None)
+
+    def _onStream(self, stream):
+        if stream.status != 'NEW':
+            return
+        with self._lock:
+            circuit_id = self.stream_map.get(stream.source_port)
+        if circuit_id is None:
+            circuit_id = '0'    # not one of ours, let tor pick the circuit
+        try:
+            self.tor_controller.attach_stream(stream.id, circuit_id)
+        except Exception as ex:
+            self.logger(f"StreamAttacher WARNING: Could not attach stream {stream.id} to circuit {circuit_id} ({ex})")
+
+
+class PendingCircuit:
+    def __init__(self, path):
+        """
+        A circuit launched with new_circuit(await_build=False). It is resolved by the CircuitPipeline once tor reports
+        it BUILT, FAILED or CLOSED, and can be waited on from a thread or through a callback.
+        """
+        self.path = list(path)
+        self.circuit_id = None
+        self.status = None
+        self.build_time = None      # seconds from launch to the first terminal CIRC event
+        self.closed = False         # set when a built circuit is closed before it is used
+        self.timed_out = False      # set when the circuit was abandoned for overrunning its build timeout
+        self._launched = time.monotonic()
+        self._done = Event()
+        self._callbacks = list()
+        self._lock = Lock()
+
+    @property
+    def usable(self):
+        return not self.closed and self.status in (None, stem.CircStatus.BUILT)
+
+    def resolve(self, status):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self.status = status
+            self.build_time = time.monotonic() - self._launched
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, list()
+        for callback in callbacks:
+            callback(self)
+
+    def addCallback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the circuit is resolved and returns its id, raising CircuitExtensionFailed if it did not build.
+        The timeout counts from the launch of the circuit, so prebuilt circuits are not granted extra time.
+        """
+        if not self._done.wait(self.remaining(timeout)):
+            self.abandon(timeout)
+        self.check()
+        return self.circuit_id
+
+    def remaining(self, timeout):
+        return None if timeout is None else max(0.0, timeout - (time.monotonic() - self._launched))
+
+    def abandon(self, timeout):
+        self.timed_out = True
+        raise stem.CircuitExtensionFailed(f"Circuit {self.circuit_id} build timed out after {timeout:.1f}s")
+
+    def check(self):
+        if self.status != stem.CircStatus.BUILT or self.closed:
+            status = 'closed' if self.closed else self.status.lower()
+            raise stem.CircuitExtensionFailed(f"Circuit {self.circuit_id} {status} while building")
+
+
+class CircuitPipeline:
+    def __init__(self, tor_controller, logger):
+        """
+        Builds the circuits of upcoming relays in the background while the current ones are being fetched, so build
+        latency hides behind transfer time. Every circuit is launched on the shared controller without waiting and
+        resolved through a single CIRC listener. Prebuilt circuits whose relay drops out of the plan are closed.
+        """
+        self.tor_controller = tor_controller
+        self.logger = logger
+
+        self._prebuilt = dict()         # relay fingerprint: PendingCircuit not yet taken
+        self._circuits = dict()         # circuit id: PendingCircuit launched by us and not yet released
+        self._early = dict()            # circuit id: status received before new_circuit returned
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._prebuilt)
+
+    def start(self):
+        self.tor_controller.add_event_listener(self._onCircuit, stem.control.EventType.CIRC)
+
+    def stop(self):
+        self.tor_controller.remove_event_listener(self._onCircuit)
+        self.discard(())
+
+    def plan(self, paths):
+        """
+        Makes sure a circuit is being built for each of the given upcoming paths, keyed by their first relay, and
+        closes prebuilt circuits no longer planned.
+        """
+        paths = list(paths)
+        self.discard(path[0] for path in paths)
+        for path in paths:
+            with self._lock:
+                pending = self._prebuilt.get(path[0])
+            if pending is not None and pending.path == path and pending.usable:
+                continue
+            try:
+                launched = self.launch(path)
+            except Exception as ex:
+                self.logger(f"CircuitPipeline WARNING: Could not prebuild a circuit through {path[0]} ({ex})")
+                continue
+            with self._lock:
+                pending, self._prebuilt[path[0]] = self._prebuilt.get(path[0]), launched
+            if pending is not None:
+                self.release(pending)
+
+    def discard(self, keep):
+        keep = set(keep)
+        with self._lock:
+            dropped = [fp for fp in self._prebuilt if fp not in keep]
+            dropped = [self._prebuilt.pop(fp) for fp in dropped]
+        for pending in dropped:
+            self.release(pending)
+
+    def take(self, path):
+        """
+        Returns the prebuilt circuit for path if there is a usable one, otherwise launches a new circuit.
+        """
+        with self._lock:
+            pending = self._prebuilt.pop(path[0], None)
+        if pending is not None and (pending.path != list(path) or not pending.usable):
+            self.release(pending)
+            pending = None
+        return pending if pending is not None else self.launch(path)
+
+    def launch(self, path):
+        pending = PendingCircuit(path)
+        circuit_id = self.tor_controller.new_circuit(pending.path, await_build=False)
+        with self._lock:
+            pending.circuit_id = circuit_id
+            self._circuits[circuit_id] = pending
+            status = self._early.pop(circuit_id, None)
+        if status is not None:
+            self._circuitStatus(pending, status)
+        return pending
+
+    def release(self, pending):
+        with self._lock:
+            self._circuits.pop(pending.circuit_id, None)
+        try:
+            self.tor_controller.close_circuit(pending.circuit_id)
+        except Exception:
+            pass    # circuit may already be gone
+
+    def _onCircuit(self, event):
+        if event.status not in (stem.CircStatus.BUILT, stem.CircStatus.FAILED, stem.CircStatus.CLOSED):
+            return
+        with self._lock:
+            pending = self._circuits.get(event.id)
+            if pending is None:
+                if event.status == stem.CircStatus.CLOSED:
+                    self._early.pop(event.id, None)
+                else:
+                    self._early[event.id] = event.status
+                return
+            if event.status != stem.CircStatus.BUILT:
+                self._circuits.pop(event.id, None)
+        self._circuitStatus(pending, event.status)
+
+    @staticmethod
+    def _circuitStatus(pending, status):
+        if pending.status is None:
+            pending.resolve(status)
+        elif status != stem.CircStatus.BUILT:
+            pending.closed = True
+
+
+class ResponseSink:
+    def __init__(self, marker=DEFAULT_CONTENT_MARKER, sha256=None):
+        """
+        Consumes a response body chunk by chunk without keeping it. The body is checked incrementally: marker is
+        searched for across chunk boundaries and, when sha256 is given, the body's digest is compared to it. While the
+        body streams in, (bytes received, seconds since the fetch started) progress samples are taken every
+        PROGRESS_SAMPLE_BYTES, halving the resolution whenever more than PROGRESS_MAX_SAMPLES have been taken.
+        """
+        self.marker = marker.encode() if isinstance(marker, str) else marker or b''
+        self.sha256 = sha256.lower() if sha256 else None
+        self.bytes = 0
+        self.found = not self.marker
+        self.progress = list()
+
+        self._digest = hashlib.sha256() if sha256 else None
+        self._tail = b''
+        self._sample_bytes = PROGRESS_SAMPLE_BYTES
+        self._next_sample = PROGRESS_SAMPLE_BYTES
+        self._start = time.monotonic()
+
+    def reset(self):
+        """
+        Starts the clock of the progress samples, called when the request is sent.
+        """
+        self._start = time.monotonic()
+
+    def write(self, chunk):
+        if not self.found:
+            window = self._tail + chunk
+            self.found = self.marker in window
+            self._tail = window[-(len(self.marker) - 1):] if len(self.marker) > 1 else b''
+        if self._digest is not None:
+            self._digest.update(chunk)
+
+        self.bytes += len(chunk)
+        if self.bytes >= self._next_sample:
+            self._sample()
+
+    def check(self):
+        """
+        Takes the final progress sample and raises ValueError if the body failed the content checks.
+        """
+        if not self.progress or self.progress[-1][0] != self.bytes:
+            self._sample()
+        if not self.found:
+            raise ValueError("Request didn't have the right content")
+        if self._digest is not None and self._digest.hexdigest() != self.sha256:
+            raise ValueError(f"Request body of {self.bytes} bytes didn't match the expected sha256")
+
+    def _sample(self):
+        self.progress.append((self.bytes, time.monotonic() - self._start))
+        if len(self.progress) > PROGRESS_MAX_SAMPLES:
+            self.progress = self.progress[1::2]
+            self._sample_bytes *= 2
+        self._next_sample = self.bytes + self._sample_bytes
+
+
+class CurlPool:
+    def __init__(self, stream_attacher, logger, socks_port=SOCKS_PORT, timeout=CONNECTION_TIMEOUT,
+                 fetch_timeout=FETCH_TIMEOUT):
+        """
+        Pooled pycurl fetch layer shared by all measurement threads. Handles are configured once and reused, and a
+        handle stays bound to one circuit until it is released so HTTP keep-alive carries over between repeats.
+        Transfers from every thread are run together on one CurlMulti, driven by the pool's own thread. timeout
+        bounds connecting through a circuit and fetch_timeout the whole transfer.
+        """
+        self.stream_attacher = stream_attacher
+        self.logger = logger
+        self.socks_port = socks_port
+        self.timeout = timeout
+        self.fetch_timeout = fetch_timeout
+
+        self.multi = pycurl.CurlMulti()
+        self._idle = list()             # configured handles not bound to a circuit
+        self._bound = dict()            # circuit id: handle
+        self._pending = queue.Queue()   # handles waiting to be added to the multi
+        self._active = 0
+        self._lock = Lock()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._pending.put(None)
+        self._thread.join()
+        with self._lock:
+            handles = self._idle + list(self._bound.values())
+            self._idle.clear()
+            self._bound.clear()
+        for handle in handles:
+            handle.close()
+        self.multi.close()
+
+    def fetch(self, url, circuit_id, sink, connect_timeout=None):
+        """
+        Fetches url on the handle bound to circuit_id, streaming the body into sink and blocking until the transfer
+        is done. connect_timeout overrides the pool's timeout for connecting through the circuit.
+
+        :return: curl's cumulative connect, pretransfer, starttransfer and total times in seconds
+        """
+        handle = self._acquire(circuit_id)
+        handle.setopt(pycurl.WRITEFUNCTION, sink.write)
+        handle.setopt(pycurl.CONNECTTIMEOUT_MS, int(1000 * (connect_timeout or self.timeout)))
+        handle.setopt(pycurl.URL, url)
+        handle.error = None
+        handle.done.clear()
+
+        sink.reset()
+        self._pending.put(handle)
+        handle.done.wait()
+        handle.setopt(pycurl.FRESH_CONNECT, 0)   # later repeats may reuse the kept-alive connection
+
+        if handle.error:
+            raise ConnectionError(f"Unable to reach {url} ({handle.error})")
+        return (handle.getinfo(pycurl.CONNECT_TIME), handle.getinfo(pycurl.PRETRANSFER_TIME),
+                handle.getinfo(pycurl.STARTTRANSFER_TIME), handle.getinfo(pycurl.TOTAL_TIME))
+
+    def release(self, circuit_id):
+        """
+        Unbinds the handle used for circuit_id and returns it to the pool.
+        """
+        with self._lock:
+            handle = self._bound.pop(circuit_id, None)
+            if handle is None:
+                return
+            self._idle.append(handle)
+        for source_port in handle.source_ports:
+            self.stream_attacher.unregister(source_port)
+        handle.source_ports.clear()
+
+    # Handles
+    def _acquire(self, circuit_id):
+        with self._lock:
+            handle = self._bound.get(circuit_id)
+            if handle is not None:
+                return handle
+            handle = self._idle.pop() if self._idle else self._newHandle()
+            self._bound[circuit_id] = handle
+
+        handle.circuit_id = circuit_id
+        handle.setopt(pycurl.FRESH_CONNECT, 1)     # never reuse a connection opened for another circuit
+        handle.setopt(pycurl.PROXYUSERNAME, f"circuit-{circuit_id}")
+        return handle
+
+    def _newHandle(self):
+        handle = pycurl.Curl()
+        handle.done = Event()
+        handle.error = None
+        handle.circuit_id = None
+        handle.source_ports = list()
+
+        def open_socket(purpose, address):
+            sock = socket.socket(address.family, address.socktype, address.protocol)
+            sock.bind((address.addr[0], 0))
+            source_port = sock.getsockname()[1]
+            handle.source_ports.append(source_port)
+            self.stream_attacher.register(source_port, handle.circuit_id)
+            return sock
+
+        handle.setopt(pycurl.PROXY, '127.0.0.1')
+        handle.setopt(pycurl.PROXYPORT, self.socks_port)
+        handle.setopt(pycurl.PROXYTYPE, pycurl.PROXYTYPE_SOCKS5_HOSTNAME)
+        handle.setopt(pycurl.OPENSOCKETFUNCTION, open_socket)
+        handle.setopt(pycurl.TIMEOUT_MS, int(1000 * self.fetch_timeout))
+        return handle
+
+    # Multi loop
+    def _run(self):
+        while self._running:
+            self._addPending(block=self._active == 0)
+
+            ret = pycurl.E_CALL_MULTI_PERFORM
+            while ret == pycurl.E_CALL_MULTI_PERFORM:
+                ret, _ = self.multi.perform()
+
+            while True:
+                remaining, succeeded, failed = self.multi.info_read()
+                for handle in succeeded:
+                    self._finish(handle)
+                for handle, errno, message in failed:
+                    self._finish(handle, message or f"curl error {errno}")
+                if not remaining:
+                    break
+
+            if self._active:
+                self.multi.select(CURL_SELECT_TIMEOUT)
+
+    def _addPending(self, block):
+        try:
+            handle = self._pending.get(block=block)
+            while handle is not None:
+                self.multi.add_handle(handle)
+                self._active += 1
+                handle = self._pending.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _finish(self, handle, error=None):
+        self.multi.remove_handle(handle)
+        self._active -= 1
+        handle.error = error
+        handle.done.set()
+
+
+class AsyncSocksClient:
+    def __init__(self, stream_attacher, socks_port=SOCKS_PORT, timeout=CONNECTION_TIMEOUT, fetch_timeout=FETCH_TIMEOUT):
+        """
+        Minimal asyncio HTTP client speaking SOCKS5 (remote hostname resolution) to tor. Every fetch opens its own
+        connection, whose source port is registered with the stream attacher before the CONNECT request is sent.
+        timeout bounds connecting through a circuit and fetch_timeout the whole fetch, as in the CurlPool.
+        """
+        self.stream_attacher = stream_attacher
+        self.socks_port = socks_port
+        self.timeout = timeout
+        self.fetch_timeout = fetch_timeout
+
+    async def fetch(self, url, circuit_id, sink, connect_timeout=None):
+        """
+        Streams the body of url into sink. connect_timeout overrides the client's timeout for connecting through the
+        circuit.
+
+        :return: cumulative connect, pretransfer, starttransfer and total times on the loop's clock
+        """
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        deadline = start_time + self.fetch_timeout
+        sink.reset()
+        connect_timeout = connect_timeout or self.timeout
+        parsed = urllib.parse.urlsplit(url)
+        host = parsed.hostname
+        port = parsed.port or 80
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', self.socks_port),
+                                                connect_timeout)
+        connect_time = loop.time() - start_time
+        source_port = writer.get_extra_info('sockname')[1]
+        self.stream_attacher.register(source_port, circuit_id)
+        try:
+            await asyncio.wait_for(self._socksConnect(reader, writer, host, port),
+                                   max(0.0, connect_timeout - (loop.time() - start_time)))
+            request = f"GET {path} HTTP/1.1\r\nHost: {parsed.netloc}\r\nConnection: close\r\n\r\n"
+            writer.write(request.encode('ascii'))
+            await writer.drain()
+            pretransfer_time = loop.time() - start_time
+
+            first_byte = await asyncio.wait_for(reader.readexactly(1), max(0.0, deadline - loop.time()))
+            starttransfer_time = loop.time() - start_time
+            await asyncio.wait_for(self._readResponse(reader, sink, first_byte), max(0.0, deadline - loop.time()))
+            return connect_time, pretransfer_time, starttransfer_time, loop.time() - start_time
+        finally:
+            self.stream_attacher.unregister(source_port)
+            writer.close()
+
+    @staticmethod
+    async def _socksConnect(reader, writer, host, port):
+        writer.write(b'\x05\x01\x00')    # version 5, one method: no authentication
+        await writer.drain()
+        version, method = await reader.readexactly(2)
+        if version != 5 or method != 0:
+            raise ConnectionError("SOCKS5 proxy refused the authentication method")
+
+        host_bytes = host.encode('idna')
+        writer.write(b'\x05\x01\x00\x03' + bytes([len(host_bytes)]) + host_bytes + port.to_bytes(2, 'big'))
+        await writer.drain()
+        version, reply, _, address_type = await reader.readexactly(4)
+        if reply != 0:
+            raise ConnectionError(f"SOCKS5 connect to {host}:{port} failed with reply {reply}")
+
+        if address_type == 1:
+            address_length = 4
+        elif address_type == 4:
+            address_length = 16
+        else:
+            address_length = (await reader.readexactly(1))[0]
+        await reader.readexactly(address_length + 2)     # bound address and port
+
+    @staticmethod
+    async def _readResponse(reader, sink, first_byte=b''):
+        head = first_byte + await reader.readuntil(b'\r\n\r\n')
+        status_line, *header_lines = head.decode('iso-8859-1').split('\r\n')
+        status = int(status_line.split()[1])
+        if status != 200:
+            raise ValueError(f"Request returned HTTP status {status}")
+
+        headers = dict()
+        for line in header_lines:
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower().endswith('chunked'):
+            await AsyncSocksClient._readChunked(reader, sink)
+            return
+
+        remaining = int(headers['content-length']) if 'content-length' in headers else None
+        while remaining is None or remaining > 0:
+            chunk = await reader.read(RESPONSE_CHUNK_SIZE if remaining is None else min(RESPONSE_CHUNK_SIZE, remaining))
+            if not chunk:
+                if remaining is not None:
+                    raise asyncio.IncompleteReadError(b'', remaining)
+                break
+            sink.write(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    @staticmethod
+    async def _readChunked(reader, sink):
+        """
+        Streams a chunked body into sink without its chunk framing, and skips the trailers after the last chunk.
+        """
+        while True:
+            size_line = await reader.readuntil(b'\r\n')
+            size = int(size_line.split(b';', 1)[0].strip(), 16)    # chunk extensions follow a ';'
+            if size == 0:
+                break
+            while size > 0:
+                chunk = await reader.readexactly(min(RESPONSE_CHUNK_SIZE, size))
+                sink.write(chunk)
+                size -= len(chunk)
+            await reader.readexactly(2)     # CRLF closing the chunk
+        while await reader.readuntil(b'\r\n') != b'\r\n':
+            pass
+
+
+class AsyncMeasurementEngine:
+    def __init__(self, circuit_pipeline, stream_attacher, logger, socks_port=SOCKS_PORT):
+        """
+        Runs measurements as coroutines on a single event loop thread. Controller calls are made from the default
+        executor and circuit builds are awaited through the CircuitPipeline callbacks, so no thread is held per
+        circuit.
+        """
+        self.circuit_pipeline = circuit_pipeline
+        self.logger = logger
+        self.socks_client = AsyncSocksClient(stream_attacher, socks_port)
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    def submit(self, path, url, repeats, sampler=None, new_sink=ResponseSink, build_timeouts=None,
+               connect_timeouts=None):
+        """
+        Schedules a scan on the event loop and returns a concurrent.futures.Future with its (timings, build time,
+        progress).
+        """
+        scan = self.scan(path, url, repeats, sampler, new_sink, build_timeouts, connect_timeouts)
+        return asyncio.run_coroutine_threadsafe(scan, self.loop)
+
+    async def scan(self, path, url, repeats, sampler=None, new_sink=ResponseSink, build_timeouts=None,
+                   connect_timeouts=None):
+        """
+        Measures the path like MeasurementHandler._scan. With TimeoutModels given, circuits overrunning the learnt
+        build timeout are abandoned and fetches use the learnt connect timeout, and both models learn from the scan.
+        """
+        build_timeout = build_timeouts.timeout(path[0]) if build_timeouts else None
+        connect_timeout = connect_timeouts.timeout(path[0]) if connect_timeouts else None
+        circuit = await self._takeCircuit(path)
+
+        timings = []
+        progress = []
+        try:
+            try:
+                await asyncio.wait_for(self._awaitBuild(circuit), circuit.remaining(build_timeout))
+            except asyncio.TimeoutError:
+                circuit.abandon(build_timeout)
+            finally:
+                if build_timeouts:
+                    build_timeouts.recordCircuit(circuit, build_timeout)
+            circuit.check()
+
+            for i in range(repeats):
+                sink = new_sink()
+                try:
+                    fetch_timings = await self.socks_client.fetch(url, circuit.circuit_id, sink, connect_timeout)
+                except asyncio.TimeoutError:
+                    if connect_timeouts and sink.bytes == 0:
+                        connect_timeouts.record(path[0], connect_timeout, timed_out=True)
+                    raise
+                if connect_timeouts:
+                    connect_timeouts.record(path[0], fetch_timings[1])
+                sink.check()
+
+                timings.append(fetch_timings)
+                progress.append(sink.progress)
+                if sampler and sampler.shouldStop([t[-1] for t in timings]):
+                    break
+
+            return timings, circuit.build_time, progress
+        finally:
+            await self.loop.run_in_executor(None, self.circuit_pipeline.release, circuit)
+
+    # Circuits
+    async def _takeCircuit(self, path):
+        return await self.loop.run_in_executor(None, self.circuit_pipeline.take, path)
+
+    async def _awaitBuild(self, circuit):
+        resolved = self.loop.create_future()
+
+        def done(_):
+            self.loop.call_soon_threadsafe(lambda: resolved.done() or resolved.set_result(None))
+
+        circuit.addCallback(done)
+        await resolved
+
+
+class TorInstance:
+    def __init__(self, logger, control_port=CONTROL_PORT, socks_port=SOCKS_PORT):
+        """
+        One tor process driven by the collector: its controller together with the stream attacher, circuit pipeline
+        and fetch backends bound to it. Measurements are spread over several of these by the MeasurementHandler.
+        """
+        self.logger = logger
+        self.control_port = control_port
+        self.socks_port = socks_port
+
+        self.tor_controller = None
+        self.stream_attacher = None
+        self.circuit_pipeline = None
+        self.curl_pool = None
+        self.async_engine = None
+        self.in_flight = 0          # measurements running on this instance, guarded by the handler's slots
+
+    def __str__(self):
+        return f"tor {self.control_port}/{self.socks_port}"
+
+    def start(self):
+        if not self._initTorController():
+            return False
+        self.stream_attacher = StreamAttacher(self.tor_controller, self.logger)
+        self.stream_attacher.start()
+        self.circuit_pipeline = CircuitPipeline(self.tor_controller, self.logger)
+        self.circuit_pipeline.start()
+        if pycurl is not None:
+            self.curl_pool = CurlPool(self.stream_attacher, self.logger, self.socks_port)
+            self.curl_pool.start()
+        return True
+
+    def stop(self):
+        if self.async_engine:
+            self.async_engine.stop()
+            self.async_engine = None
+        if self.curl_pool:
+            self.curl_pool.stop()
+            self.curl_pool = None
+        if self.circuit_pipeline:
+            self.circuit_pipeline.stop()
+            self.circuit_pipeline = None
+        if self.stream_attacher:
+            self.stream_attacher.stop()
+            self.stream_attacher = None
+        if self.tor_controller:
+            self.tor_controller.close()
+            self.tor_controller = None
+
+    def asyncEngine(self):
+        if self.async_engine is None:
+            self.async_engine = AsyncMeasurementEngine(self.circuit_pipeline, self.stream_attacher, self.logger,
+                                                       self.socks_port)
+            self.async_engine.start()
+        return self.async_engine
+
+    def _initTorController(self):
+        try:
+            self.tor_controller = stem.control.Controller.from_port(port=self.control_port)
+        except stem.SocketError as exc:
+            self.logger(f"TorInstance ERROR: Unable to connect to tor on port {self.control_port}: {exc}")
+            return False
+        try:
+            self.tor_controller.authenticate()
+        except stem.connection.AuthenticationFailure as exc:
+            self.logger(f"TorInstance ERROR: Unable to authenticate on port {self.control_port}: {exc}")
+            self.tor_controller.close()
+            self.tor_controller = None
+            return False
+        self.logger(f"TorInstance INFO: {self} is running version {self.tor_controller.get_version()}")
+        return True
 
 
 class MeasurementHandler:
-    def __init__(self, logger):
-        self.socks_port = SOCKS_PORT
+    def __init__(self, logger, relay_stats=None, failure_cache=None, results=None, stats_lock=None):
+        self.tor_ports = [(CONTROL_PORT, SOCKS_PORT)]     # (control port, socks port) of every tor instance
         self.conn_timeout = CONNECTION_TIMEOUT
+        self.build_timeouts = TimeoutModel(self.conn_timeout)       # learnt circuit build timeouts
+        self.connect_timeouts = TimeoutModel(self.conn_timeout)     # learnt timeouts of connecting through a circuit
         self.logger = logger
+        self.relay_stats = relay_stats if relay_stats is not None else dict()
+        self.stats_lock = stats_lock if stats_lock is not None else Lock()  # held by the Database updating relay_stats
+        self.failure_cache = failure_cache
+        # Receives finished Measurements and skip set entries (strings) in order. The Controller passes a
+        # GroupCommitWriter, whose bounded queue blocks the measurement loop only when the disk falls behind
+        self.results = results if results is not None else queue.Queue()
 
         self.config = None
-        self.anchor = None
+        self.anchors = list()       # second hops, each relay is measured through them in turn
         self.url = None
         self.file_size = None
+        self.content_marker = DEFAULT_CONTENT_MARKER
+        self.content_sha256 = None
         self.repeats = 5
-
-        self.tor_controller = None
+        self.sampler = None
+        self.concurrency = DEFAULT_CONCURRENCY
+        self.concurrency_controller = None
+        self.backend = DEFAULT_BACKEND
+        self.scheduler = DEFAULT_SCHEDULER
+        self.prebuild = DEFAULT_PREBUILD_CIRCUITS
+        self.shard = None               # (index, count) of the fingerprint range measured by this collector
+
+        self.instances = list()
+        self.consensus_cache = ConsensusCache(CONSENSUS_FILE)
         self.relay_queue = None
-        self.skip_list = None
-
-        self.measurement_cache = list()
-
+        self.relay_scheduler = RelayScheduler(self.relay_stats, stats_lock=self.stats_lock)
+        self.skip_set = None
+
+        self._in_flight = 0
+        self._planned = dict()          # relay fingerprint: TorInstance its circuit is being prebuilt on
+        self._slots = Condition()
+        self._anchor_turns = defaultdict(int)   # relay fingerprint: measurements dispatched through the anchors
+        self._lastCutoffUpdate = 0
         self._initialized = False
 
     # Public methods
-    def initialize(self, skip_list):
-        if skip_list is None:
-            skip_list = list()
-        self.skip_list = skip_list
-        if self._initTorController():
+    def initialize(self, skip_set):
+        if skip_set is None:
+            skip_set = set()
+        self.skip_set = skip_set
+        if self._initTorInstances():
             if self._buildRelayQueue():
                 self._initialized = True
-                self.logger(f"MeasurementHandler INFO: Initialized successfully and skipping {len(skip_list)} relays")
+                self.logger(f"MeasurementHandler INFO: Initialized successfully on {len(self.instances)} tor instances "
+                            f"and skipping {len(skip_set)} relays")
                 return True
         return False
 
     def stop(self):
-        self.tor_controller.close()
-        self.tor_controller = None
-        self.skip_list = None
+        self.awaitInFlight()
+        for instance in self.instances:
+            instance.stop()
+        self.instances = list()
+        self._planned.clear()
+        self.skip_set = None
         self._initialized = False
 
     def updateConfig(self, config):
         self.config = config
-        self.anchor = config.get('anchor', None)
+        self.anchors = config.get('anchors', None) or [config.get('anchor', None)]
         self.url = config.get('target_file_URL', None)
         self.file_size = config.get('target_file_size_kb', None)
+        self.content_marker = config.get('content_marker', DEFAULT_CONTENT_MARKER)
+        self.content_sha256 = config.get('target_file_sha256', None)
         self.repeats = config.get('repeats_per_relay', 10)
+        sampling = config.get('adaptive_sampling', None)
+        if sampling and sampling.get('enabled', True):
+            self.sampler = AdaptiveSampler.fromConfig(sampling, self.repeats)
+            self.sampler.updateCutoff(self.relay_stats, self.stats_lock)
+            self._lastCutoffUpdate = time.time()
+        else:
+            self.sampler = None
+        self.backend = config.get('measurement_backend', DEFAULT_BACKEND)
+        self.scheduler = config.get('scheduler', DEFAULT_SCHEDULER)
+        self.relay_scheduler.weights.update(config.get('priority_weights', None) or dict())
+        self.prebuild = max(0, int(config.get('prebuild_circuits', DEFAULT_PREBUILD_CIRCUITS)))
 
-    def dumpMeasurementCache(self):
-        cache = self.measurement_cache.copy()
-        self.measurement_cache.clear()
-        return cache
+        shard = config.get('shard', None)
+        try:
+            shard = (int(shard['index']), int(shard['count'])) if shard and int(shard.get('count', 1)) > 1 else None
+        except (AttributeError, KeyError, TypeError, ValueError) as ex:
+            self.logger(f"MeasurementHandler ERROR: The shard config {shard} needs an integer index and count ({ex})")
+            shard = self.shard
+        if shard and not 0 <= shard[0] < shard[1]:
+            self.logger(f"MeasurementHandler ERROR: Shard index {shard[0]} is not below the shard count {shard[1]}")
+            shard = self.shard
+        if shard != self.shard:
+            self.shard = shard
+            self.relay_scheduler.valid_after = None     # re-rank the consensus restricted to the new shard
+            if self.relay_queue:
+                self.relay_queue = [fp for fp in self.relay_queue if self._inShard(fp)]
+            self.logger(f"MeasurementHandler INFO: Measuring shard {shard[0] + 1} of {shard[1]}" if shard else
+                        "MeasurementHandler INFO: Measuring the whole consensus")
+
+        tor_ports = [(int(i['control_port']), int(i['socks_port'])) for i in config.get('tor_instances', None) or []]
+        tor_ports = tor_ports or [(CONTROL_PORT, SOCKS_PORT)]
+        if tor_ports != self.tor_ports and self.instances:
+            self.logger("MeasurementHandler WARNING: Changes to tor_instances only take effect after a restart")
+        elif not self.instances:
+            self.tor_ports = tor_ports
+        adaptive = config.get('adaptive_concurrency', None)
+        if adaptive and adaptive.get('enabled', True):
+            self.concurrency_controller = ConcurrencyController.fromConfig(adaptive, self.relay_stats, self.stats_lock)
+        else:
+            self.concurrency_controller = None
+        with self._slots:
+            self.concurrency = max(1, int(config.get('concurrency', DEFAULT_CONCURRENCY)))
+            if self.concurrency_controller:
+                self.concurrency = min(max(self.concurrency, self.concurrency_controller.min_concurrency),
+                                       self.concurrency_controller.max_concurrency)
+            self._slots.notify_all()
 
     def measureNext(self):
+        """
+        Measures the next relay in the queue. With a concurrency above 1, or on the asyncio backend, the measurement
+        runs in the background and this only blocks until one of the in-flight slots is free.
+        """
         if not self._initialized:
             return False
 
-        if not self.relay_queue:
-            self.skip_list.clear()
-            built = self._buildRelayQueue()
-            if not built:
+        if self.scheduler == 'priority':
+            next_fp = self._nextPriorityRelay()
+            if next_fp is None:
                 return False
+        else:
+            if not self.relay_queue:
+                self._skip(StateJournal.CLEAR)
+                built = self._buildRelayQueue()
+                if not built:
+                    return False
+
+            next_fp = self.relay_queue.pop()
+            self._skip(next_fp)
+            if self._isBackedOff(next_fp):
+                return True
+
+        if self.sampler and time.time() - self._lastCutoffUpdate > CUTOFF_REFRESH_SECONDS:
+            self.sampler.updateCutoff(self.relay_stats, self.stats_lock)
+            self._lastCutoffUpdate = time.time()
+
+        self._planCircuits(next_fp)
+        instance = self._acquireSlot(next_fp)
+        anchor = self._anchorFor(next_fp)
+        self._anchor_turns[next_fp] += 1
+        if self.backend == 'asyncio':
+            self._measureRelayAsync(next_fp, anchor, instance)
+        elif self.concurrency > 1:
+            Thread(target=self._measureRelay, args=(next_fp, anchor, instance), daemon=True).start()
+        else:
+            self._measureRelay(next_fp, anchor, instance)
+
+        return True
+
+    def awaitInFlight(self, timeout=CONNECTION_TIMEOUT * 4):
+        """
+        Blocks until all in-flight measurements have finished or the timeout has passed.
+        """
+        with self._slots:
+            self._slots.wait_for(lambda: self._in_flight == 0, timeout=timeout)
 
-        next_fp = self.relay_queue.pop()
-        self.skip_list.append(next_fp)
+    # Measuring
+    def _anchorFor(self, fingerprint):
+        """
+        Returns the anchor of the relay's next measurement. Relays start at different anchors and move on to the next
+        one after every measurement, so that every anchor is paired with a spread of relays and the path times can be
+        decomposed into relay and anchor components. Depends only on the dispatched measurements, so circuits planned
+        ahead use the same anchor as the measurement.
+        """
+        anchors = [anchor for anchor in self.anchors if anchor != fingerprint] or self.anchors
+        return anchors[(int(fingerprint[:8], 16) + self._anchor_turns[fingerprint]) % len(anchors)]
 
-        tor_path = [next_fp, self.anchor]
+    def _measureRelay(self, fingerprint, anchor, instance):
+        tor_path = [fingerprint, anchor]
         timestamp = getTimestamp()
         try:
-            times_taken = self._scan(tor_path)
+            result = self._scan(tor_path, instance)
         except Exception as ex:
-            self.logger(f"MeasurementHandler WARNING: Measurement failed: {next_fp} => {ex}")
-            times_taken = []
+            self._measurementDone(instance, fingerprint, anchor, timestamp, None, ex)
+        else:
+            self._measurementDone(instance, fingerprint, anchor, timestamp, result)
 
-        if times_taken:
-            m = Measurement(timestamp, next_fp, times_taken, self.config)
-            self.measurement_cache.append(m)
+    def _measureRelayAsync(self, fingerprint, anchor, instance):
+        tor_path = [fingerprint, anchor]
+        timestamp = getTimestamp()
 
-        return True
+        def done(future):
+            error = future.exception()
+            self._measurementDone(instance, fingerprint, anchor, timestamp, None if error else future.result(), error)
 
-    # Tor controller
-    def _initTorController(self):
-        try:
-            self.tor_controller = stem.control.Controller.from_port()
-        except stem.SocketError as exc:
-            self.logger(f"MeasurementHandler ERROR: Unable to connect to tor on port 9051: {exc}")
-            return False
-        try:
-            self.tor_controller.authenticate()
-        except stem.connection.AuthenticationFailure as exc:
-            self.logger(f"MeasurementHandler ERROR: Unable to authenticate: {exc}")
+        engine = instance.asyncEngine()
+        future = engine.submit(tor_path, self.url, self.repeats, self.sampler, self._newSink, self.build_timeouts,
+                               self.connect_timeouts)
+        future.add_done_callback(done)
+
+    def _measurementDone(self, instance, fingerprint, anchor, timestamp, result, error=None):
+        """
+        Records the outcome of a scan, where result is its (timings, build time, progress) or None if it failed.
+        """
+        self._releaseSlot(instance)
+        if error is not None:
+            self.logger(f"MeasurementHandler WARNING: Measurement failed: {fingerprint} => {error}")
+            if self.failure_cache is not None:
+                kind, backoff = self.failure_cache.recordFailure(fingerprint, error)
+                self.logger(f"MeasurementHandler INFO: Backing off {fingerprint} for {backoff}s after a {kind} failure")
+        elif self.failure_cache is not None:
+            self.failure_cache.recordSuccess(fingerprint)
+
+        controller = self.concurrency_controller
+        if controller is not None:
+            concurrency = controller.record(fingerprint, self.concurrency, result, error)
+            if concurrency is not None:
+                self.logger(f"MeasurementHandler INFO: Concurrency {self.concurrency} -> {concurrency} "
+                            f"(throughput {controller.throughput:.0f} B/s, failure rate {controller.failure_rate:.2f}, "
+                            f"latency inflation {controller.inflation or 1:.2f})")
+                with self._slots:
+                    self.concurrency = concurrency
+                    self._slots.notify_all()
+
+        if result and result[0]:
+            timings, build_time, progress = result
+            times_taken = [fetch_timings[-1] for fetch_timings in timings]
+            self.results.put(Measurement(timestamp, fingerprint, times_taken, self.config, timings, build_time,
+                                         progress, anchor))
+
+    def _skip(self, entry):
+        if entry == StateJournal.CLEAR:
+            self.skip_set.clear()
+        else:
+            self.skip_set.add(entry)
+        self.results.put(entry)
+
+    def _acquireSlot(self, fingerprint):
+        """
+        Waits for a free slot and returns the tor instance the relay is measured on: the one its circuit was prebuilt
+        on, otherwise the least loaded one.
+        """
+        with self._slots:
+            self._slots.wait_for(lambda: self._in_flight < self.concurrency)
+            instance = self._planned.pop(fingerprint, None) or self._leastLoaded()
+            self._in_flight += 1
+            instance.in_flight += 1
+        return instance
+
+    def _releaseSlot(self, instance):
+        with self._slots:
+            self._in_flight -= 1
+            instance.in_flight -= 1
+            self._slots.notify_all()
+
+    def _leastLoaded(self):
+        planned = defaultdict(int)
+        for instance in self._planned.values():
+            planned[instance] += 1
+        return min(self.instances, key=lambda i: i.in_flight + planned[i])
+
+    # Tor instances
+    @property
+    def tor_controller(self):
+        """
+        Controller of the first tor instance, used for consensus reads.
+        """
+        return self.instances[0].tor_controller if self.instances else None
+
+    def _initTorInstances(self):
+        for control_port, socks_port in self.tor_ports:
+            instance = TorInstance(self.logger, control_port, socks_port)
+            if instance.start():
+                self.instances.append(instance)
+        if not self.instances:
+            self.logger("MeasurementHandler ERROR: No tor instance could be started")
             return False
-        self.logger(f"MeasurementHandler INFO: Tor is running version {self.tor_controller.get_version()}")
         return True
 
     # Relays
     def _buildRelayQueue(self):
         fps = self._readConsensus()
-        self.relay_queue = [x for x in fps if x not in self.skip_list]
+        self.relay_queue = [x for x in fps if x not in self.skip_set]
 
         if self.relay_queue:
             return True
@@ -293,63 +2741,130 @@ class MeasurementHandler:
             self.logger("MeasurementHandler ERROR: Relay queue is empty.")
             return False
 
-    def _readConsensus(self):
-        return [desc.fingerprint for desc in self.tor_controller.get_network_statuses()]
+    def _nextPriorityRelay(self):
+        consensus = self.consensus_cache.get(self.tor_controller)
+        if consensus.valid_after != self.relay_scheduler.valid_after:
+            weights = {fp: w for fp, w in consensus.weights().items() if self._inShard(fp)}
+            self.relay_scheduler.updateConsensus(weights, consensus.valid_after)
+            self.logger(f"MeasurementHandler INFO: Priority scheduler is ranking {len(self.relay_scheduler)} relays")
+
+        next_fp = self.relay_scheduler.pop()
+        for _ in range(len(self.relay_scheduler)):
+            if next_fp is None or not self._isBackedOff(next_fp):
+                break
+            next_fp = self.relay_scheduler.pop()
+
+        if next_fp is None:
+            self.logger("MeasurementHandler ERROR: Relay scheduler is empty.")
+        return next_fp
+
+    def _upcomingRelays(self, count):
+        if self.scheduler == 'priority':
+            candidates = self.relay_scheduler.peek(count * 2)
+        else:
+            candidates = reversed(self.relay_queue[-count * 2:]) if self.relay_queue else []
+        return [fp for fp in candidates if not self._isBackedOff(fp)][:count]
 
-    # Query handling
-    def _query(self, url):
-        """
-        Uses pycurl to fetch a site using the proxy on the SOCKS_PORT.
-        """
-        output = BytesIO()
-        query = pycurl.Curl()
-        query.setopt(pycurl.URL, url)
-        query.setopt(pycurl.PROXY, 'localhost')
-        query.setopt(pycurl.PROXYPORT, SOCKS_PORT)
-        query.setopt(pycurl.PROXYTYPE, pycurl.PROXYTYPE_SOCKS5_HOSTNAME)
-        query.setopt(pycurl.CONNECTTIMEOUT, CONNECTION_TIMEOUT)
-        query.setopt(pycurl.WRITEFUNCTION, output.write)
-        try:
-            query.perform()
-            return output.getvalue()
-        except pycurl.error as exc:
-            self.logger(f"MeasurementHandler WARNING: Unable to reach {url} ({exc})")
+    def _inShard(self, fingerprint):
+        return self.shard is None or shardOf(fingerprint, self.shard[1]) == self.shard[0]
 
-    def _scan(self, path):
-        circuit_id = self.tor_controller.new_circuit(path, await_build=True)
+    def _isBackedOff(self, fingerprint):
+        return self.failure_cache is not None and self.failure_cache.isBackedOff(fingerprint)
 
-        def attach_stream(stream):
-            if stream.status == 'NEW':
-                self.tor_controller.attach_stream(stream.id, circuit_id)
+    def _readConsensus(self):
+        """
+        Returns the consensus weight of every relay in this collector's shard, keyed by fingerprint in consensus order.
+        The consensus is only parsed again once the cached snapshot has expired.
+        """
+        weights = self.consensus_cache.get(self.tor_controller).weights()
+        return {fp: weight for fp, weight in weights.items() if self._inShard(fp)}
 
-        self.tor_controller.add_event_listener(attach_stream, stem.control.EventType.STREAM)
+    # Circuits
+    def _planCircuits(self, next_fp):
+        """
+        Starts building circuits for the relay about to be measured and the ones after it, closing prebuilt circuits
+        that left the plan.
+        """
+        if not self.prebuild:
+            if self._planned:
+                with self._slots:
+                    self._planned.clear()
+                for instance in self.instances:
+                    instance.circuit_pipeline.discard(())
+            return
+        upcoming = [next_fp] + [fp for fp in self._upcomingRelays(self.prebuild) if fp != next_fp]
+        with self._slots:
+            self._planned = {fp: instance for fp, instance in self._planned.items() if fp in upcoming}
+            for fp in upcoming:
+                if fp not in self._planned:
+                    self._planned[fp] = self._leastLoaded()
+            planned = dict(self._planned)
+        for instance in self.instances:
+            instance.circuit_pipeline.plan([fp, self._anchorFor(fp)] for fp in upcoming if planned.get(fp) is instance)
+
+    # Query handling
+    def _newSink(self):
+        return ResponseSink(self.content_marker, self.content_sha256)
 
-        times = []
+    def _query(self, url, circuit_id, instance, sink, fingerprint):
+        """
+        Fetches a site through the pooled curl handle of circuit_id using the SOCKS proxy of the tor instance, with
+        the connect timeout learnt for the relay.
+        """
+        connect_timeout = self.connect_timeouts.timeout(fingerprint)
         try:
-            self.tor_controller.set_conf('__LeaveStreamsUnattached', '1')  # leave stream management to us
-            for i in range(self.repeats):
-                start_time = time.time()
-                check_page = self._query(self.url)
-                time_taken = time.time() - start_time
+            fetch_timings = instance.curl_pool.fetch(url, circuit_id, sink, connect_timeout)
+        except ConnectionError as exc:
+            self.logger(f"MeasurementHandler WARNING: {exc}")
+            if sink.bytes == 0 and 'timed out' in str(exc).lower():
+                self.connect_timeouts.record(fingerprint, connect_timeout, timed_out=True)
+            raise
+        self.connect_timeouts.record(fingerprint, fetch_timings[1])
+        return fetch_timings
+
+    def _scan(self, path, instance):
+        """
+        Measures the path, returning the (connect, pretransfer, starttransfer, total) timings of every fetch, the
+        circuit build time and the progress samples of every fetch. The circuit is taken from the pipeline when it
+        was prebuilt, and abandoned if it overruns the build timeout learnt for the relay.
+        """
+        build_timeout = self.build_timeouts.timeout(path[0])
+        circuit = instance.circuit_pipeline.take(path)
 
-                if 'van' not in check_page.decode("utf-8"):
-                    raise ValueError("Request didn't have the right content")
+        timings = []
+        progress = []
+        try:
+            try:
+                circuit_id = circuit.wait(build_timeout)
+            finally:
+                self.build_timeouts.recordCircuit(circuit, build_timeout)
+            for i in range(self.repeats):
+                sink = self._newSink()
+                fetch_timings = self._query(self.url, circuit_id, instance, sink, path[0])
+                sink.check()
 
-                times.append(time_taken)
+                timings.append(fetch_timings)
+                progress.append(sink.progress)
+                if self.sampler and self.sampler.shouldStop([t[-1] for t in timings]):
+                    break
 
-            return times
+            return timings, circuit.build_time, progress
         finally:
-            self.tor_controller.remove_event_listener(attach_stream)
-            self.tor_controller.reset_conf('__LeaveStreamsUnattached')
+            instance.curl_pool.release(circuit.circuit_id)
+            instance.circuit_pipeline.release(circuit)
 
 
 class Controller:
-    def __init__(self, config_file, measurements_file, state_file, log_file):
+    def __init__(self, config_file, measurements_file, state_file, log_file, store_file=None, aggregates_file=None,
+                 failures_file=None):
         self.config_file = config_file
         self.config = CustomConfig()
         self.logger = CustomLogger(log_file)
-        self.torHandler = MeasurementHandler(self.logger)
-        self.database = Database(measurements_file, state_file, self.logger)
+        self.database = Database(measurements_file, state_file, self.logger, store_file, aggregates_file,
+                                 failures_file)
+        self.writer = GroupCommitWriter(self._commitResults, self.database.sync, name="DatabaseWriter")
+        self.torHandler = MeasurementHandler(self.logger, self.database.stats, self.database.failures, self.writer,
+                                             self.database.stats_lock)
         self._repeatedTimer = None
         self._lastConfigHash = ""
         self._running = False
@@ -359,9 +2874,12 @@ class Controller:
         self.logger("----------------------------")
         self.logger("INFO: Controller is starting")
 
+        # Read the config first, the tor instances to drive are part of it
+        self._syncConfig()
+
         # Initialize torHandler
-        skip_list = self.database.getSkipList()
-        if not self.torHandler.initialize(skip_list):
+        skip_set = self.database.getSkipSet()
+        if not self.torHandler.initialize(skip_set):
             self.logger(f"ERROR: Tor authentication has failed")
             raise KeyboardInterrupt
 
@@ -375,8 +2893,10 @@ class Controller:
         self.logger("----------------------------")
         self._running = False
         self._stopTimer()
+        self.torHandler.stop()      # Waits for the measurements in flight and stops the workers of the tor instances
+        self.writer.stop()          # Commits the results still queued, later ones are rejected
         self._repeatedEvent()       # Syncing the program state before exiting
-        self.torHandler.stop()
+        self.database.close()
 
     # Timer event handling
     def _startTimer(self):
@@ -391,7 +2911,6 @@ class Controller:
 
     def _repeatedEvent(self):
         self._syncConfig()
-        self._syncDatabase()
         self._dumpLogs()
 
     # Config handling
@@ -423,14 +2942,16 @@ class Controller:
 
     def _configChanged(self):
         self.torHandler.updateConfig(self.config)
+        self.database.updateConfig(self.config)
+        self.writer.fsync_policy = self.config.get('fsync_policy', DEFAULT_FSYNC_POLICY)
         self.logger(f"INFO: Config has been updated:\n{self.config}")
 
     # Database handling
-    def _syncDatabase(self):
-        # Dump cached results of torHandler to database and update skip list
-        cached_measurements = self.torHandler.dumpMeasurementCache()
-        skip_list = self.torHandler.skip_list
-        self.database.update(skip_list, cached_measurements)
+    def _commitResults(self, results):
+        # Runs on the writer thread: journal skip list changes and save the measurements of one group
+        skip_updates = [r for r in results if isinstance(r, str)]
+        measurements = [r for r in results if isinstance(r, Measurement)]
+        self.database.update(skip_updates, measurements)
 
     # Log handling
     def _dumpLogs(self):
@@ -447,8 +2968,54 @@ class Controller:
 
 # MAIN
 
+def importMeasurements(jsonl_path):
+    logger = CustomLogger(LOGS_FILE, print_logs=True)
+    store = MeasurementStore(STORE_FILE, logger)
+    store.open()
+    try:
+        store.importJsonl(jsonl_path)
+    finally:
+        store.close()
+        logger.dump()
+
+
+def mergeCollectors(input_dirs):
+    """
+    Merges the measurement stores and aggregates of collectors run in the given directories into the database of the
+    working directory, dropping duplicates. Directories with only a JSON lines measurements file are imported first,
+    and all their measurements are replayed into the aggregates.
+    """
+    logger = CustomLogger(LOGS_FILE, print_logs=True)
+    database = Database(DATABASE_FILE, STATE_FILE, logger, STORE_FILE, AGGREGATES_FILE)
+    known = dict()      # measurements already in the database, see MeasurementStore.merge
+    try:
+        for input_dir in input_dirs:
+            store_path = os.path.join(input_dir, STORE_FILE)
+            jsonl_path = os.path.join(input_dir, DATABASE_FILE)
+            aggregates_file = os.path.join(input_dir, AGGREGATES_FILE)
+            if os.path.exists(store_path):
+                other = MeasurementStore(store_path, logger)
+            elif os.path.exists(jsonl_path):
+                other = MeasurementStore(os.path.join(input_dir, 'merge_' + STORE_FILE), logger)
+                aggregates_file = None  # kept without a store, so they have no watermark into the imported records
+            else:
+                logger(f"ERROR: {input_dir} has neither {STORE_FILE} nor {DATABASE_FILE}")
+                continue
+            other.open()
+            try:
+                if not len(other) and os.path.exists(jsonl_path):
+                    other.importJsonl(jsonl_path)
+                database.mergeCollector(other, aggregates_file, known)
+            finally:
+                other.close()
+    finally:
+        database.store.close()
+    logger.dump()
+
+
 def main(verbose=False):
-    controller = Controller(CONFIG_FILE, DATABASE_FILE, STATE_FILE, LOGS_FILE)
+    controller = Controller(CONFIG_FILE, DATABASE_FILE, STATE_FILE, LOGS_FILE, STORE_FILE, AGGREGATES_FILE,
+                            FAILURES_FILE)
 
     if verbose:
         controller.logger.print_logs = True
@@ -465,7 +3032,11 @@ def main(verbose=False):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) > 1 and sys.argv[1] == "-v":
+    if len(sys.argv) > 2 and sys.argv[1] == "--import":
+        importMeasurements(sys.argv[2])
+    elif len(sys.argv) > 2 and sys.argv[1] == "--merge":
+        mergeCollectors(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "-v":
         main(True)
     else:
         main()
@@ -30,16 +30,16 @@ def test_CustomLogger_():
 
 
 # DATABASE TESTS
-def test_Database_getSkipList():
+def test_Database_getSkipSet():
     db = Database('measurements.json', 'state.json', CustomLogger('logs.txt', print_logs=True))
-    skip_list = db.getSkipList()
-    print(skip_list)
+    skip_set = db.getSkipSet()
+    print(skip_set)
 
 
 def test_Database_update():
     db = Database('measurements.json', 'state.json', CustomLogger('logs.txt', print_logs=True))
 
-    # Create new skip list
+    # Create skip list updates
     new_skip = ['relay1', 'relay2', 'relay3']
 
     # Create custom config object
@@ -58,10 +58,116 @@ def test_Database_update():
     db.update(new_skip, new_measurements)
 
 
+# STORE TESTS
+def test_MeasurementStore():
+    store = MeasurementStore('test_measurements.bin', CustomLogger('logs.txt', print_logs=True))
+    store.open()
+
+    config = CustomConfig()
+    config['anchor'] = '749EF4A434DFD00DAB31E93DE86233FB916D31E3'
+    config['target_file_size_kb'] = 1
+
+    relay = '708A968F3644F8A547156368FEA3DB664110E631'
+    phases = [(0.01, 0.21, 0.32, 0.5), (0.01, 0.22, 0.41, 0.6), (0.02, 0.25, 0.50, 0.7)]
+    store.append([Measurement(getTimestamp(), relay, [0.5, 0.6, 0.7], config, phases, build_time=1.2)])
+    print(store.relayMeasurements(relay))
+    store.close()
+
+
+def test_MeasurementStore_importJsonl():
+    store = MeasurementStore('test_measurements.bin', CustomLogger('logs.txt', print_logs=True))
+    store.open()
+    store.importJsonl('measurements.json')
+    print(f"{len(store)} measurements of {len(store.relays())} relays")
+    store.close()
+
+
+def test_MeasurementStore_merge():
+    logger = CustomLogger('logs.txt', print_logs=True)
+    store = MeasurementStore('test_measurements.bin', logger)
+    other = MeasurementStore('test_measurements_other.bin', logger)
+    store.open()
+    other.open()
+
+    config = CustomConfig()
+    config['anchor'] = '749EF4A434DFD00DAB31E93DE86233FB916D31E3'
+    config['target_file_size_kb'] = 1
+
+    timestamp = getTimestamp()
+    other.append([Measurement(timestamp, '708A968F3644F8A547156368FEA3DB664110E631', [0.5, 0.6], config)])
+    print(f"Merged {store.merge(other)} measurements, then {store.merge(other)} on the second merge")
+    store.close()
+    other.close()
+
+
+def test_shardOf():
+    fingerprints = ['708A968F3644F8A547156368FEA3DB664110E631', '749EF4A434DFD00DAB31E93DE86233FB916D31E3']
+    print({fp: shardOf(fp, 4) for fp in fingerprints})
+
+
+def test_analytics():
+    from data_collection import analytics
+    analytics.main(['--jsonl', 'measurements.json', '--out', 'test_analytics'])
+
+
+def test_Database_getScores():
+    db = Database('measurements.json', 'state.json', CustomLogger('logs.txt', print_logs=True),
+                  store_file='test_measurements.bin', aggregates_file='test_aggregates.json')
+    print(db.getScores(0.5))
+    print(db.getScores(0.9))
+    db.close()
+
+
+def test_Database_reopenWithoutClose():
+    import tempfile
+    directory = tempfile.mkdtemp()
+    paths = {name: os.path.join(directory, name) for name in ('measurements.json', 'state.json', 'store.bin',
+                                                              'aggregates.json')}
+    logger = CustomLogger(os.path.join(directory, 'logs.txt'), print_logs=True)
+    db = Database(paths['measurements.json'], paths['state.json'], logger, store_file=paths['store.bin'],
+                  aggregates_file=paths['aggregates.json'])
+
+    config = CustomConfig()
+    config['anchor'] = '749EF4A434DFD00DAB31E93DE86233FB916D31E3'
+    config['target_file_size_kb'] = 1
+    relay = '708A968F3644F8A547156368FEA3DB664110E631'
+
+    # Save the aggregates with the batch, then reopen as after a crash: the batch must not be replayed into them
+    db._lastAggregatesSave = 0
+    db.update([], [Measurement(getTimestamp(), relay, [0.5, 0.6, 0.7], config)])
+    reopened = Database(paths['measurements.json'], paths['state.json'], logger, store_file=paths['store.bin'],
+                        aggregates_file=paths['aggregates.json'])
+    assert reopened.stats[relay].samples == 3, reopened.stats[relay].samples
+    reopened.store.close()
+    db.store.close()
+
+
+def test_PathDecomposition():
+    relays = {'relay1': 1.0, 'relay2': 2.0, 'relay3': 4.0}
+    anchors = {'anchor1': -0.5, 'anchor2': 0.5}
+    decomposition = PathDecomposition()
+    for turn in range(20):
+        for relay, relay_time in relays.items():
+            anchor = list(anchors)[turn % 2]
+            times = [relay_time + anchors[anchor]] * 3 + ([50.0] if turn == 5 else [])   # one outlier
+            decomposition.add(relay, anchor, times)
+        decomposition.solve()
+    print(decomposition.relays)
+    print(decomposition.anchors)
+
+
 if __name__ == "__main__":
     # test_main()
     # test_Controller_readConfig()
     # test_Controller_startTimer()
     # test_CustomLogger_()
-    test_Database_getSkipList()
+    test_Database_getSkipSet()
     test_Database_update()
+    # test_MeasurementStore()
+    # test_MeasurementStore_importJsonl()
+    # test_MeasurementStore_merge()
+    # test_shardOf()
+    # test_analytics()
+    # test_Database_getScores()
+    # test_Database_reopenWithoutClose()
+    # test_PathDecomposition()
@@ -1,6 +1,18 @@
+import asyncio
+from typing import Iterable, List, Optional, Tuple
+from weakref import WeakValueDictionary
+
 from fastor.common import log
 from fastor.common import FastorObject
+from fastor.client.connection import AsyncConnectionPool, ConnectionPool, StreamAttacher
+from fastor.client.pool import POOL_SIZE, CircuitPool, PooledCircuit
 from fastor.client.utils import ClientType
+from fastor.events.events import CONNECTIONS_IDLE, CONSENSUS_EXPIRED
+from fastor.events.scheduler import Scheduler
+from fastor.scheme import FastorScheme, Scheme, VanillaScheme
+from fastor.torHandler import TorHandler
+
+MAX_REQUESTS_PER_CIRCUIT = 8    # concurrent requests the async client sends over one circuit
 
 
 # FACTORY
@@ -9,7 +21,7 @@ def getClient(client_type: str = 'fastor') -> 'Client':
     """ Factory method returns an initialized object of the required Client Class
 
     :param client_type: defines the client Tor scheme
-                        Supported: ('vanilla', 'fastor')
+                        Supported: ('vanilla', 'fastor', 'fastor-async')
     :return:
     """
     ClientSubclass = ClientType.d[client_type]
@@ -24,14 +36,112 @@ def getClient(client_type: str = 'fastor') -> 'Client':
 # CLIENT CLASSES
 
 class Client(FastorObject):
-    """ Base class for all client types """
+    def __init__(self, tor_handler: Optional[TorHandler] = None, pool_size: int = POOL_SIZE,
+                 exit_port: Optional[int] = None):
+        """ Base class for all client types.
+
+        A client owns a CircuitPool of circuits chosen by its scheme. Once started, the Scheduler keeps the pool
+        full through CIRCUIT_UPDATE events, and CONSENSUS_EXPIRED events load the next consensus into the scheme and
+        retire circuits through relays that left it. Requests go through a ConnectionPool of keep-alive SOCKS
+        connections, whose streams the StreamAttacher routes to the pooled circuits. CONNECTIONS_IDLE events close
+        connections left idle, and the connections of a circuit are closed as soon as the pool retires it.
+
+        :param tor_handler: TorHandler of the tor instance to use, the default ports if None
+        :param pool_size: circuits kept built ahead of requests
+        :param exit_port: port the exits of pooled circuits must accept, None for any exit
+        """
+        self.tor_handler = tor_handler or TorHandler()
+        self.scheme = self._createScheme()
+        self.circuit_pool = CircuitPool(self.tor_handler, self.scheme, pool_size, exit_port,
+                                        on_retire=self._onCircuitRetired)
+        self.stream_attacher = StreamAttacher(self.tor_handler)
+        self.connection_pool = ConnectionPool(self.stream_attacher, self.tor_handler.socks_port)
+        self.scheduler: Optional[Scheduler] = None
+        self._subscriptions: List[Tuple[int, int]] = list()     # (condition id, listener id) on the scheduler
+
+    def start(self, scheduler: Optional[Scheduler] = None) -> bool:
+        """ Connects to tor, loads the consensus and starts filling the circuit pool
+
+        :param scheduler: scheduler driving the client, the Scheduler singleton if None
+        :return: True if the client is running
+        """
+        if not self.tor_handler.connect():
+            return False
+        self.scheme.updateConsensus(self.tor_handler.getConsensus())
+        self.stream_attacher.start()
+        self.scheduler = scheduler or Scheduler.retrieve()
+        self._subscribe(self._consensusExpired, self._onConsensusExpired, CONSENSUS_EXPIRED)
+        self._startConnectionPool()
+        self.circuit_pool.start(self.scheduler)
+        self.scheduler.start()
+        return True
+
+    def stop(self) -> None:
+        """ Closes the pooled circuits and unsubscribes from the scheduler, which keeps running for other users """
+        if self.scheduler is None:
+            return
+        for condition_id, listener_id in self._subscriptions:
+            self.scheduler.removeCondition(condition_id)
+            self.scheduler.removeListener(listener_id)
+        self._subscriptions = list()
+        self.scheduler = None
+        self.connection_pool.close()
+        self.circuit_pool.stop()
+        self.stream_attacher.stop()
+
+    def circuit(self) -> PooledCircuit:
+        """ Returns a built circuit from the pool for the next request """
+        return self.circuit_pool.acquire()
+
     def request(self, url: str) -> bytes:
         """ Sends HTTP request to the url provided with an empty query.
 
-        :param url: URL to send pycurl to
+        The request runs on a pooled circuit, over a kept-alive connection to the same host when there is one.
+
+        :param url: http or https URL to fetch
         :return: bytes object containing the response
         """
-        pass
+        circuit = self.circuit()
+        try:
+            return self.connection_pool.request(circuit.circuit_id, url)
+        except ConnectionError:
+            # The stream could not be opened or broke, most likely at the exit, so new requests avoid the circuit
+            self.circuit_pool.retire(circuit.circuit_id)
+            raise
+
+    # Protected #
+    def _createScheme(self) -> Scheme:
+        return VanillaScheme()
+
+    def _startConnectionPool(self) -> None:
+        """ Has the scheduler close connections idle past their timeout, which requests alone only notice on the next
+        request """
+        self._subscribe(self.connection_pool.needsEviction, self.connection_pool.evictIdle, CONNECTIONS_IDLE)
+
+    def _subscribe(self, condition, listener, event_type: str) -> None:
+        self._subscriptions.append((self.scheduler.registerCondition(condition, event_type),
+                                    self.scheduler.addListener(listener, event_type)))
+
+    def _onCircuitRetired(self, circuit_id: str) -> None:
+        """ Closes the idle connections of a circuit the pool stopped handing out, no request will reuse them """
+        self.connection_pool.closeCircuit(circuit_id)
+
+    def _consensusExpired(self) -> bool:
+        """ Condition of the CONSENSUS_EXPIRED event """
+        snapshot = self.scheme.snapshot
+        return snapshot is None or not snapshot.isFresh()
+
+    def _onConsensusExpired(self) -> None:
+        """ Listener of the CONSENSUS_EXPIRED event. The consensus cache throttles refreshes while tor has not
+        fetched a newer consensus yet """
+        snapshot = self.tor_handler.getConsensus()
+        if snapshot is self.scheme.snapshot:
+            return
+        self.scheme.updateConsensus(snapshot)
+        table = self.scheme.table
+        retired = self.circuit_pool.retireWhere(lambda path: any(fingerprint not in table for fingerprint in path))
+        if retired:
+            self.info(f"Retired {retired} circuits through relays missing from the new consensus")
 
 
 @ClientType.register('vanilla')
@@ -42,5 +152,95 @@ class VanillaClient(Client):
 
 @ClientType.register('fastor')
 class FastorClient(Client):
-    """ Client using the fastor scheme """
-    pass
+    def __init__(self, scores_file: Optional[str] = None, **kwargs):
+        """ Client using the fastor scheme
+
+        :param scores_file: JSON relay scores loaded into the FastorScheme, see FastorScheme.loadScores
+        :param kwargs: see Client
+        """
+        super().__init__(**kwargs)
+        if scores_file:
+            self.scheme.loadScores(scores_file)
+
+    def _createScheme(self) -> Scheme:
+        return FastorScheme()
+
+
+@ClientType.register('fastor-async')
+class AsyncFastorClient(FastorClient):
+    def __init__(self, max_per_circuit: int = MAX_REQUESTS_PER_CIRCUIT, **kwargs):
+        """ Client using the fastor scheme with an asyncio request API, for fanning out many requests from one
+        thread.
+
+        Requests are coroutines over an AsyncConnectionPool, so the client must be used from a single event loop.
+        Each circuit carries at most max_per_circuit requests at once. A request takes the next pooled circuit with a
+        free slot and only waits for a slot when every ready circuit is full. start() and stop() stay synchronous.
+
+        :param max_per_circuit: concurrent requests per circuit
+        :param kwargs: see FastorClient
+        """
+        super().__init__(**kwargs)
+        self.max_per_circuit = max_per_circuit
+        self.connection_pool = AsyncConnectionPool(self.stream_attacher, self.tor_handler.socks_port)
+        # circuit id: semaphore limiting its requests, dropped once no request holds it
+        self._semaphores: WeakValueDictionary = WeakValueDictionary()
+
+    async def request(self, url: str) -> bytes:
+        """ Sends HTTP request to the url provided with an empty query.
+
+        :param url: http or https URL to fetch
+        :return: bytes object containing the response
+        """
+        circuit, semaphore = await self._circuitSlot()
+        async with semaphore:
+            try:
+                return await self.connection_pool.request(circuit.circuit_id, url)
+            except ConnectionError:
+                self.circuit_pool.retire(circuit.circuit_id)
+                raise
+
+    async def gather(self, urls: Iterable[str], limit: Optional[int] = None,
+                     return_exceptions: bool = False) -> List:
+        """ Fetches all urls concurrently, like asyncio.gather over request()
+
+        :param urls: URLs to fetch
+        :param limit: maximum requests in flight across all circuits, None for no limit beyond max_per_circuit
+        :param return_exceptions: return the exceptions of failed requests in place of their response
+        :return: responses in the order of urls
+        """
+        if limit is None:
+            requests = [self.request(url) for url in urls]
+        else:
+            semaphore = asyncio.Semaphore(limit)
+
+            async def limited(url):
+                async with semaphore:
+                    return await self.request(url)
+
+            requests = [limited(url) for url in urls]
+        return await asyncio.gather(*requests, return_exceptions=return_exceptions)
+
+    # Protected #
+    def _startConnectionPool(self) -> None:
+        """ The AsyncConnectionPool evicts idle connections on a timer of its event loop """
+        pass
+
+    # Private #
+    async def _circuit(self) -> PooledCircuit:
+        """ Takes a ready circuit from the pool. If there is none, acquire launches builds over the control port and
+        waits for them, so it runs in the default executor to keep the event loop free """
+        circuit = self.circuit_pool.poll()
+        if circuit is not None:
+            return circuit
+        return await asyncio.get_running_loop().run_in_executor(None, self.circuit_pool.acquire)
+
+    async def _circuitSlot(self) -> Tuple[PooledCircuit, asyncio.Semaphore]:
+        """ Returns the next ready circuit with a free request slot, or the next circuit if they are all full """
+        for _ in range(max(1, len(self.circuit_pool))):
+            circuit = await self._circuit()
+            semaphore = self._semaphores.get(circuit.circuit_id)
+            if semaphore is None:
+                semaphore = self._semaphores[circuit.circuit_id] = asyncio.Semaphore(self.max_per_circuit)
+            if not semaphore.locked():
+                break
+        return circuit, semaphore
@@ -0,0 +1,594 @@
+import asyncio
+import socket
+import ssl
+import time
+import urllib.parse
+from collections import defaultdict
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from fastor.common import FastorObject
+from fastor.torHandler import CONNECTION_TIMEOUT, SOCKS_PORT, TorHandler
+
+SOCKS_HOST = '127.0.0.1'
+IDLE_TIMEOUT = 30   # seconds an unused keep-alive connection is kept open
+MAX_IDLE_PER_KEY = 4    # idle connections kept per (circuit, host, port)
+READ_CHUNK_SIZE = 64 * 1024
+
+
+# UTILS
+
+class Target(NamedTuple):
+    """ Where a URL is fetched from """
+    tls: bool
+    host: str
+    port: int
+    path: str       # path and query sent in the request line
+    netloc: str     # value of the Host header
+
+
+def parseUrl(url: str) -> Target:
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ValueError(f"Unsupported URL: {url}")
+    tls = parsed.scheme == 'https'
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
+    return Target(tls, parsed.hostname, parsed.port or (443 if tls else 80), path, parsed.netloc)
+
+
+def socksAddressLength(address_type: int) -> Optional[int]:
+    """ Length of the bound address in a SOCKS5 reply, None for a domain name, whose length byte comes first """
+    return {1: 4, 4: 16}.get(address_type)
+
+
+def socksConnectRequest(host: str, port: int) -> bytes:
+    """ SOCKS5 CONNECT request leaving the hostname to be resolved by tor at the exit """
+    host_bytes = host.encode('idna')
+    return b'\x05\x01\x00\x03' + bytes([len(host_bytes)]) + host_bytes + port.to_bytes(2, 'big')
+
+
+def httpRequest(target: Target) -> bytes:
+    return f"GET {target.path} HTTP/1.1\r\nHost: {target.netloc}\r\nConnection: keep-alive\r\n\r\n".encode('ascii')
+
+
+def parseHead(head: bytes) -> Tuple[str, int, Dict[str, str]]:
+    """ Parses the status line and headers of an HTTP response
+
+    :return: HTTP version, status code and headers with lowercase names
+    """
+    status_line, *header_lines = head.decode('iso-8859-1').rstrip('\r\n').split('\r\n')
+    version, status = status_line.split()[:2]
+    headers = dict()
+    for line in header_lines:
+        key, _, value = line.partition(':')
+        headers[key.strip().lower()] = value.strip()
+    return version, int(status), headers
+
+
+def keepsAlive(version: str, headers: Dict[str, str]) -> bool:
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+
+def checkStatus(status: int, url: str) -> None:
+    if not 200 <= status < 300:
+        raise ValueError(f"Request to {url} returned HTTP status {status}")
+
+
+# CLASSES
+
+class StreamAttacher(FastorObject):
+    def __init__(self, tor_handler: TorHandler):
+        """ Attaches every new SOCKS stream to the circuit registered for its source port, and lets tor choose the
+        circuit of any other stream
+
+        :param tor_handler: connected TorHandler
+        """
+        self.tor_handler = tor_handler
+        self.stream_map: Dict[int, str] = dict()    # source port: circuit id
+        self._lock = Lock()
+
+    def start(self) -> None:
+        self.tor_handler.addEventListener(self._onStream, 'STREAM')
+        self.tor_handler.leaveStreamsUnattached(True)
+
+    def stop(self) -> None:
+        self.tor_handler.removeEventListener(self._onStream)
+        self.tor_handler.leaveStreamsUnattached(False)
+
+    def register(self, source_port: int, circuit_id: str) -> None:
+        with self._lock:
+            self.stream_map[source_port] = circuit_id
+
+    def unregister(self, source_port: int) -> None:
+        with self._lock:
+            self.stream_map.pop(source_port, None)
+
+    def _onStream(self, stream) -> None:
+        if stream.status != 'NEW':
+            return
+        with self._lock:
+            circuit_id = self.stream_map.get(stream.source_port, '0')   # '0' lets tor pick the circuit
+        try:
+            self.tor_handler.attachStream(stream.id, circuit_id)
+        except Exception as ex:
+            self.warn(f"Could not attach stream {stream.id} to circuit {circuit_id}: {ex}")
+
+
+class SocksConnection:
+    def __init__(self, socks_port: int = SOCKS_PORT, timeout: float = CONNECTION_TIMEOUT):
+        """ HTTP/1.1 connection tunnelled through tor's SOCKS port, reused across requests while the server keeps it
+        alive. The TCP connection to tor is opened here, so that its source port can be registered with the
+        StreamAttacher before connect() opens the tor stream.
+
+        :param socks_port: tor's SOCKS port
+        :param timeout: socket timeout in seconds
+        """
+        self.sock = socket.create_connection((SOCKS_HOST, socks_port), timeout)
+        self.source_port: int = self.sock.getsockname()[1]
+        self.file = None
+        self.requests = 0
+        self.last_used = time.monotonic()
+
+    def connect(self, target: Target) -> None:
+        """ Opens a tor stream to the target with a SOCKS5 CONNECT, then starts TLS for https """
+        sock = self.sock
+        sock.sendall(b'\x05\x01\x00')    # version 5, one method: no authentication
+        version, method = self._recvExactly(2)
+        if version != 5 or method != 0:
+            raise ConnectionError("SOCKS5 proxy refused the authentication method")
+
+        sock.sendall(socksConnectRequest(target.host, target.port))
+        version, reply, _, address_type = self._recvExactly(4)
+        if reply != 0:
+            raise ConnectionError(f"SOCKS5 connect to {target.host}:{target.port} failed with reply {reply}")
+        address_length = socksAddressLength(address_type)
+        if address_length is None:
+            address_length = self._recvExactly(1)[0]
+        self._recvExactly(address_length + 2)    # bound address and port
+
+        if target.tls:
+            self.sock = ssl.create_default_context().wrap_socket(sock, server_hostname=target.host)
+        self.file = self.sock.makefile('rb')
+
+    def request(self, target: Target) -> Tuple[int, bytes, bool]:
+        """ Sends a GET request and reads the whole response
+
+        :return: status code, body, and whether the connection can be reused
+        """
+        self.sock.sendall(httpRequest(target))
+        head = b''
+        while not head.endswith(b'\r\n\r\n'):
+            line = self.file.readline()
+            if not line:
+                raise ConnectionError("Connection closed before the response headers")
+            head += line
+        version, status, headers = parseHead(head)
+        keep_alive = keepsAlive(version, headers)
+
+        if status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = self._readChunked()
+        elif 'content-length' in headers:
+            body = self._readExactly(int(headers['content-length']))
+        else:
+            body = self.file.read()
+            keep_alive = False
+        self.requests += 1
+        self.last_used = time.monotonic()
+        return status, body, keep_alive
+
+    def close(self) -> None:
+        try:
+            if self.file is not None:
+                self.file.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+    def _readChunked(self) -> bytes:
+        chunks = []
+        while True:
+            size = int(self.file.readline().split(b';')[0], 16)
+            if size == 0:
+                while self.file.readline() not in (b'\r\n', b'\n', b''):    # trailers
+                    pass
+                return b''.join(chunks)
+            chunks.append(self._readExactly(size))
+            self.file.readline()
+
+    def _readExactly(self, size: int) -> bytes:
+        chunks = []
+        while size > 0:
+            chunk = self.file.read(min(size, READ_CHUNK_SIZE))
+            if not chunk:
+                raise ConnectionError(f"Connection closed with {size} bytes of the body left")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def _recvExactly(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("SOCKS5 proxy closed the connection")
+            data += chunk
+        return data
+
+
+class ConnectionPool(FastorObject):
+    def __init__(self, stream_attacher: StreamAttacher, socks_port: int = SOCKS_PORT,
+                 idle_timeout: float = IDLE_TIMEOUT, max_idle: int = MAX_IDLE_PER_KEY,
+                 timeout: float = CONNECTION_TIMEOUT):
+        """ Keep-alive SOCKS connections keyed by (circuit id, host, port).
+
+        A request takes an idle connection of its key, or opens a new tor stream on the circuit, and returns the
+        connection to the pool if the server keeps it alive. Repeated requests to a service on the same circuit so
+        skip the SOCKS handshake and tor's stream setup. A connection is only ever used by one thread at a time.
+        Connections idle for more than idle_timeout are closed by evictIdle, which the Client runs on CONNECTIONS_IDLE
+        events of its Scheduler, or else on the next request. closeCircuit drops the connections of a retired circuit.
+
+        :param stream_attacher: started StreamAttacher routing new streams to their circuit
+        :param socks_port: tor's SOCKS port
+        :param idle_timeout: seconds an idle connection is kept
+        :param max_idle: idle connections kept per key
+        :param timeout: socket timeout in seconds
+        """
+        self.stream_attacher = stream_attacher
+        self.socks_port = socks_port
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle: Dict[Tuple[str, str, int], List[SocksConnection]] = defaultdict(list)
+        self._lock = Lock()
+        self._next_eviction = time.monotonic() + idle_timeout
+
+    def request(self, circuit_id: str, url: str) -> bytes:
+        """ Fetches url through the circuit, reusing an idle connection when there is one
+
+        :return: response body
+        :raises ValueError: the response status is not 2xx
+        """
+        target = parseUrl(url)
+        key = (circuit_id, target.host, target.port)
+        connection = self._checkout(key)
+        if connection is not None:
+            try:
+                status, body, keep_alive = connection.request(target)
+            except (OSError, ValueError):
+                # The server may have closed the idle connection, GET is safe to send again on a new one
+                self._close(connection)
+                connection = None
+        if connection is None:
+            connection = self._open(circuit_id, target)
+            try:
+                status, body, keep_alive = connection.request(target)
+            except Exception:
+                self._close(connection)
+                raise
+
+        if keep_alive:
+            self._checkin(key, connection)
+        else:
+            self._close(connection)
+        checkStatus(status, url)
+        return body
+
+    def needsEviction(self) -> bool:
+        """ Condition of the CONNECTIONS_IDLE event: a connection has been idle for longer than idle_timeout """
+        now = time.monotonic()
+        with self._lock:
+            return any(now - connection.last_used > self.idle_timeout
+                       for connections in self.idle.values() for connection in connections)
+
+    def evictIdle(self) -> int:
+        """ Closes connections idle for longer than idle_timeout
+
+        :return: number of closed connections
+        """
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            self._next_eviction = now + self.idle_timeout
+            for key in list(self.idle):
+                connections = self.idle[key]
+                expired += [connection for connection in connections if now - connection.last_used > self.idle_timeout]
+                connections[:] = [connection for connection in connections
+                                  if now - connection.last_used <= self.idle_timeout]
+                if not connections:
+                    del self.idle[key]
+        for connection in expired:
+            self._close(connection)
+        return len(expired)
+
+    def closeCircuit(self, circuit_id: str) -> int:
+        """ Closes the idle connections of a circuit, e.g. once it was retired and takes no new requests
+
+        :return: number of closed connections
+        """
+        with self._lock:
+            keys = [key for key in self.idle if key[0] == circuit_id]
+            connections = [connection for key in keys for connection in self.idle.pop(key)]
+        for connection in connections:
+            self._close(connection)
+        return len(connections)
+
+    def close(self) -> None:
+        with self._lock:
+            connections = [connection for connections in self.idle.values() for connection in connections]
+            self.idle.clear()
+        for connection in connections:
+            self._close(connection)
+
+    # Private #
+    def _open(self, circuit_id: str, target: Target) -> SocksConnection:
+        connection = SocksConnection(self.socks_port, self.timeout)
+        self.stream_attacher.register(connection.source_port, circuit_id)
+        try:
+            connection.connect(target)
+        except Exception:
+            self._close(connection)
+            raise
+        return connection
+
+    def _checkout(self, key) -> Optional[SocksConnection]:
+        if time.monotonic() >= self._next_eviction:
+            self.evictIdle()
+        with self._lock:
+            connections = self.idle.get(key)
+            while connections:
+                connection = connections.pop()
+                if time.monotonic() - connection.last_used <= self.idle_timeout:
+                    return connection
+                self._close(connection)
+        return None
+
+    def _checkin(self, key, connection: SocksConnection) -> None:
+        with self._lock:
+            connections = self.idle[key]
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        self._close(connection)
+
+    def _close(self, connection: SocksConnection) -> None:
+        self.stream_attacher.unregister(connection.source_port)
+        connection.close()
+
+
+class AsyncSocksConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ asyncio counterpart of SocksConnection, created with open() """
+        self.reader = reader
+        self.writer = writer
+        self.source_port: int = writer.get_extra_info('sockname')[1]
+        self.requests = 0
+        self.last_used = time.monotonic()
+
+    @staticmethod
+    async def open(socks_port: int = SOCKS_PORT) -> 'AsyncSocksConnection':
+        reader, writer = await asyncio.open_connection(SOCKS_HOST, socks_port)
+        return AsyncSocksConnection(reader, writer)
+
+    async def connect(self, target: Target) -> None:
+        """ Opens a tor stream to the target with a SOCKS5 CONNECT, then starts TLS for https """
+        reader, writer = self.reader, self.writer
+        writer.write(b'\x05\x01\x00')    # version 5, one method: no authentication
+        await writer.drain()
+        version, method = await reader.readexactly(2)
+        if version != 5 or method != 0:
+            raise ConnectionError("SOCKS5 proxy refused the authentication method")
+
+        writer.write(socksConnectRequest(target.host, target.port))
+        await writer.drain()
+        version, reply, _, address_type = await reader.readexactly(4)
+        if reply != 0:
+            raise ConnectionError(f"SOCKS5 connect to {target.host}:{target.port} failed with reply {reply}")
+        address_length = socksAddressLength(address_type)
+        if address_length is None:
+            address_length = (await reader.readexactly(1))[0]
+        await reader.readexactly(address_length + 2)     # bound address and port
+
+        if target.tls:
+            await writer.start_tls(ssl.create_default_context(), server_hostname=target.host)
+
+    async def request(self, target: Target) -> Tuple[int, bytes, bool]:
+        """ Sends a GET request and reads the whole response
+
+        :return: status code, body, and whether the connection can be reused
+        """
+        reader = self.reader
+        self.writer.write(httpRequest(target))
+        await self.writer.drain()
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed before the response headers")
+        version, status, headers = parseHead(head)
+        keep_alive = keepsAlive(version, headers)
+
+        if status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while await reader.readline() not in (b'\r\n', b'\n', b''):     # trailers
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        self.requests += 1
+        self.last_used = time.monotonic()
+        return status, body, keep_alive
+
+    def close(self) -> None:
+        try:
+            self.writer.close()
+        except RuntimeError:
+            pass    # the event loop already finished, e.g. Client.stop after asyncio.run, and took the socket with it
+
+
+class AsyncConnectionPool(FastorObject):
+    def __init__(self, stream_attacher: StreamAttacher, socks_port: int = SOCKS_PORT,
+                 idle_timeout: float = IDLE_TIMEOUT, max_idle: int = MAX_IDLE_PER_KEY,
+                 timeout: float = CONNECTION_TIMEOUT):
+        """ asyncio counterpart of ConnectionPool. Its connections belong to the event loop they were opened on, so
+        the pool must only be used from that loop, which also makes locking unnecessary. Idle connections are evicted
+        by a timer of that loop, set for the next connection to expire, and closeCircuit may be called from any
+        thread.
+
+        :param stream_attacher: started StreamAttacher routing new streams to their circuit
+        :param socks_port: tor's SOCKS port
+        :param idle_timeout: seconds an idle connection is kept
+        :param max_idle: idle connections kept per key
+        :param timeout: seconds allowed for opening a stream and for each request
+        """
+        self.stream_attacher = stream_attacher
+        self.socks_port = socks_port
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle: Dict[Tuple[str, str, int], List[AsyncSocksConnection]] = defaultdict(list)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._eviction: Optional[asyncio.TimerHandle] = None
+
+    async def request(self, circuit_id: str, url: str) -> bytes:
+        """ Fetches url through the circuit, reusing an idle connection when there is one
+
+        :return: response body
+        :raises ValueError: the response status is not 2xx
+        """
+        self._loop = asyncio.get_running_loop()
+        target = parseUrl(url)
+        key = (circuit_id, target.host, target.port)
+        connection = self._checkout(key)
+        if connection is not None:
+            try:
+                status, body, keep_alive = await asyncio.wait_for(connection.request(target), self.timeout)
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                # The server may have closed the idle connection, GET is safe to send again on a new one
+                self._close(connection)
+                connection = None
+        if connection is None:
+            connection = await asyncio.wait_for(self._open(circuit_id, target), self.timeout)
+            try:
+                status, body, keep_alive = await asyncio.wait_for(connection.request(target), self.timeout)
+            except asyncio.IncompleteReadError as ex:
+                self._close(connection)
+                raise ConnectionError("Connection closed before the response was complete") from ex
+            except BaseException:
+                self._close(connection)
+                raise
+
+        if keep_alive and len(self.idle[key]) < self.max_idle:
+            self.idle[key].append(connection)
+            self._scheduleEviction()
+        else:
+            self._close(connection)
+        checkStatus(status, url)
+        return body
+
+    def evictIdle(self) -> int:
+        """ Closes connections idle for longer than idle_timeout
+
+        :return: number of closed connections
+        """
+        now = time.monotonic()
+        expired = 0
+        for key in list(self.idle):
+            connections = self.idle[key]
+            for connection in connections:
+                if now - connection.last_used > self.idle_timeout:
+                    self._close(connection)
+                    expired += 1
+            connections[:] = [connection for connection in connections
+                              if now - connection.last_used <= self.idle_timeout]
+            if not connections:
+                del self.idle[key]
+        return expired
+
+    def closeCircuit(self, circuit_id: str) -> None:
+        """ Closes the idle connections of a circuit, e.g. once it was retired and takes no new requests. Called from
+        another thread, e.g. by the CircuitPool, the connections are closed on the pool's event loop """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._closeCircuit(circuit_id)
+            return
+        try:
+            loop.call_soon_threadsafe(self._closeCircuit, circuit_id)
+        except RuntimeError:
+            pass    # the loop closed meanwhile, and its connections with it
+
+    def close(self) -> None:
+        if self._eviction is not None:
+            self._eviction.cancel()
+            self._eviction = None
+        for connections in self.idle.values():
+            for connection in connections:
+                self._close(connection)
+        self.idle.clear()
+
+    # Private #
+    async def _open(self, circuit_id: str, target: Target) -> AsyncSocksConnection:
+        connection = await AsyncSocksConnection.open(self.socks_port)
+        self.stream_attacher.register(connection.source_port, circuit_id)
+        try:
+            await connection.connect(target)
+        except asyncio.IncompleteReadError as ex:
+            self._close(connection)
+            raise ConnectionError("SOCKS5 proxy closed the connection") from ex
+        except BaseException:
+            self._close(connection)
+            raise
+        return connection
+
+    def _checkout(self, key) -> Optional[AsyncSocksConnection]:
+        connections = self.idle.get(key)
+        while connections:
+            connection = connections.pop()
+            if time.monotonic() - connection.last_used <= self.idle_timeout:
+                return connection
+            self._close(connection)
+        return None
+
+    def _closeCircuit(self, circuit_id: str) -> None:
+        for key in [key for key in self.idle if key[0] == circuit_id]:
+            for connection in self.idle.pop(key):
+                self._close(connection)
+
+    def _scheduleEviction(self) -> None:
+        """ Sets the eviction timer for the connection expiring first, unless it is already set for an earlier one """
+        if self._eviction is not None or not self.idle:
+            return
+        oldest = min(connection.last_used for connections in self.idle.values() for connection in connections)
+        delay = max(0.0, oldest + self.idle_timeout - time.monotonic())
+        self._eviction = self._loop.call_later(delay, self._evictScheduled)
+
+    def _evictScheduled(self) -> None:
+        self._eviction = None
+        self.evictIdle()
+        self._scheduleEviction()
+
+    def _close(self, connection: AsyncSocksConnection) -> None:
+        self.stream_attacher.unregister(connection.source_port)
+        connection.close()
@@ -0,0 +1,246 @@
+import time
+from collections import deque
+from threading import Condition
+from typing import Callable, Deque, Dict, List, Optional
+
+from fastor.common import FastorObject
+from fastor.events.events import CIRCUIT_UPDATE
+from fastor.events.scheduler import Scheduler
+from fastor.scheme import Scheme
+from fastor.torHandler import CONNECTION_TIMEOUT, TorHandler
+
+POOL_SIZE = 4   # built circuits kept ready for requests
+MAX_PENDING = 4     # circuits being built at once, bounds the launches after a burst of failures
+CIRCUIT_MAX_AGE = 600   # seconds a circuit takes new requests, as tor's MaxCircuitDirtiness
+RETIRE_GRACE = 60   # seconds a retired circuit stays open for the requests still using it
+
+
+# CLASSES
+
+class PooledCircuit:
+    """ Circuit launched by a CircuitPool """
+    __slots__ = ('circuit_id', 'path', 'launched', 'built', 'retired')
+
+    def __init__(self, circuit_id: str, path: List[str]):
+        self.circuit_id = circuit_id
+        self.path = path
+        self.launched = time.monotonic()
+        self.built: Optional[float] = None      # monotonic time tor reported the circuit BUILT
+        self.retired: Optional[float] = None    # monotonic time the circuit stopped taking new requests
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.circuit_id})"
+
+    def age(self, now: Optional[float] = None) -> float:
+        return (now or time.monotonic()) - (self.built or self.launched)
+
+
+class CircuitPool(FastorObject):
+    def __init__(self, tor_handler: TorHandler, scheme: Scheme, size: int = POOL_SIZE, exit_port: Optional[int] = None,
+                 max_age: float = CIRCUIT_MAX_AGE, on_retire: Optional[Callable[[str], None]] = None):
+        """ Keeps size circuits chosen by the scheme built ahead of the requests that use them.
+
+        Circuits are launched without waiting for them and move to the ready set when tor reports them BUILT.
+        Requests take ready circuits round robin, so they never wait on a circuit build while the pool is warm.
+        Refilling and retiring runs on CIRCUIT_UPDATE events of the Scheduler, which the pool raises whenever it is
+        short of circuits or holds circuits older than max_age. Old circuits keep serving requests until a younger
+        circuit is ready, then stop taking requests and are closed RETIRE_GRACE seconds later.
+
+        :param tor_handler: connected TorHandler used to build circuits
+        :param scheme: scheme choosing the circuit paths
+        :param size: number of ready circuits to keep
+        :param exit_port: port the exits of the circuits must accept, None for any exit
+        :param max_age: seconds after which a circuit is replaced
+        :param on_retire: called with the id of every ready circuit that stops taking requests, because it was retired
+                          or tor closed it, e.g. to close the connections kept open on it
+        """
+        self.tor_handler = tor_handler
+        self.scheme = scheme
+        self.size = size
+        self.exit_port = exit_port
+        self.max_age = max_age
+        self.on_retire = on_retire
+
+        self.ready: Deque[PooledCircuit] = deque()
+        self.pending: Dict[str, PooledCircuit] = dict()     # circuit id: circuit being built
+        self.retiring: List[PooledCircuit] = list()
+        self._condition = Condition()
+        self._scheduler: Optional[Scheduler] = None
+        self._condition_id = None
+        self._listener_id = None
+
+    def __len__(self):
+        return len(self.ready)
+
+    # Public #
+    def start(self, scheduler: Scheduler) -> None:
+        """ Subscribes to circuit events and the scheduler, and starts filling the pool """
+        self._scheduler = scheduler
+        self.tor_handler.addEventListener(self._onCircuit, 'CIRC')
+        self._condition_id = scheduler.registerCondition(self.needsUpdate, CIRCUIT_UPDATE)
+        self._listener_id = scheduler.addListener(self.update, CIRCUIT_UPDATE)
+        self.update()
+
+    def stop(self) -> None:
+        """ Unsubscribes and closes every circuit of the pool """
+        if self._scheduler is not None:
+            self._scheduler.removeCondition(self._condition_id)
+            self._scheduler.removeListener(self._listener_id)
+            self._scheduler = None
+        self.tor_handler.removeEventListener(self._onCircuit)
+        with self._condition:
+            circuits = list(self.ready) + list(self.pending.values()) + self.retiring
+            self.ready.clear()
+            self.pending.clear()
+            self.retiring = list()
+            self._condition.notify_all()
+        for circuit in circuits:
+            self.tor_handler.closeCircuit(circuit.circuit_id)
+
+    def acquire(self, timeout: float = CONNECTION_TIMEOUT) -> PooledCircuit:
+        """ Returns a built circuit for a request, only waiting for a build when the pool is empty
+
+        :param timeout: seconds to wait for a circuit when none is ready
+        :return: ready circuit
+        :raises TimeoutError: no circuit was built in time
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not self.ready:
+                if self._scheduler is None:
+                    raise ValueError("The circuit pool is not running")
+                if not self.pending:
+                    self._launch(self.size)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No circuit was built within {timeout}s")
+                self._condition.wait(remaining)
+            return self._next()
+
+    def poll(self) -> Optional[PooledCircuit]:
+        """ Returns a built circuit for a request without launching builds or waiting, e.g. from an event loop
+
+        :return: ready circuit, None if no circuit is ready
+        """
+        with self._condition:
+            return self._next() if self.ready else None
+
+    def retire(self, circuit_id: str) -> None:
+        """ Stops handing out the circuit, e.g. after a request failed on it """
+        with self._condition:
+            for circuit in self.ready:
+                if circuit.circuit_id == circuit_id:
+                    self.ready.remove(circuit)
+                    self._retire(circuit, time.monotonic())
+                    break
+            else:
+                return
+        self._retired([circuit_id])
+
+    def retireWhere(self, predicate) -> int:
+        """ Retires the ready and pending circuits whose path matches predicate, e.g. relays that left the consensus
+
+        :param predicate: callable taking a path and returning True for circuits to retire
+        :return: number of retired circuits
+        """
+        now = time.monotonic()
+        with self._condition:
+            retired = [circuit for circuit in list(self.ready) + list(self.pending.values()) if predicate(circuit.path)]
+            for circuit in retired:
+                if circuit.circuit_id in self.pending:
+                    del self.pending[circuit.circuit_id]
+                else:
+                    self.ready.remove(circuit)
+                self._retire(circuit, now)
+        self._retired([circuit.circuit_id for circuit in retired])
+        return len(retired)
+
+    def needsUpdate(self) -> bool:
+        """ Condition of the CIRCUIT_UPDATE event: the pool is short of circuits, or has circuits to retire or close
+        """
+        now = time.monotonic()
+        with self._condition:
+            return len(self.ready) + len(self.pending) < self.size \
+                or any(circuit.age(now) > self.max_age for circuit in self.ready) \
+                or any(now - circuit.retired > RETIRE_GRACE for circuit in self.retiring)
+
+    def update(self) -> None:
+        """ Listener of the CIRCUIT_UPDATE event: launches builds to get back to size circuits younger than max_age,
+        retires the older ones once a younger one is ready, and closes retired circuits past their grace period """
+        now = time.monotonic()
+        aged = []
+        with self._condition:
+            fresh = [circuit for circuit in self.ready if circuit.age(now) <= self.max_age]
+            if fresh:
+                aged = [circuit for circuit in self.ready if circuit.age(now) > self.max_age]
+                for circuit in aged:
+                    self.ready.remove(circuit)
+                    self._retire(circuit, now)
+            expired = [circuit for circuit in self.retiring if now - circuit.retired > RETIRE_GRACE]
+            self.retiring = [circuit for circuit in self.retiring if now - circuit.retired <= RETIRE_GRACE]
+            self._launch(self.size - len(fresh) - len(self.pending))
+        self._retired([circuit.circuit_id for circuit in aged])
+        for circuit in expired:
+            self.tor_handler.closeCircuit(circuit.circuit_id)
+
+    # Private #
+    def _next(self) -> PooledCircuit:
+        """ Hands out the ready circuits round robin, holding the lock """
+        circuit = self.ready[0]
+        self.ready.rotate(-1)
+        return circuit
+
+    def _launch(self, count: int) -> None:
+        """ Launches up to count circuits. The lock is held across newCircuit, so that the CIRC events of a circuit
+        are only handled once it is pending. stem delivers events on its own thread, so this cannot deadlock """
+        for _ in range(min(count, MAX_PENDING - len(self.pending))):
+            try:
+                path = self.scheme.selectPath(self.exit_port)
+                circuit_id = self.tor_handler.newCircuit(path)
+            except Exception as ex:
+                self.warn(f"Could not launch a circuit: {ex}")
+                return
+            self.pending[circuit_id] = PooledCircuit(circuit_id, path)
+
+    def _retire(self, circuit: PooledCircuit, now: float) -> None:
+        circuit.retired = now
+        self.retiring.append(circuit)
+
+    def _retired(self, circuit_ids: List[str]) -> None:
+        """ Calls on_retire for the circuits, without holding the lock """
+        if self.on_retire is None:
+            return
+        for circuit_id in circuit_ids:
+            try:
+                self.on_retire(circuit_id)
+            except Exception as ex:
+                self.warn(f"Could not clean up after circuit {circuit_id}: {ex}")
+
+    def _onCircuit(self, event) -> None:
+        if event.status not in ('BUILT', 'FAILED', 'CLOSED'):
+            return
+        forgotten = False
+        with self._condition:
+            circuit = self.pending.pop(event.id, None)
+            if circuit is None:
+                forgotten = event.status != 'BUILT' and self._forget(event.id)
+            elif event.status == 'BUILT':
+                circuit.built = time.monotonic()
+                self.ready.append(circuit)
+                self._condition.notify_all()
+            else:
+                self.debug(f"Circuit {event.id} through {circuit.path} {event.status.lower()}")
+        if forgotten:
+            self._retired([event.id])
+
+    def _forget(self, circuit_id: str) -> bool:
+        """ Drops a circuit tor closed, holding the lock
+
+        :return: True if the circuit was ready
+        """
+        self.retiring = [circuit for circuit in self.retiring if circuit.circuit_id != circuit_id]
+        for circuit in self.ready:
+            if circuit.circuit_id == circuit_id:
+                self.ready.remove(circuit)
+                return True
+        return False
@@ -0,0 +1 @@
+from fastor.consensus.consensus import ConsensusRelay, ConsensusSnapshot, ConsensusCache
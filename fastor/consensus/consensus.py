@@ -0,0 +1,291 @@
+import base64
+import calendar
+import hashlib
+import json
+import os
+import time
+from types import SimpleNamespace
+from typing import Dict, List, NamedTuple, Optional
+
+from fastor.common import FastorObject
+
+try:
+    import stem.descriptor
+    import stem.descriptor.networkstatus
+except ImportError:
+    stem = None
+    print("Could not import stem")
+
+
+SNAPSHOT_FILE = "consensus.json"
+CACHED_CONSENSUS_FILE = "cached-consensus"   # name of the consensus file in tor's DataDirectory
+CONSENSUS_DESCRIPTOR_TYPE = "network-status-consensus-3 1.0"
+CACHED_MICRODESC_CONSENSUS_FILE = "cached-microdesc-consensus"  # consensus flavour cached by clients
+MICRODESC_CONSENSUS_DESCRIPTOR_TYPE = "network-status-microdesc-consensus-3 1.0"
+CACHED_MICRODESCS_FILES = ("cached-microdescs", "cached-microdescs.new")    # microdescriptors in the DataDirectory
+MICRODESCRIPTOR_TYPE = "microdescriptor 1.0"
+CONSENSUS_INTERVAL = 3600   # seconds between consensuses, assumed when tor only hands out router status entries
+REFRESH_RETRY_INTERVAL = 60  # seconds before retrying a refresh that did not produce a fresh consensus
+
+
+# UTILS
+
+def toEpoch(dt) -> float:
+    """ Converts a naive UTC datetime, as used by stem, to seconds since the epoch """
+    return float(calendar.timegm(dt.utctimetuple()))
+
+
+def microdescriptorDigest(descriptor) -> str:
+    """ Returns the digest a microdescriptor consensus refers to a microdescriptor by: unpadded base64 SHA256 """
+    return base64.b64encode(hashlib.sha256(str(descriptor).encode()).digest()).decode().rstrip('=')
+
+
+# CLASSES
+
+class ConsensusRelay(NamedTuple):
+    """ Compact consensus entry of a single relay """
+    fingerprint: str
+    nickname: str
+    address: str
+    or_port: int
+    flags: List[str]
+    bandwidth: int
+    exit_policy: str    # microdescriptor exit policy summary, e.g. 'accept 80,443'
+    family: Optional[List[str]] = None  # family line of the relay's microdescriptor, None if unknown or empty
+
+
+class ConsensusSnapshot(FastorObject):
+    def __init__(self, valid_after: float, fresh_until: float, valid_until: float, relays: List[ConsensusRelay],
+                 bandwidth_weights: Optional[Dict[str, int]] = None):
+        """ Parsed consensus, reduced to what fastor needs and serializable to a compact JSON snapshot
+
+        :param valid_after: start of the consensus validity (seconds since the epoch)
+        :param fresh_until: time the next consensus is published (seconds since the epoch)
+        :param valid_until: end of the consensus validity (seconds since the epoch)
+        :param relays: relay entries in consensus order
+        :param bandwidth_weights: position weights of the consensus footer (Wgg, Wmd, ...)
+        """
+        self.valid_after = valid_after
+        self.fresh_until = fresh_until
+        self.valid_until = valid_until
+        self.relays = relays
+        self.bandwidth_weights = bandwidth_weights or dict()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(valid_after={self.valid_after}, relays={len(self.relays)})"
+
+    def __len__(self):
+        return len(self.relays)
+
+    def fingerprints(self) -> List[str]:
+        return [relay.fingerprint for relay in self.relays]
+
+    def weights(self) -> Dict[str, int]:
+        """ Returns the consensus weight of every relay, keyed by fingerprint in consensus order """
+        return {relay.fingerprint: relay.bandwidth for relay in self.relays}
+
+    def families(self) -> Dict[str, List[str]]:
+        """ Returns the declared family of every relay that has one, keyed by fingerprint """
+        return {relay.fingerprint: relay.family for relay in self.relays if relay.family}
+
+    def isFresh(self, now: Optional[float] = None) -> bool:
+        """ Returns True until the next consensus is due, after which tor will have fetched a newer one """
+        return (now or time.time()) < self.fresh_until
+
+    def isValid(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) < self.valid_until
+
+    # Serialization
+    def toDict(self) -> dict:
+        return {'valid_after': self.valid_after,
+                'fresh_until': self.fresh_until,
+                'valid_until': self.valid_until,
+                'bandwidth_weights': self.bandwidth_weights,
+                'relays': [list(relay) for relay in self.relays]
+                }
+
+    @staticmethod
+    def fromDict(d: dict) -> 'ConsensusSnapshot':
+        relays = [ConsensusRelay(*row) for row in d['relays']]
+        return ConsensusSnapshot(d['valid_after'], d['fresh_until'], d['valid_until'], relays,
+                                 d.get('bandwidth_weights'))
+
+    @staticmethod
+    def fromDocument(document, valid_after: Optional[float] = None, fresh_until: Optional[float] = None,
+                     valid_until: Optional[float] = None,
+                     families: Optional[Dict[str, List[str]]] = None) -> 'ConsensusSnapshot':
+        """ Builds a snapshot from a stem NetworkStatusDocumentV3, optionally overriding its validity times
+
+        :param families: declared families keyed by microdescriptor digest. Only entries of a microdescriptor
+                         consensus refer to a microdescriptor, so other relays get no family
+        """
+        families = families or dict()
+        relays = []
+        for entry in document.routers.values():
+            exit_policy = str(entry.exit_policy) if entry.exit_policy is not None else 'reject 1-65535'
+            digest = getattr(entry, 'microdescriptor_digest', None)
+            family = families.get(digest.rstrip('=')) if digest else None
+            relays.append(ConsensusRelay(entry.fingerprint, entry.nickname, entry.address, entry.or_port,
+                                         sorted(entry.flags), entry.bandwidth or 0, exit_policy,
+                                         sorted(family) if family else None))
+        if valid_after is None:
+            valid_after = toEpoch(document.valid_after)
+            fresh_until = toEpoch(document.fresh_until)
+            valid_until = toEpoch(document.valid_until)
+        return ConsensusSnapshot(valid_after, fresh_until, valid_until, relays, dict(document.bandwidth_weights))
+
+    def save(self, path: str) -> None:
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.toDict(), file, separators=(',', ':'))
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def load(path: str) -> 'ConsensusSnapshot':
+        with open(path) as file:
+            return ConsensusSnapshot.fromDict(json.load(file))
+
+
+class ConsensusCache(FastorObject):
+    def __init__(self, snapshot_file: str = SNAPSHOT_FILE, cached_consensus_file: Optional[str] = None):
+        """ Keeps the current consensus as a ConsensusSnapshot persisted to snapshot_file.
+
+        The consensus is only parsed again once the snapshot is no longer fresh. It is read from tor's
+        cached-consensus or cached-microdesc-consensus file when one is available, and over the control port
+        otherwise. As a last resort the router status entries of the control port are used, with validity times
+        assumed from CONSENSUS_INTERVAL. Relay families come from the microdescriptors tor cached next to the
+        consensus, or from the control port, and are matched to the entries of a microdescriptor consensus.
+
+        :param snapshot_file: path of the persisted snapshot
+        :param cached_consensus_file: path of tor's cached-consensus, by default looked up through the controller.
+                                      The other cached files are looked up in its directory
+        """
+        self.snapshot_file = snapshot_file
+        self.cached_consensus_file = cached_consensus_file
+        self.snapshot: Optional[ConsensusSnapshot] = None
+        self._next_refresh = 0.0
+
+    # Public #
+    def get(self, controller=None) -> ConsensusSnapshot:
+        """ Returns a fresh consensus snapshot, refreshing it from tor only if the current one has expired
+
+        :param controller: authenticated stem controller used to locate or fetch the consensus
+        :return: current ConsensusSnapshot
+        """
+        if self.snapshot is None:
+            self.snapshot = self._loadSnapshot()
+        now = time.time()
+        if self.snapshot is None or (not self.snapshot.isFresh(now) and now >= self._next_refresh):
+            self._next_refresh = now + REFRESH_RETRY_INTERVAL
+            self.refresh(controller)
+        return self.snapshot
+
+    def refresh(self, controller=None) -> ConsensusSnapshot:
+        """ Parses the latest consensus from tor and persists it, keeping the current snapshot on failure
+
+        :param controller: authenticated stem controller
+        :return: current ConsensusSnapshot
+        """
+        families = self._readFamilies(controller)
+        snapshot = self._readCachedConsensus(controller, families)
+        if snapshot is None and controller is not None:
+            snapshot = self._readControlPort(controller, families) or \
+                self._readNetworkStatuses(controller, families)
+        if snapshot is None:
+            if self.snapshot is None:
+                raise ValueError("No consensus could be read from tor")
+            self.warn("Could not read a newer consensus, keeping the current snapshot")
+            return self.snapshot
+
+        if self.snapshot is None or snapshot.valid_after >= self.snapshot.valid_after:
+            self.snapshot = snapshot
+            try:
+                snapshot.save(self.snapshot_file)
+            except OSError as ex:
+                self.error(f"Could not save consensus snapshot to {self.snapshot_file}: {ex}")
+            self.info(f"Loaded consensus valid after {snapshot.valid_after} with {len(snapshot)} relays")
+        return self.snapshot
+
+    # Private #
+    def _loadSnapshot(self) -> Optional[ConsensusSnapshot]:
+        try:
+            snapshot = ConsensusSnapshot.load(self.snapshot_file)
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as ex:
+            self.warn(f"Ignoring unreadable consensus snapshot {self.snapshot_file}: {ex}")
+            return None
+        return snapshot if snapshot.isValid() else None
+
+    def _dataDirectory(self, controller) -> Optional[str]:
+        """ Returns the directory tor caches its consensus and descriptors in """
+        if self.cached_consensus_file is not None:
+            return os.path.dirname(self.cached_consensus_file)
+        if controller is None:
+            return None
+        try:
+            return controller.get_conf('DataDirectory')
+        except Exception:
+            return None
+
+    def _readCachedConsensus(self, controller, families=None):
+        directory = self._dataDirectory(controller)
+        if directory is None:
+            return None
+        candidates = [(self.cached_consensus_file or os.path.join(directory, CACHED_CONSENSUS_FILE),
+                       CONSENSUS_DESCRIPTOR_TYPE),
+                      (os.path.join(directory, CACHED_MICRODESC_CONSENSUS_FILE), MICRODESC_CONSENSUS_DESCRIPTOR_TYPE)]
+        for path, descriptor_type in candidates:
+            if not os.path.exists(path):
+                continue
+            try:
+                document = next(stem.descriptor.parse_file(path, descriptor_type=descriptor_type,
+                                                           document_handler=stem.descriptor.DocumentHandler.DOCUMENT))
+                return ConsensusSnapshot.fromDocument(document, families=families)
+            except Exception as ex:
+                self.warn(f"Could not parse {path}: {ex}")
+        return None
+
+    def _readFamilies(self, controller) -> Dict[str, List[str]]:
+        """ Returns the declared family of every microdescriptor that has one, keyed by microdescriptor digest. Read
+        from tor's cached microdescriptors, or over the control port when there are none """
+        if stem is None:
+            return dict()
+        descriptors = []
+        directory = self._dataDirectory(controller)
+        for name in CACHED_MICRODESCS_FILES if directory is not None else ():
+            path = os.path.join(directory, name)
+            if not os.path.exists(path):
+                continue
+            try:
+                descriptors.extend(stem.descriptor.parse_file(path, descriptor_type=MICRODESCRIPTOR_TYPE))
+            except Exception as ex:
+                self.warn(f"Could not parse {path}: {ex}")
+        if not descriptors and controller is not None:
+            try:
+                descriptors = list(controller.get_microdescriptors())
+            except Exception as ex:
+                self.warn(f"Could not fetch microdescriptors over the control port, relay families are unknown: {ex}")
+        return {microdescriptorDigest(descriptor): list(descriptor.family)
+                for descriptor in descriptors if descriptor.family}
+
+    def _readControlPort(self, controller, families=None):
+        try:
+            content = controller.get_info('dir/status-vote/current/consensus')
+            document = stem.descriptor.networkstatus.NetworkStatusDocumentV3(content)
+            return ConsensusSnapshot.fromDocument(document, families=families)
+        except Exception as ex:
+            self.warn(f"Could not fetch the consensus over the control port: {ex}")
+            return None
+
+    def _readNetworkStatuses(self, controller, families=None):
+        try:
+            entries = list(controller.get_network_statuses())
+        except Exception as ex:
+            self.error(f"Could not fetch router status entries over the control port: {ex}")
+            return None
+        now = time.time()
+        valid_after = now - now % CONSENSUS_INTERVAL
+        document = SimpleNamespace(routers={entry.fingerprint: entry for entry in entries}, bandwidth_weights={})
+        return ConsensusSnapshot.fromDocument(document, valid_after, valid_after + CONSENSUS_INTERVAL,
+                                              valid_after + 3 * CONSENSUS_INTERVAL, families)
@@ -6,4 +6,5 @@
 # Scheme-handled events
 CONSENSUS_EXPIRED = "CONSENSUS_EXPIRED"
 CIRCUIT_UPDATE = "CIRCUIT_UPDATE"
+CONNECTIONS_IDLE = "CONNECTIONS_IDLE"
 
@@ -144,7 +144,7 @@ class Schedule(FastorObject):
         :param condition_id: Unique condition id.
         :return:
         """
-        self.condition_id_map.pop(condition_id)
+        self.condition_id_map.pop(condition_id, None)
         self._updateConditions()
 
     def addListener(self, listener: Callable[[Any], None], event_type: str, args: list) -> int:
@@ -169,7 +169,7 @@ class Schedule(FastorObject):
         :param listener_id: unique id.
         :return:
         """
-        self.listener_id_map.pop(listener_id)
+        self.listener_id_map.pop(listener_id, None)
 
     def getAllConditions(self) -> Dict[str, List[ArgCallable]]:
         """ Returns a dictionary containing all events and every condition associated with them.
@@ -185,7 +185,7 @@ class Schedule(FastorObject):
         :return: List with condition callables.
         """
         return [self.condition_id_map[uid] for uid in self.event_condition_ids[event_type]
-                if self.condition_id_map[uid]]
+                if self.condition_id_map.get(uid)]
 
     def getEventListeners(self, event_type) -> List[ArgCallable]:
         """ Returns a list of listener associated with the given event.
@@ -194,12 +194,13 @@ class Schedule(FastorObject):
         :return: List with listener callables.
         """
         return [self.listener_id_map[uid] for uid in self.event_listener_ids[event_type]
-                if self.listener_id_map[uid]]
+                if self.listener_id_map.get(uid)]
 
     # Private #
     def _updateConditions(self) -> None:
         """ Caches live conditions for faster accessing """
-        self.live_conditions = {event_type: [self.condition_id_map[uid] for uid in uids if self.condition_id_map[uid]]
+        self.live_conditions = {event_type: [self.condition_id_map[uid] for uid in uids
+                                             if self.condition_id_map.get(uid)]
                                 for event_type, uids in self.event_condition_ids.items()}
 
 
@@ -1,5 +1,5 @@
 import time
-from collections import Callable
+from typing import Callable
 from threading import Timer, Thread, Event
 
 
@@ -0,0 +1,2 @@
+from fastor.scheme.scheme import Scheme, VanillaScheme, FastorScheme, GUARD, MIDDLE, EXIT
+from fastor.scheme.table import RelayTable
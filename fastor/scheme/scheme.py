@@ -1,10 +1,238 @@
+import json
+import random
+import statistics
+from threading import Lock
+from typing import Dict, Iterable, List, Optional
+
 from fastor.common import FastorObject
+from fastor.consensus import ConsensusSnapshot
+from fastor.scheme.table import FLAG_BITS, RelayTable
+from fastor.scheme.utils import BlockedAliasSampler
+
+GUARD = 'guard'
+MIDDLE = 'middle'
+EXIT = 'exit'
+POSITIONS = (GUARD, MIDDLE, EXIT)
+
+BANDWIDTH_WEIGHT_SCALE = 10000  # consensus bandwidth weights are fractions of this, and default to it when missing
+REQUIRED_FLAGS = FLAG_BITS['Running'] | FLAG_BITS['Valid'] | FLAG_BITS['Fast']  # needed on general purpose circuits
+MAX_PATH_ATTEMPTS = 64  # draws of a hop before giving up on a relay not conflicting with the rest of the path
+
+SCORE_EXPONENT = 1.0    # how strongly FastorScheme favours relays with a low TTLB score
+MIN_SCORE_FACTOR = 0.05     # bounds of the factor a score multiplies a relay's position weight by
+MAX_SCORE_FACTOR = 20.0
+
+
+# UTILS
+
+def positionWeight(flags: int, bandwidth: float, position: str, bandwidth_weights: Dict[str, int]) -> float:
+    """ Consensus weight of a relay in the given path position, scaled by the position weights of the consensus
+    footer as in Tor's path selection. Relays which cannot take the position weigh 0.
+
+    :param flags: FLAG_BITS bitset of the relay
+    :param bandwidth: consensus weight of the relay
+    :param position: GUARD, MIDDLE or EXIT
+    :param bandwidth_weights: Wgg, Wgd, Wmg, ... from the consensus footer
+    :return: weighted bandwidth
+    """
+    if flags & REQUIRED_FLAGS != REQUIRED_FLAGS:
+        return 0.0
+    guard = bool(flags & FLAG_BITS['Guard'])
+    exit_ = bool(flags & FLAG_BITS['Exit']) and not flags & FLAG_BITS['BadExit']
+    if position == GUARD:
+        if not guard:
+            return 0.0
+        key = 'Wgd' if exit_ else 'Wgg'
+    elif position == EXIT:
+        if not exit_:
+            return 0.0
+        key = 'Wed' if guard else 'Wee'
+    else:
+        key = ('Wmd' if exit_ else 'Wmg') if guard else ('Wme' if exit_ else 'Wmm')
+    return bandwidth * bandwidth_weights.get(key, BANDWIDTH_WEIGHT_SCALE) / BANDWIDTH_WEIGHT_SCALE
 
 
+# CLASSES
+
 class Scheme(FastorObject):
-    """ Defines a Tor client scheme for selecting relays """
-    pass
+    def __init__(self, rng: Optional[random.Random] = None):
+        """ Defines a Tor client scheme for selecting relays.
+
+        The consensus is held in a RelayTable. Relays are drawn for each path position from a BlockedAliasSampler
+        over the table rows, weighted by position weight, so that choosing a hop takes O(1) however large the
+        consensus is. Family and /16 constraints are enforced by redrawing, and exits for a port come from a sampler
+        over the exits accepting it. Families are those the relays declare mutually in the microdescriptors of the
+        snapshot, relays without a known family only conflicting through their /16. Subclasses bias the choice through
+        relayFactor.
+
+        :param rng: random number generator used for path selection
+        """
+        self.rng = rng or random.Random()
+        self.snapshot: Optional[ConsensusSnapshot] = None
+        self.table: Optional[RelayTable] = None
+        self.samplers: Dict[str, BlockedAliasSampler] = dict()      # position: sampler over the rows of its relays
+        self.exit_samplers: Dict[int, BlockedAliasSampler] = dict()     # port: sampler over the exits accepting it
+        self._lock = Lock()
+
+    # Public #
+    def updateConsensus(self, snapshot: ConsensusSnapshot) -> None:
+        """ Rebuilds the sampling tables for a new consensus. Does nothing if the snapshot is already in use """
+        with self._lock:
+            if snapshot is self.snapshot:
+                return
+            self.snapshot = snapshot
+            self.table = RelayTable(snapshot)
+            self.table.setFamilies(snapshot.families())
+            self._consensusChanged()
+            self.samplers = {position: self._buildSampler(position) for position in POSITIONS}
+            self.exit_samplers = dict()
+        self.info(f"Built sampling tables over {len(self.table)} relays "
+                  f"({', '.join(f'{len(s)} {p}s' for p, s in self.samplers.items())})")
+
+    def selectRelay(self, position: str, exclude: Iterable[str] = (), port: Optional[int] = None) -> str:
+        """ Draws a relay for the position that may share a circuit with the excluded relays
+
+        :param position: GUARD, MIDDLE or EXIT
+        :param exclude: fingerprints of the relays already on the path
+        :param port: for EXIT, port the exit policy must accept
+        :return: relay fingerprint
+        """
+        with self._lock:
+            if self.table is None:
+                raise ValueError("No consensus has been loaded")
+            path = [self.table.rows[fingerprint] for fingerprint in exclude if fingerprint in self.table]
+            return self.table.fingerprints[self._selectRow(position, path, port)]
+
+    def selectPath(self, port: Optional[int] = None) -> List[str]:
+        """ Chooses the relays of a 3-hop circuit, exit first as Tor does. No two relays share a family or /16
+
+        :param port: port the exit must accept connections to
+        :return: [guard, middle, exit] fingerprints
+        """
+        with self._lock:
+            if self.table is None:
+                raise ValueError("No consensus has been loaded")
+            exit_ = self._selectRow(EXIT, [], port)
+            guard = self._selectRow(GUARD, [exit_])
+            middle = self._selectRow(MIDDLE, [guard, exit_])
+            fingerprints = self.table.fingerprints
+            return [fingerprints[guard], fingerprints[middle], fingerprints[exit_]]
+
+    def relayFactor(self, row: int) -> float:
+        """ Multiplier of the position weights of the relay in the given table row, 1 in vanilla Tor """
+        return 1.0
+
+    # Protected #
+    def _consensusChanged(self) -> None:
+        """ Hook called with the lock held after a new consensus is loaded, before the samplers are rebuilt """
+        pass
+
+    def _selectRow(self, position: str, path: List[int], port: Optional[int] = None) -> int:
+        sampler = self.samplers[position] if port is None or position != EXIT else self._exitSampler(port)
+        for _ in range(MAX_PATH_ATTEMPTS):
+            row = sampler.sample(self.rng)
+            if row is None:
+                break
+            if not self.table.conflictsWithAny(row, path):
+                return row
+        raise ValueError(f"Could not find a {position} relay" + (f" for port {port}" if port is not None else ""))
+
+    def _buildSampler(self, position: str, rows: Optional[int] = None) -> BlockedAliasSampler:
+        """ Builds the sampler of a position over all relays, or over the rows set in the given bitset """
+        table = self.table
+        keys, weights = [], []
+        for row in range(len(table)):
+            if rows is not None and not (rows >> row) & 1:
+                continue
+            weight = positionWeight(table.flags[row], table.bandwidth[row], position, table.bandwidth_weights)
+            if weight > 0:
+                keys.append(row)
+                weights.append(weight * self.relayFactor(row))
+        return BlockedAliasSampler(keys, weights)
+
+    def _exitSampler(self, port: int) -> BlockedAliasSampler:
+        sampler = self.exit_samplers.get(port)
+        if sampler is None:
+            sampler = self.exit_samplers[port] = self._buildSampler(EXIT, self.table.exitsFor(port))
+        return sampler
+
+    def _reweight(self, rows: Iterable[int]) -> None:
+        """ Updates the sampling weights of the given rows after their relayFactor changed. Only the blocks holding
+        them are rebuilt, on the next draw """
+        table = self.table
+        if table is None:
+            return
+        samplers = [(position, sampler) for position, sampler in self.samplers.items()]
+        samplers += [(EXIT, sampler) for sampler in self.exit_samplers.values()]
+        for row in rows:
+            factor = self.relayFactor(row)
+            for position, sampler in samplers:
+                if row in sampler:
+                    weight = positionWeight(table.flags[row], table.bandwidth[row], position, table.bandwidth_weights)
+                    sampler.update(row, weight * factor)
 
 
 class VanillaScheme(Scheme):
     """ Tor vanilla scheme """
+
+
+class FastorScheme(Scheme):
+    def __init__(self, scores: Optional[Dict[str, float]] = None, score_exponent: float = SCORE_EXPONENT,
+                 rng: Optional[random.Random] = None):
+        """ Scheme favouring relays with a low measured TTLB.
+
+        A relay's position weights are multiplied by (reference / score) ** score_exponent, where the reference is
+        the median score, so unmeasured relays keep their vanilla weight. Scores are kept across consensuses and
+        copied into the score column of every new RelayTable. The reference is only recomputed when the consensus
+        changes, so that new scores of a few relays only rebuild the blocks holding them.
+
+        :param scores: TTLB score of every measured relay in seconds, as exported by the data collection analytics
+        :param score_exponent: 0 reproduces vanilla Tor, larger values prefer fast relays more strongly
+        :param rng: random number generator used for path selection
+        """
+        super().__init__(rng)
+        self.scores: Dict[str, float] = dict(scores or {})
+        self.score_exponent = score_exponent
+        self.reference: Optional[float] = None
+
+    def loadScores(self, path: str) -> None:
+        """ Loads relay scores from a JSON file mapping fingerprints to TTLB seconds """
+        with open(path) as file:
+            scores = json.load(file)
+        self.updateScores(scores, replace=True)
+        self.info(f"Loaded {len(scores)} relay scores from {path}")
+
+    def updateScores(self, scores: Dict[str, float], replace: bool = False) -> None:
+        """ Sets the scores of the given relays and reweights only them
+
+        :param scores: fingerprint: TTLB seconds
+        :param replace: drop the scores of relays missing from scores
+        """
+        with self._lock:
+            updates = dict(scores)
+            if replace:
+                updates.update({fingerprint: None for fingerprint in self.scores if fingerprint not in scores})
+                self.scores = dict(scores)
+            else:
+                self.scores.update(scores)
+            if self.table is None:
+                return
+            changed = self.table.setScores(updates)
+            if self.reference is None:
+                self._updateReference()
+                changed = range(len(self.table))
+            self._reweight(changed)
+
+    def relayFactor(self, row: int) -> float:
+        score = self.table.getScore(row)
+        if score is None or score <= 0 or self.reference is None:
+            return 1.0
+        return min(max((self.reference / score) ** self.score_exponent, MIN_SCORE_FACTOR), MAX_SCORE_FACTOR)
+
+    def _consensusChanged(self) -> None:
+        self.table.setScores(self.scores)
+        self._updateReference()
+
+    def _updateReference(self) -> None:
+        scores = [score for score in self.table.score if score > 0]   # nan compares False, so unmeasured are skipped
+        self.reference = statistics.median(scores) if scores else None
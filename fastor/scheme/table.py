@@ -0,0 +1,203 @@
+import math
+import socket
+import struct
+import sys
+from array import array
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastor.common import FastorObject
+from fastor.consensus import ConsensusSnapshot
+
+# Known relay flags, in bit order. Flags missing from this list get the next free bits of a table
+FLAG_NAMES = ('Authority', 'BadExit', 'Exit', 'Fast', 'Guard', 'HSDir', 'MiddleOnly', 'NoEdConsensus', 'Running',
+              'Stable', 'StaleDesc', 'Sybil', 'V2Dir', 'Valid')
+FLAG_BITS = {name: 1 << bit for bit, name in enumerate(FLAG_NAMES)}
+INDEXED_EXIT_PORTS = (80, 443)  # exit ports indexed when the table is built, other ports are indexed on first use
+NO_SUBNET = -1
+
+
+# UTILS
+
+def parsePolicySummary(summary: str) -> Tuple[bool, List[Tuple[int, int]]]:
+    """ Parses a microdescriptor exit policy summary such as 'accept 80,443,6660-6669'
+
+    :param summary: policy summary of the consensus
+    :return: whether the listed ports are accepted, and the listed port ranges
+    """
+    action, _, ports = summary.strip().partition(' ')
+    ranges = []
+    for item in ports.split(','):
+        if not item:
+            continue
+        low, _, high = item.partition('-')
+        ranges.append((int(low), int(high or low)))
+    return action == 'accept', ranges
+
+
+def bitset(rows: Iterable[int]) -> int:
+    """ Packs row numbers into an integer with those bits set """
+    bits = bytearray()
+    for row in rows:
+        byte = row >> 3
+        if byte >= len(bits):
+            bits.extend(bytes(byte + 1 - len(bits)))
+        bits[byte] |= 1 << (row & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def subnetOf(address: str) -> int:
+    """ Returns the /16 prefix of an IPv4 address as an integer, or NO_SUBNET if it is not one """
+    try:
+        return struct.unpack('!I', socket.inet_aton(address))[0] >> 16
+    except (OSError, TypeError):
+        return NO_SUBNET
+
+
+# CLASSES
+
+class RelayTable(FastorObject):
+    def __init__(self, snapshot: ConsensusSnapshot):
+        """ Column-oriented view of a consensus for path selection.
+
+        Relays are addressed by row number. Fingerprints are interned once, flags are packed into an integer bitset
+        per row and bandwidth, score, /16 subnet, family and exit policy live in typed arrays. Sets of rows, such as
+        the relays with a flag or the exits allowing a port, are Python integers used as bitsets, so they are
+        combined with & and | and tested with (rows >> row) & 1.
+
+        :param snapshot: consensus to index
+        """
+        relays = snapshot.relays
+        self.valid_after = snapshot.valid_after
+        self.bandwidth_weights = snapshot.bandwidth_weights
+        self.fingerprints: List[str] = [sys.intern(relay.fingerprint) for relay in relays]
+        self.rows: Dict[str, int] = {fingerprint: row for row, fingerprint in enumerate(self.fingerprints)}
+        self.flag_bits: Dict[str, int] = dict(FLAG_BITS)
+
+        self.flags = array('Q')             # bitset of FLAG_BITS
+        self.bandwidth = array('d')         # consensus weight
+        self.score = array('d', [math.nan]) * len(relays)  # TTLB score, nan if unmeasured
+        self.subnet = array('i')            # /16 prefix, NO_SUBNET if unknown
+        self.family = array('i', range(len(relays)))    # family id, the lowest row of the family
+        self.policy = array('H')            # id into policies
+
+        self.policies: List[Tuple[bool, List[Tuple[int, int]]]] = list()
+        policy_ids: Dict[str, int] = dict()
+        flag_rows: Dict[str, List[int]] = defaultdict(list)
+        self.by_flag: Dict[str, int] = dict()                       # flag: rows
+        self.by_subnet: Dict[int, List[int]] = defaultdict(list)    # /16 prefix: rows
+        self.by_family: Dict[int, List[int]] = dict()               # family id: rows, for families of 2 or more
+        self.by_exit_port: Dict[int, int] = dict()                  # port: exit rows whose policy accepts it
+
+        for row, relay in enumerate(relays):
+            bits = 0
+            for flag in relay.flags:
+                bit = self.flag_bits.get(flag)
+                if bit is None:
+                    bit = self.flag_bits[flag] = 1 << len(self.flag_bits)
+                bits |= bit
+                flag_rows[flag].append(row)
+            self.flags.append(bits)
+            self.bandwidth.append(relay.bandwidth)
+            subnet = subnetOf(relay.address)
+            self.subnet.append(subnet)
+            if subnet != NO_SUBNET:
+                self.by_subnet[subnet].append(row)
+            policy_id = policy_ids.get(relay.exit_policy)
+            if policy_id is None:
+                policy_id = policy_ids[relay.exit_policy] = len(self.policies)
+                self.policies.append(parsePolicySummary(relay.exit_policy))
+            self.policy.append(policy_id)
+        self.by_flag = {flag: bitset(rows) for flag, rows in flag_rows.items()}
+
+        for port in INDEXED_EXIT_PORTS:
+            self.exitsFor(port)
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.rows
+
+    # Lookups #
+    def hasFlag(self, row: int, flag: str) -> bool:
+        return bool(self.flags[row] & self.flag_bits.get(flag, 0))
+
+    def rowsWith(self, *flags: str) -> int:
+        """ Returns the bitset of rows having all the flags """
+        rows = (1 << len(self)) - 1
+        for flag in flags:
+            rows &= self.by_flag.get(flag, 0)
+        return rows
+
+    def exitsFor(self, port: int) -> int:
+        """ Returns the bitset of rows with the Exit flag whose policy accepts the port, indexing it on first use """
+        rows = self.by_exit_port.get(port)
+        if rows is None:
+            accepting = [accept == any(low <= port <= high for low, high in ranges) for accept, ranges in self.policies]
+            rows = bitset(row for row, policy_id in enumerate(self.policy) if accepting[policy_id])
+            rows &= self.by_flag.get('Exit', 0)
+            self.by_exit_port[port] = rows
+        return rows
+
+    def allowsPort(self, row: int, port: int) -> bool:
+        return bool((self.exitsFor(port) >> row) & 1)
+
+    def conflicts(self, row: int, other: int) -> bool:
+        """ Returns True if the two relays may not share a circuit: they are the same relay, share a /16 subnet or
+        belong to the same family """
+        return row == other or self.family[row] == self.family[other] or \
+            (self.subnet[row] != NO_SUBNET and self.subnet[row] == self.subnet[other])
+
+    def conflictsWithAny(self, row: int, path: Iterable[int]) -> bool:
+        return any(self.conflicts(row, other) for other in path)
+
+    # Updates #
+    def setFamilies(self, declared: Dict[str, Iterable[str]]) -> None:
+        """ Groups relays into families. As in Tor, two relays are in the same family only if each declares the other
+
+        :param declared: fingerprint: fingerprints listed in the relay's family line, e.g. from its microdescriptor
+        """
+        parent = list(range(len(self)))
+
+        def find(row):
+            while parent[row] != row:
+                parent[row] = parent[parent[row]]
+                row = parent[row]
+            return row
+
+        declared_rows = {self.rows[fingerprint]: {self.rows[member.lstrip('$').upper()] for member in members
+                                                  if member.lstrip('$').upper() in self.rows}
+                         for fingerprint, members in declared.items() if fingerprint in self.rows}
+        for row, members in declared_rows.items():
+            for member in members:
+                if row in declared_rows.get(member, ()):
+                    root, other = find(row), find(member)
+                    parent[max(root, other)] = min(root, other)
+
+        self.by_family = dict()
+        for row in range(len(self)):
+            family = self.family[row] = find(row)
+            if family != row:
+                self.by_family.setdefault(family, [family]).append(row)
+
+    def setScores(self, scores: Dict[str, float]) -> List[int]:
+        """ Sets the score column for the given fingerprints, nan clearing a score
+
+        :return: rows whose score changed
+        """
+        changed = []
+        for fingerprint, score in scores.items():
+            row = self.rows.get(fingerprint)
+            if row is None:
+                continue
+            score = math.nan if score is None else float(score)
+            current = self.score[row]
+            if current != score and not (math.isnan(current) and math.isnan(score)):
+                self.score[row] = score
+                changed.append(row)
+        return changed
+
+    def getScore(self, row: int) -> Optional[float]:
+        score = self.score[row]
+        return None if math.isnan(score) else score
@@ -0,0 +1,104 @@
+import random
+from typing import Dict, Hashable, List, Optional, Sequence
+
+ALIAS_BLOCK_SIZE = 256  # keys per alias table of a BlockedAliasSampler, bounds the cost of an incremental rebuild
+
+
+class AliasTable:
+    """ Vose's alias method: after an O(n) build, samples an index with probability proportional to its weight in
+    O(1) using a single random number """
+    __slots__ = ('probabilities', 'aliases', 'total')
+
+    def __init__(self, weights: Sequence[float]):
+        n = len(weights)
+        self.total = float(sum(weights))
+        self.probabilities = [1.0] * n
+        self.aliases = list(range(n))
+        if self.total <= 0:
+            return
+
+        scaled = [weight * n / self.total for weight in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # Whatever is left is 1 up to rounding errors
+        for i in small + large:
+            self.probabilities[i] = 1.0
+
+    def __len__(self):
+        return len(self.probabilities)
+
+    def sample(self, rng: random.Random = random) -> Optional[int]:
+        """ Returns a random index, or None if all weights are zero """
+        if self.total <= 0:
+            return None
+        u = rng.random() * len(self.probabilities)
+        i = int(u)
+        return i if u - i < self.probabilities[i] else self.aliases[i]
+
+
+class BlockedAliasSampler:
+    def __init__(self, keys: Sequence[Hashable], weights: Sequence[float], block_size: int = ALIAS_BLOCK_SIZE):
+        """ Weighted sampling of keys in O(1), with cheap weight updates.
+
+        Keys are split into blocks of block_size, each with its own AliasTable, and a top-level AliasTable picks a
+        block by its total weight. Changing a weight marks its block dirty. Dirty blocks and the top-level table are
+        rebuilt on the next sample, so a batch of updates costs O(block_size) per touched block plus O(blocks),
+        instead of a rebuild over every key.
+
+        :param keys: keys to sample, e.g. relay fingerprints
+        :param weights: non-negative weight of every key
+        :param block_size: keys per block
+        """
+        self.keys: List[Hashable] = list(keys)
+        self.weights: List[float] = [float(weight) for weight in weights]
+        self.block_size = block_size
+        self.positions: Dict[Hashable, int] = {key: i for i, key in enumerate(self.keys)}
+        self.blocks: List[AliasTable] = [AliasTable(self.weights[start:start + block_size])
+                                         for start in range(0, len(self.keys), block_size)]
+        self.top = AliasTable([block.total for block in self.blocks])
+        self._dirty = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    @property
+    def total(self) -> float:
+        self._rebuild()
+        return self.top.total
+
+    def weight(self, key: Hashable) -> float:
+        return self.weights[self.positions[key]]
+
+    def update(self, key: Hashable, weight: float) -> None:
+        """ Changes the weight of a key. Unknown keys are ignored, since the key set is fixed at construction """
+        position = self.positions.get(key)
+        if position is None or self.weights[position] == weight:
+            return
+        self.weights[position] = float(weight)
+        self._dirty.add(position // self.block_size)
+
+    def sample(self, rng: random.Random = random) -> Optional[Hashable]:
+        """ Returns a random key with probability proportional to its weight, or None if all weights are zero """
+        self._rebuild()
+        block = self.top.sample(rng)
+        if block is None:
+            return None
+        return self.keys[block * self.block_size + self.blocks[block].sample(rng)]
+
+    def _rebuild(self) -> None:
+        if not self._dirty:
+            return
+        for block in self._dirty:
+            start = block * self.block_size
+            self.blocks[block] = AliasTable(self.weights[start:start + self.block_size])
+        self.top = AliasTable([block.total for block in self.blocks])
+        self._dirty.clear()
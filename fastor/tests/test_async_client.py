@@ -0,0 +1,82 @@
+import asyncio
+import random
+import threading
+import unittest
+from collections import Counter
+
+from fastor.client.client import AsyncFastorClient
+from fastor.events.scheduler import Scheduler
+from fastor.tests.test_circuit_pool import CircuitTorHandler
+from fastor.tests.test_connection_pool import LocalServers, SourcePortAttacher
+from fastor.tests.test_scheme import buildSnapshot
+
+
+class AsyncFastorClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = LocalServers()
+        self.tor_handler = tor_handler = CircuitTorHandler()
+        tor_handler.socks_port = self.servers.socks.server_address[1]
+
+        self.client = AsyncFastorClient(max_per_circuit=2, tor_handler=tor_handler, pool_size=2)
+        self.client.scheme.rng = random.Random(6)
+        self.client.scheme.info = lambda msg: None
+        self.client.scheme.updateConsensus(buildSnapshot())
+        self.attacher = self.client.connection_pool.stream_attacher = SourcePortAttacher()
+        self.client.circuit_pool.start(Scheduler())
+        tor_handler.event('1', 'BUILT')
+        tor_handler.event('2', 'BUILT')
+
+    def tearDown(self):
+        self.client.connection_pool.close()
+        self.servers.close()
+
+    def test_gather(self):
+        async def fetch():
+            try:
+                return await self.client.gather(urls)
+            finally:
+                self.client.connection_pool.close()
+
+        urls = [f"{self.servers.url}/slow/{i}" for i in range(12)]
+        responses = asyncio.run(fetch())
+        self.assertEqual(responses, [f"/slow/{i}".encode() for i in range(12)])
+
+        # Both circuits were used, each by at most 2 connections at a time, reused across requests
+        streams = Counter(circuit_id for _, circuit_id in self.attacher.streams)
+        self.assertEqual(set(streams), {'1', '2'})
+        self.assertLessEqual(max(streams.values()), 2)
+
+    def test_errors(self):
+        async def fetch():
+            try:
+                return await self.client.gather([self.servers.url + '/missing', self.servers.url + '/ok'],
+                                                limit=1, return_exceptions=True)
+            finally:
+                self.client.connection_pool.close()
+
+        missing, ok = asyncio.run(fetch())
+        self.assertIsInstance(missing, ValueError)
+        self.assertEqual(ok, b'/ok')
+
+    def test_circuitOffLoop(self):
+        # Empty the pool, so that taking a circuit launches builds
+        self.tor_handler.event('1', 'CLOSED')
+        self.tor_handler.event('2', 'CLOSED')
+        launching_threads = []
+        launch = self.tor_handler.newCircuit
+
+        def newCircuit(path):
+            launching_threads.append(threading.get_ident())
+            return launch(path)
+
+        self.tor_handler.newCircuit = newCircuit
+        threading.Timer(0.1, self.tor_handler.event, ('3', 'BUILT')).start()
+
+        async def circuit():
+            return threading.get_ident(), await self.client._circuit()
+
+        loop_thread, pooled = asyncio.run(circuit())
+        self.assertEqual(pooled.circuit_id, '3')
+        self.assertTrue(launching_threads)
+        self.assertNotIn(loop_thread, launching_threads)
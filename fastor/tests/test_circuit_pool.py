@@ -0,0 +1,95 @@
+import random
+import unittest
+from types import SimpleNamespace
+
+from fastor.client.pool import CircuitPool
+from fastor.events.events import CIRCUIT_UPDATE
+from fastor.events.scheduler import Scheduler
+from fastor.scheme import VanillaScheme
+from fastor.tests.test_scheme import buildSnapshot
+
+
+class CircuitTorHandler:
+    """ Records the circuits a pool launches and closes, standing in for a TorHandler connected to tor """
+    def __init__(self):
+        self.launched = []
+        self.closed = []
+        self.listener = None
+
+    def newCircuit(self, path):
+        self.launched.append(path)
+        return str(len(self.launched))
+
+    def closeCircuit(self, circuit_id):
+        self.closed.append(circuit_id)
+
+    def addEventListener(self, listener, event_type):
+        self.listener = listener
+
+    def removeEventListener(self, listener):
+        self.listener = None
+
+    def event(self, circuit_id, status):
+        self.listener(SimpleNamespace(id=circuit_id, status=status))
+
+
+class CircuitPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        scheme = VanillaScheme(random.Random(5))
+        scheme.info = lambda msg: None
+        scheme.updateConsensus(buildSnapshot())
+        self.tor_handler = CircuitTorHandler()
+        self.scheduler = Scheduler()
+        self.retired = []
+        self.pool = CircuitPool(self.tor_handler, scheme, size=2, on_retire=self.retired.append)
+        self.pool.start(self.scheduler)
+
+    def test_fill(self):
+        self.assertEqual(len(self.tor_handler.launched), 2)
+        self.assertEqual(len(self.scheduler.schedule.getEventConditions(CIRCUIT_UPDATE)), 1)
+        self.assertIsNone(self.pool.poll())
+        self.tor_handler.event('1', 'BUILT')
+        self.assertEqual(self.pool.poll().circuit_id, '1')
+        self.tor_handler.event('2', 'FAILED')
+        self.assertEqual([self.pool.acquire().circuit_id for _ in range(2)], ['1', '1'])
+
+        # The failed circuit is replaced on the next CIRCUIT_UPDATE
+        self.assertTrue(self.pool.needsUpdate())
+        self.pool.update()
+        self.tor_handler.event('3', 'BUILT')
+        self.assertEqual({self.pool.acquire().circuit_id for _ in range(2)}, {'1', '3'})
+        self.assertFalse(self.pool.needsUpdate())
+
+    def test_replaceOldCircuits(self):
+        self.tor_handler.event('1', 'BUILT')
+        self.tor_handler.event('2', 'BUILT')
+        for circuit in self.pool.ready:
+            circuit.built -= self.pool.max_age + 1
+        # Without a younger circuit ready, the old ones keep serving requests while replacements are built
+        self.assertTrue(self.pool.needsUpdate())
+        self.pool.update()
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(len(self.tor_handler.launched), 4)
+
+        self.tor_handler.event('3', 'BUILT')
+        self.pool.update()
+        self.assertEqual([circuit.circuit_id for circuit in self.pool.ready], ['3'])
+        self.assertEqual([circuit.circuit_id for circuit in self.pool.retiring], ['1', '2'])
+        self.assertEqual(self.retired, ['1', '2'])
+
+        self.tor_handler.event('1', 'CLOSED')
+        self.assertEqual([circuit.circuit_id for circuit in self.pool.retiring], ['2'])
+
+        # A ready circuit closed by tor is dropped and reported once
+        self.tor_handler.event('3', 'CLOSED')
+        self.pool.retire('3')
+        self.assertEqual(self.retired, ['1', '2', '3'])
+
+    def test_stop(self):
+        self.tor_handler.event('1', 'BUILT')
+        self.pool.stop()
+        self.assertEqual(sorted(self.tor_handler.closed), ['1', '2'])
+        self.assertEqual(self.scheduler.schedule.getEventConditions(CIRCUIT_UPDATE), [])
+        with self.assertRaises(ValueError):
+            self.pool.acquire()
@@ -1,7 +1,7 @@
 import unittest
 
 from fastor.client import getClient
-from fastor.client.client import FastorClient, VanillaClient
+from fastor.client.client import AsyncFastorClient, FastorClient, VanillaClient
 
 
 class FactoryTestCase(unittest.TestCase):
@@ -12,3 +12,6 @@ class FactoryTestCase(unittest.TestCase):
 
         vanilla_client = getClient("vanilla")
         self.assertIsInstance(vanilla_client, VanillaClient)
+
+        async_client = getClient("fastor-async")
+        self.assertIsInstance(async_client, AsyncFastorClient)
@@ -0,0 +1,147 @@
+import socket
+import socketserver
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fastor.client.connection import ConnectionPool, parseUrl
+
+
+class HttpHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b'3\r\nfas\r\n3\r\ntor\r\n0\r\n\r\n')
+        elif self.path == '/missing':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            if self.path.startswith('/slow'):
+                time.sleep(0.05)
+            body = self.path.encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SocksHandler(socketserver.BaseRequestHandler):
+    """ SOCKS5 CONNECT proxy for local targets, counting the streams it opens """
+
+    def handle(self):
+        sock = self.request
+        sock.recv(3)
+        sock.sendall(b'\x05\x00')
+        head = sock.recv(5)
+        host = sock.recv(head[4]).decode()
+        port = int.from_bytes(sock.recv(2), 'big')
+        self.server.streams += 1
+        upstream = socket.create_connection((host, port))
+        sock.sendall(b'\x05\x00\x00\x01' + bytes(6))
+
+        def pipe(source, destination):
+            try:
+                while True:
+                    data = source.recv(65536)
+                    if not data:
+                        break
+                    destination.sendall(data)
+            except OSError:
+                pass
+            finally:
+                destination.close()
+
+        threading.Thread(target=pipe, args=(upstream, sock), daemon=True).start()
+        pipe(sock, upstream)
+
+
+class SourcePortAttacher:
+    """ Records the source ports registered for each circuit, standing in for the StreamAttacher """
+    def __init__(self):
+        self.registered = {}
+        self.streams = []   # (source port, circuit id) of every stream opened
+
+    def register(self, source_port, circuit_id):
+        self.registered[source_port] = circuit_id
+        self.streams.append((source_port, circuit_id))
+
+    def unregister(self, source_port):
+        self.registered.pop(source_port, None)
+
+
+class LocalServers:
+    """ Local HTTP server behind a SOCKS5 proxy, standing in for tor and a destination """
+    def __init__(self):
+        self.http = ThreadingHTTPServer(('127.0.0.1', 0), HttpHandler)
+        self.socks = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SocksHandler)
+        self.socks.daemon_threads = True
+        self.socks.streams = 0
+        for server in (self.http, self.socks):
+            threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        self.url = f"http://localhost:{self.http.server_address[1]}"
+
+    def close(self):
+        for server in (self.http, self.socks):
+            server.shutdown()
+            server.server_close()
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = LocalServers()
+        self.socks = self.servers.socks
+        self.url = self.servers.url
+        self.attacher = SourcePortAttacher()
+        self.pool = ConnectionPool(self.attacher, self.socks.server_address[1], timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+        self.servers.close()
+
+    def test_keepAlive(self):
+        self.assertEqual(self.pool.request('1', self.url + '/a?b=c'), b'/a?b=c')
+        self.assertEqual(self.pool.request('1', self.url + '/chunked'), b'fastor')
+        self.assertEqual(self.socks.streams, 1)
+        self.assertEqual(list(self.attacher.registered.values()), ['1'])
+
+        # Another circuit gets its own stream
+        self.pool.request('2', self.url)
+        self.assertEqual(self.socks.streams, 2)
+
+        with self.assertRaises(ValueError):
+            self.pool.request('1', self.url + '/missing')
+        self.assertEqual(self.socks.streams, 2)
+
+    def test_idleEviction(self):
+        self.pool.request('1', self.url)
+        self.assertFalse(self.pool.needsEviction())
+        self.pool.idle_timeout = -1
+        self.assertTrue(self.pool.needsEviction())
+        self.assertEqual(self.pool.evictIdle(), 1)
+        self.assertEqual(self.attacher.registered, {})
+        self.pool.idle_timeout = 30
+        self.pool.request('1', self.url)
+        self.assertEqual(self.socks.streams, 2)
+
+    def test_closeCircuit(self):
+        self.pool.request('1', self.url)
+        self.pool.request('2', self.url)
+        self.assertEqual(self.pool.closeCircuit('1'), 1)
+        self.assertEqual(list(self.attacher.registered.values()), ['2'])
+        self.assertEqual(self.pool.closeCircuit('1'), 0)
+
+    def test_parseUrl(self):
+        target = parseUrl('https://example.com/path?q=1')
+        self.assertEqual((target.tls, target.host, target.port, target.path), (True, 'example.com', 443, '/path?q=1'))
+        with self.assertRaises(ValueError):
+            parseUrl('ftp://example.com')
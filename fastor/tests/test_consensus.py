@@ -0,0 +1,79 @@
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+
+from fastor.consensus import ConsensusCache, ConsensusRelay, ConsensusSnapshot
+from fastor.consensus.consensus import microdescriptorDigest
+
+
+def buildSnapshot(valid_after: float) -> ConsensusSnapshot:
+    relays = [ConsensusRelay('A' * 40, 'alpha', '10.0.0.1', 9001, ['Fast', 'Guard'], 500, 'reject 1-65535'),
+              ConsensusRelay('B' * 40, 'beta', '10.0.1.1', 443, ['Exit', 'Fast'], 1200, 'accept 80,443')]
+    return ConsensusSnapshot(valid_after, valid_after + 3600, valid_after + 3 * 3600, relays, {'Wgg': 6000})
+
+
+class ConsensusSnapshotTestCase(unittest.TestCase):
+
+    def test_roundtrip(self):
+        snapshot = buildSnapshot(time.time())
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'consensus.json')
+            snapshot.save(path)
+            loaded = ConsensusSnapshot.load(path)
+
+        self.assertEqual(loaded.relays, snapshot.relays)
+        self.assertEqual(loaded.bandwidth_weights, {'Wgg': 6000})
+        self.assertEqual(loaded.weights(), {'A' * 40: 500, 'B' * 40: 1200})
+
+    def test_fromDocument(self):
+        entry = SimpleNamespace(fingerprint='C' * 40, nickname='gamma', address='10.0.2.1', or_port=9001,
+                                flags=['Running', 'Fast'], bandwidth=None, exit_policy=None)
+        document = SimpleNamespace(routers={entry.fingerprint: entry}, bandwidth_weights={'Wee': 10000},
+                                   valid_after=datetime(2021, 3, 1, 12), fresh_until=datetime(2021, 3, 1, 13),
+                                   valid_until=datetime(2021, 3, 1, 15))
+        snapshot = ConsensusSnapshot.fromDocument(document)
+
+        self.assertEqual(snapshot.valid_after, 1614600000.0)
+        self.assertEqual(snapshot.relays[0].flags, ['Fast', 'Running'])
+        self.assertEqual(snapshot.relays[0].bandwidth, 0)
+        self.assertFalse(snapshot.isFresh(1614600000.0 + 3600))
+        self.assertTrue(snapshot.isValid(1614600000.0 + 3600))
+        self.assertEqual(snapshot.families(), {})
+
+    def test_families(self):
+        microdescriptor = "onion-key\nfamily $" + 'D' * 40 + "\n"
+        digest = microdescriptorDigest(microdescriptor)
+        entry = SimpleNamespace(fingerprint='C' * 40, nickname='gamma', address='10.0.2.1', or_port=9001,
+                                flags=['Running'], bandwidth=10, exit_policy=None, microdescriptor_digest=digest)
+        document = SimpleNamespace(routers={entry.fingerprint: entry}, bandwidth_weights={})
+        snapshot = ConsensusSnapshot.fromDocument(document, 0.0, 3600.0, 3 * 3600.0, {digest: ['$' + 'D' * 40]})
+        self.assertEqual(snapshot.families(), {'C' * 40: ['$' + 'D' * 40]})
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'consensus.json')
+            snapshot.save(path)
+            self.assertEqual(ConsensusSnapshot.load(path).relays, snapshot.relays)
+
+
+class ConsensusCacheTestCase(unittest.TestCase):
+
+    def test_loadsFreshSnapshotWithoutTor(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'consensus.json')
+            buildSnapshot(time.time()).save(path)
+
+            cache = ConsensusCache(path, cached_consensus_file=os.path.join(directory, 'missing'))
+            self.assertEqual(len(cache.get()), 2)
+
+    def test_keepsExpiredSnapshotWhenTorIsUnavailable(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'consensus.json')
+            buildSnapshot(time.time() - 2 * 3600).save(path)
+
+            cache = ConsensusCache(path, cached_consensus_file=os.path.join(directory, 'missing'))
+            snapshot = cache.get()
+            self.assertFalse(snapshot.isFresh())
+            self.assertEqual(snapshot.fingerprints(), ['A' * 40, 'B' * 40])
@@ -0,0 +1,117 @@
+import random
+import time
+import unittest
+from collections import Counter
+
+from fastor.consensus import ConsensusRelay, ConsensusSnapshot
+from fastor.scheme import FastorScheme, RelayTable, VanillaScheme, GUARD, MIDDLE, EXIT
+from fastor.scheme.utils import AliasTable, BlockedAliasSampler
+
+
+def buildSnapshot() -> ConsensusSnapshot:
+    flags = ['Fast', 'Running', 'Valid']
+    relays = [ConsensusRelay('A' * 40, 'guard', '10.0.0.1', 9001, flags + ['Guard'], 1000, 'reject 1-65535'),
+              ConsensusRelay('B' * 40, 'middle', '10.1.0.1', 9001, flags, 1000, 'reject 1-65535'),
+              ConsensusRelay('C' * 40, 'exit', '10.2.0.1', 9001, flags + ['Exit'], 1000, 'accept 80,443'),
+              ConsensusRelay('D' * 40, 'both', '10.3.0.1', 9001, flags + ['Exit', 'Guard'], 1000, 'accept 443'),
+              ConsensusRelay('E' * 40, 'slow', '10.4.0.1', 9001, ['Running', 'Valid'], 1000, 'reject 1-65535'),
+              ConsensusRelay('F' * 40, 'bad', '10.5.0.1', 9001, flags + ['BadExit', 'Exit'], 1000, 'accept 80')]
+    now = time.time()
+    return ConsensusSnapshot(now, now + 3600, now + 3 * 3600, relays,
+                             {'Wgg': 6000, 'Wgd': 0, 'Wmg': 4000, 'Wmm': 10000, 'Wme': 0, 'Wmd': 0,
+                              'Wee': 10000, 'Wed': 10000})
+
+
+class AliasTableTestCase(unittest.TestCase):
+
+    def test_distribution(self):
+        rng = random.Random(1)
+        table = AliasTable([1, 0, 3, 6])
+        counts = Counter(table.sample(rng) for _ in range(20000))
+        self.assertEqual(counts[1], 0)
+        self.assertAlmostEqual(counts[3] / 20000, 0.6, delta=0.02)
+        self.assertIsNone(AliasTable([0, 0]).sample(rng))
+
+    def test_blockedUpdate(self):
+        rng = random.Random(2)
+        sampler = BlockedAliasSampler(range(10), [1.0] * 10, block_size=3)
+        for key in range(9):
+            sampler.update(key, 0.0)
+        self.assertEqual({sampler.sample(rng) for _ in range(100)}, {9})
+        self.assertEqual(sampler.total, 1.0)
+
+
+class RelayTableTestCase(unittest.TestCase):
+
+    def test_indexes(self):
+        table = RelayTable(buildSnapshot())
+        self.assertTrue(table.hasFlag(table.rows['A' * 40], 'Guard'))
+        self.assertEqual(table.rowsWith('Exit', 'Guard'), 1 << table.rows['D' * 40])
+        self.assertTrue(table.allowsPort(table.rows['C' * 40], 80))
+        self.assertFalse(table.allowsPort(table.rows['D' * 40], 80))
+        self.assertFalse(table.allowsPort(table.rows['F' * 40], 22))
+        self.assertTrue(table.allowsPort(table.rows['C' * 40], 443))
+
+    def test_constraints(self):
+        snapshot = buildSnapshot()
+        snapshot.relays.append(snapshot.relays[0]._replace(fingerprint='G' * 40, address='10.0.9.9'))
+        table = RelayTable(snapshot)
+        a, b, c, g = (table.rows[fingerprint * 40] for fingerprint in 'ABCG')
+        self.assertTrue(table.conflicts(a, g))      # same /16
+        self.assertFalse(table.conflicts(a, b))
+
+        # Families need both relays to declare each other
+        table.setFamilies({'A' * 40: ['$' + 'B' * 40, 'C' * 40], 'B' * 40: ['A' * 40]})
+        self.assertTrue(table.conflicts(a, b))
+        self.assertFalse(table.conflicts(a, c))
+        self.assertEqual(table.by_family[a], [a, b])
+
+
+class SchemeTestCase(unittest.TestCase):
+
+    def test_positions(self):
+        scheme = VanillaScheme(random.Random(3))
+        scheme.updateConsensus(buildSnapshot())
+        # Wgd, Wme and Wmd are 0, so exits are kept for the exit position. E lacks Fast and the BadExit F is
+        # only usable as a middle
+        def relays(position):
+            return {scheme.table.fingerprints[row] for row in scheme.samplers[position].keys}
+
+        self.assertEqual(relays(GUARD), {'A' * 40})
+        self.assertEqual(relays(MIDDLE), {'A' * 40, 'B' * 40, 'F' * 40})
+        self.assertEqual(relays(EXIT), {'C' * 40, 'D' * 40})
+        counts = Counter(scheme.selectRelay(MIDDLE) for _ in range(5000))
+        self.assertAlmostEqual(counts['A' * 40] / 5000, 0.4 / 2.4, delta=0.03)
+
+        guard, middle, exit_ = scheme.selectPath()
+        self.assertEqual(len({guard, middle, exit_}), 3)
+        with self.assertRaises(ValueError):
+            scheme.selectRelay(GUARD, exclude=['A' * 40])
+
+    def test_scores(self):
+        scheme = FastorScheme({'C' * 40: 0.5, 'D' * 40: 2.0}, rng=random.Random(4))
+        scheme.updateConsensus(buildSnapshot())
+        counts = Counter(scheme.selectRelay(EXIT) for _ in range(5000))
+        self.assertAlmostEqual(counts['C' * 40] / 5000, 0.8, delta=0.03)
+
+        scheme.updateScores({'D' * 40: 0.5})
+        counts = Counter(scheme.selectRelay(EXIT) for _ in range(5000))
+        self.assertAlmostEqual(counts['C' * 40] / 5000, 0.5, delta=0.03)
+
+        # Only C accepts port 80
+        self.assertEqual({scheme.selectPath(port=80)[2] for _ in range(20)}, {'C' * 40})
+
+    def test_families(self):
+        snapshot = buildSnapshot()
+        snapshot.relays[0] = snapshot.relays[0]._replace(family=['$' + 'C' * 40])
+        snapshot.relays[2] = snapshot.relays[2]._replace(family=['$' + 'A' * 40])
+        scheme = VanillaScheme(random.Random(5))
+        scheme.updateConsensus(snapshot)
+
+        # A is the only guard and C the only exit for port 80, which their family forbids on one circuit
+        self.assertEqual(scheme.table.by_family, {0: [0, 2]})
+        self.assertEqual(scheme.selectRelay(GUARD, exclude=['D' * 40]), 'A' * 40)
+        with self.assertRaises(ValueError):
+            scheme.selectRelay(GUARD, exclude=['C' * 40])
+        with self.assertRaises(ValueError):
+            scheme.selectPath(port=80)
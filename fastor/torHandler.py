@@ -1,6 +1,15 @@
-import stem
+from typing import Callable, List
 
 from fastor.common import FastorObject
+from fastor.consensus import ConsensusCache, ConsensusSnapshot
+
+try:
+    import stem
+    import stem.connection
+    import stem.control
+except ImportError:
+    stem = None
+    print("Could not import stem")
 
 
 SOCKS_PORT = 9050
@@ -9,21 +18,86 @@ CONNECTION_TIMEOUT = 15  # timeout before we give up on a circuit
 
 
 class TorHandler(FastorObject):
-    def __init__(self):
-        """ Interface to stem.Controller  """
+    def __init__(self, control_port: int = CONTROL_PORT, socks_port: int = SOCKS_PORT):
+        """ Interface to stem.Controller
+
+        :param control_port: control port of the tor instance to drive
+        :param socks_port: socks port of the same tor instance
+        """
+        self.control_port = control_port
+        self.socks_port = socks_port
         self.tor_controller = None
+        self.consensus_cache = ConsensusCache()
+
+    def connect(self) -> bool:
+        """ Connects and authenticates to tor, unless already connected
+
+        :return: True if a controller is available
+        """
+        if self.tor_controller is not None:
+            return True
+        return self._initTorController()
+
+    def close(self) -> None:
+        if self.tor_controller is not None:
+            self.tor_controller.close()
+            self.tor_controller = None
+
+    def getConsensus(self) -> ConsensusSnapshot:
+        """ Returns the current consensus snapshot, only fetching it from tor when the cached one has expired """
+        return self.consensus_cache.get(self.tor_controller)
+
+    # Circuits
+    def newCircuit(self, path: List[str]) -> str:
+        """ Asks tor to build a circuit through the given relays without waiting for it
+
+        :param path: relay fingerprints, guard first
+        :return: circuit id, whose progress is reported through CIRC events
+        """
+        return self.tor_controller.new_circuit(path, await_build=False)
+
+    def closeCircuit(self, circuit_id: str) -> None:
+        try:
+            self.tor_controller.close_circuit(circuit_id)
+        except Exception as ex:
+            self.debug(f"Could not close circuit {circuit_id}: {ex}")
+
+    # Streams
+    def attachStream(self, stream_id: str, circuit_id: str) -> None:
+        """ Attaches a stream left unattached by tor to the circuit, '0' letting tor choose it """
+        self.tor_controller.attach_stream(stream_id, circuit_id)
+
+    def leaveStreamsUnattached(self, enabled: bool) -> None:
+        """ Makes tor wait for attachStream on every new stream instead of choosing circuits itself """
+        if enabled:
+            self.tor_controller.set_conf('__LeaveStreamsUnattached', '1')
+        elif self.tor_controller is not None:
+            self.tor_controller.reset_conf('__LeaveStreamsUnattached')
+
+    # Events
+    def addEventListener(self, listener: Callable, event_type: str) -> None:
+        """ Subscribes listener to tor events of event_type, e.g. 'CIRC' or 'STREAM' """
+        self.tor_controller.add_event_listener(listener, event_type)
+
+    def removeEventListener(self, listener: Callable) -> None:
+        if self.tor_controller is not None:
+            self.tor_controller.remove_event_listener(listener)
 
     # Tor controller
     def _initTorController(self):
+        if stem is None:
+            self.error("stem is required to drive tor")
+            return False
         try:
-            self.tor_controller = stem.control.Controller.from_port(port=CONTROL_PORT)
+            self.tor_controller = stem.control.Controller.from_port(port=self.control_port)
         except stem.SocketError as exc:
-            self.error(f"Unable to connect to tor on port {CONTROL_PORT}: {exc}")
+            self.error(f"Unable to connect to tor on port {self.control_port}: {exc}")
             return False
         try:
             self.tor_controller.authenticate()
         except stem.connection.AuthenticationFailure as exc:
             self.error(f"Unable to authenticate: {exc}")
+            self.tor_controller = None
             return False
         self.info(f"Tor is running version {self.tor_controller.get_version()}")
         return True
@@ -1,7 +1,9 @@
 import stem.control
 
+from fastor.consensus import ConsensusCache
+
 with stem.control.Controller.from_port() as controller:
         controller.authenticate()
-        relay_fingerprints = [desc.fingerprint for desc in controller.get_network_statuses()]
+        relay_fingerprints = ConsensusCache().get(controller).fingerprints()
 
 print(len(relay_fingerprints))
\ No newline at end of file